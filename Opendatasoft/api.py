@@ -0,0 +1,121 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+"""
+Plain Python API of the plugin, usable without any widget: from the QGIS Python console, from
+Processing algorithms, or from scripts run by qgis_process on headless machines. Functions block
+until they are done and raise the exceptions of the exceptions module on failure.
+
+    from Opendatasoft import api
+    api.export_dataset('data.opendatasoft.com', 'geonames-all-cities-with-a-population-1000',
+                       '/tmp/cities.gpkg', where='population > 100000')
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import catalog_index, schema, tasks, utils, writers
+from .exceptions import NumberOfLinesError
+
+
+def list_datasets(domain, apikey=None, include_non_geo_dataset=False, text_search=None, force_refresh=False):
+    """Identifiers of the datasets of a domain, sorted alphabetically unless text_search is given."""
+    return utils.datasets_to_dataset_id_list(
+        utils.import_dataset_list(domain, apikey, include_non_geo_dataset, text_search, force_refresh))
+
+
+def search_catalog(domain, text=None, apikey=None, include_non_geo_dataset=False, min_records=None,
+                   max_records=None, limit=None, force_refresh=False):
+    """
+    Title, publisher and number of records of the datasets of a domain matching all the words of text,
+    searched in the local catalog index. The index is built on the first call, then refreshed once a day.
+    """
+    utils.index_catalog(domain, apikey, force_refresh)
+    index = catalog_index.default_catalog_index()
+    scope = index.scope(domain, apikey)
+    dataset_ids, _ = index.search(scope, text, not include_non_geo_dataset, min_records, max_records, limit=limit)
+    return index.summaries(scope, dataset_ids)
+
+
+def get_schema(domain, dataset_id, apikey=None):
+    """schema.DatasetSchema of a dataset: fields, metas, geometry field and a sample record."""
+    return schema.get_dataset_schema(domain, dataset_id, apikey)
+
+
+def export_dataset(domain, dataset_id, file_path, apikey=None, select=None, where=None, order_by=None, limit=None,
+                   output_format=None, export_format=writers.AUTO, report_progress=None, is_canceled=lambda: False,
+                   fields=None):
+    """
+    Download a dataset to file_path, in output_format or in the format given by its extension.
+    fields, a list of field names, replaces select: only these fields and the geometry field are exported.
+    report_progress(text, percentage) is called while the export is downloaded, percentage being
+    None when unknown. Returns the number of records expected in the file.
+    """
+    params = export_params(apikey, select, where, order_by, limit)
+    output_format = output_format or writers.output_format_for(file_path)
+    export_format = writers.resolve_export_format(export_format)
+    geom_column = None
+    field_types = None
+    if fields or export_format == writers.JSONL or writers.needs_field_types(output_format, export_format):
+        dataset_schema = get_schema(domain, dataset_id, apikey)
+        if fields:
+            params['select'] = utils.pruned_select(fields, dataset_schema.geom_column)
+        if export_format == writers.JSONL:
+            geom_column = dataset_schema.geom_column
+        field_types = utils.export_field_types(dataset_schema.fields, params)
+    imported_dataset, records_count = utils.import_dataset_to_qgis(domain, dataset_id, params, export_format)
+    progress_reporter = tasks.ProgressReporter(records_count, report_progress or (lambda text, percentage: None))
+    try:
+        tasks.download_to_file(imported_dataset, file_path, progress_reporter, is_canceled, output_format,
+                               dataset_id, export_format, geom_column, field_types=field_types)
+    finally:
+        imported_dataset.close()
+    return records_count
+
+
+def export_datasets(domain, dataset_ids, directory, apikey=None, output_format=writers.GEOPACKAGE,
+                    export_format=writers.AUTO, max_workers=tasks.MAX_PARALLEL_IMPORTS, is_canceled=lambda: False):
+    """
+    Download several datasets to <directory>/<dataset_id>.<output_format>, at most max_workers at a
+    time. A failed dataset does not stop the others: returns the path of each dataset downloaded
+    and the error of each dataset which failed.
+    """
+    file_paths = {dataset_id: os.path.join(directory, '{}.{}'.format(writers.layer_name_for(dataset_id),
+                                                                      output_format))
+                  for dataset_id in dataset_ids}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {dataset_id: executor.submit(export_dataset, domain, dataset_id, file_paths[dataset_id], apikey,
+                                               output_format=output_format, export_format=export_format,
+                                               is_canceled=is_canceled)
+                   for dataset_id in dataset_ids}
+    exported, errors = {}, {}
+    for dataset_id, future in futures.items():
+        try:
+            future.result()
+            exported[dataset_id] = file_paths[dataset_id]
+        except tasks.DOWNLOAD_ERRORS as error:
+            errors[dataset_id] = error
+            tasks.remove_partial_file(file_paths[dataset_id])
+    return exported, errors
+
+
+def export_params(apikey=None, select=None, where=None, order_by=None, limit=None):
+    """Export query of the Explore API, as built by the plugin dialog from its filter inputs."""
+    params = {}
+    for name, value in (('select', select), ('where', where), ('order_by', order_by)):
+        if value:
+            params[name] = value
+    if limit is not None and limit != -1:
+        if not isinstance(limit, int) or limit < 0:
+            raise NumberOfLinesError
+        params['limit'] = str(limit)
+    if apikey:
+        params['apikey'] = apikey
+    return params
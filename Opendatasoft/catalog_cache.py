@@ -0,0 +1,134 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from PyQt5.QtCore import QSettings
+from qgis.core import QgsApplication
+
+CACHE_DIRECTORY_NAME = 'ods_catalog_cache'
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+TTL_SETTINGS_KEY = 'ods_plugin/catalog_cache_ttl'
+MAX_SIZE_SETTINGS_KEY = 'ods_plugin/catalog_cache_max_size'
+
+
+class JsonFileCache:
+    """
+    On-disk cache of JSON entries, one file per key, each entry recording when it was stored.
+    The least recently used entries are evicted when the cache grows above its maximum size.
+    """
+    def __init__(self, directory, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored_at'] < self.ttl
+
+    def store(self, key, entry):
+        entry = dict(entry, stored_at=time.time())
+        self._write(key, entry)
+        self._evict()
+        return entry
+
+    def touch(self, key, entry):
+        """Mark an entry as fresh again, after the server answered that it did not change."""
+        entry['stored_at'] = time.time()
+        self._write(key, entry)
+
+    def remove(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.json'):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+    def _write(self, key, entry):
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, self._entry_path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _evict(self):
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.json'):
+                continue
+            file_path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            total_size -= size
+
+
+class CatalogCache(JsonFileCache):
+    """
+    On-disk cache of dataset lists, one JSON file per (domain, text search, non-geo option, API key) query.
+    Entries younger than the TTL are served without any network traffic, older ones keep their
+    ETag/Last-Modified validators so that they can be revalidated with a conditional request.
+    """
+    @staticmethod
+    def key(domain_url, text_search_param, include_non_geo_dataset, apikey):
+        raw_key = json.dumps([domain_url, text_search_param, bool(include_non_geo_dataset), apikey_identity(apikey)])
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def put(self, key, json_dataset, etag=None, last_modified=None):
+        return self.store(key, {'etag': etag, 'last_modified': last_modified, 'json_dataset': json_dataset})
+
+
+def apikey_identity(apikey):
+    """Digest identifying an API key in cache keys: the API key itself is never written on disk."""
+    return hashlib.sha256(apikey.encode('utf-8')).hexdigest() if apikey else None
+
+
+def default_catalog_cache():
+    """Catalog cache stored in the QGIS profile folder, configured from QGIS settings."""
+    settings = QSettings()
+    ttl = int(settings.value(TTL_SETTINGS_KEY, DEFAULT_TTL))
+    max_size = int(settings.value(MAX_SIZE_SETTINGS_KEY, DEFAULT_MAX_SIZE))
+    directory = os.path.join(QgsApplication.qgisSettingsDirPath(), CACHE_DIRECTORY_NAME)
+    return CatalogCache(directory, ttl, max_size)
@@ -0,0 +1,184 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+from PyQt5.QtCore import QSettings
+from qgis.core import QgsApplication
+
+from . import catalog_cache
+
+INDEX_FILE_NAME = 'ods_catalog_index.sqlite'
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS catalogs (
+    scope TEXT PRIMARY KEY, domain TEXT NOT NULL, indexed_at REAL NOT NULL, datasets INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS datasets (
+    scope TEXT NOT NULL, dataset_id TEXT NOT NULL, title TEXT, publisher TEXT, records_count INTEGER,
+    has_geo INTEGER NOT NULL, dataset TEXT NOT NULL, PRIMARY KEY (scope, dataset_id));
+CREATE VIRTUAL TABLE IF NOT EXISTS datasets_search USING fts5(
+    scope UNINDEXED, dataset_id, title, publisher, keywords, description, tokenize='unicode61 remove_diacritics 2');
+'''
+
+
+class CatalogIndex:
+    """
+    SQLite index of the metadata and fields of every dataset of a catalog, one catalog per
+    (domain, API key) scope, with a full-text index on identifiers, titles, publishers, keywords
+    and descriptions. Once a catalog is indexed, it can be searched and its schemas read without
+    any network access. A catalog is replaced as a whole in one transaction when indexed again.
+    """
+    def __init__(self, file_path, ttl=catalog_cache.DEFAULT_TTL):
+        self.file_path = file_path
+        self.ttl = ttl
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @staticmethod
+    def scope(domain_url, apikey):
+        # The API key itself is never written on disk, only a digest identifying it
+        apikey_identity = hashlib.sha256(apikey.encode('utf-8')).hexdigest() if apikey else None
+        return hashlib.sha256(json.dumps([domain_url, apikey_identity]).encode('utf-8')).hexdigest()
+
+    def indexed_at(self, scope):
+        """When the catalog of scope was last indexed, None if it never was."""
+        with self._connect() as connection:
+            row = connection.execute('SELECT indexed_at FROM catalogs WHERE scope = ?', (scope,)).fetchone()
+        return row[0] if row else None
+
+    def is_fresh(self, scope):
+        indexed_at = self.indexed_at(scope)
+        return indexed_at is not None and time.time() - indexed_at < self.ttl
+
+    def replace(self, scope, domain_url, datasets):
+        """Index the datasets of a catalog, as returned by the catalog endpoints, instead of the previous ones."""
+        with self._connect() as connection:
+            connection.execute('DELETE FROM datasets WHERE scope = ?', (scope,))
+            connection.execute('DELETE FROM datasets_search WHERE scope = ?', (scope,))
+            count = 0
+            for dataset in datasets:
+                default_metas = (dataset.get('metas') or {}).get('default') or {}
+                connection.execute(
+                    'INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (scope, dataset['dataset_id'], default_metas.get('title'), default_metas.get('publisher'),
+                     default_metas.get('records_count'), has_geo(dataset), json.dumps(dataset)))
+                # A dataset listed twice by the catalog replaces its previous version in both tables
+                connection.execute('DELETE FROM datasets_search WHERE scope = ? AND dataset_id = ?',
+                                   (scope, dataset['dataset_id']))
+                connection.execute(
+                    'INSERT INTO datasets_search VALUES (?, ?, ?, ?, ?, ?)',
+                    (scope, dataset['dataset_id'], default_metas.get('title'), default_metas.get('publisher'),
+                     ' '.join(default_metas.get('keyword') or []), strip_html(default_metas.get('description'))))
+                count += 1
+            connection.execute('INSERT OR REPLACE INTO catalogs VALUES (?, ?, ?, ?)',
+                               (scope, domain_url, time.time(), count))
+        return count
+
+    def search(self, scope, text=None, geo_only=False, min_records=None, max_records=None, offset=0, limit=None):
+        """
+        Identifiers of the datasets of scope matching all the words of text, sorted by relevance, or
+        alphabetically without text. Returns one page of them and the number of matching datasets.
+        """
+        conditions = ['datasets.scope = ?']
+        values = [scope]
+        join = ''
+        order_by = 'datasets.dataset_id'
+        match = match_expression(text)
+        if match:
+            join = 'JOIN datasets_search ON datasets_search.scope = datasets.scope ' \
+                   'AND datasets_search.dataset_id = datasets.dataset_id'
+            conditions.append('datasets_search MATCH ?')
+            values.append(match)
+            order_by = 'datasets_search.rank'
+        if geo_only:
+            conditions.append('datasets.has_geo = 1')
+        if min_records is not None:
+            conditions.append('datasets.records_count >= ?')
+            values.append(min_records)
+        if max_records is not None:
+            conditions.append('datasets.records_count <= ?')
+            values.append(max_records)
+        query = 'FROM datasets {} WHERE {}'.format(join, ' AND '.join(conditions))
+        with self._connect() as connection:
+            total_count = connection.execute('SELECT count(*) {}'.format(query), values).fetchone()[0]
+            rows = connection.execute('SELECT datasets.dataset_id {} ORDER BY {} LIMIT ? OFFSET ?'.format(
+                query, order_by), values + [-1 if limit is None else limit, offset]).fetchall()
+        return [row[0] for row in rows], total_count
+
+    def summaries(self, scope, dataset_ids):
+        """Title, publisher and number of records of indexed datasets."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT dataset_id, title, publisher, records_count FROM datasets WHERE scope = ? '
+                'AND dataset_id IN ({})'.format(','.join('?' * len(dataset_ids))), [scope] + list(dataset_ids))
+            summaries = {row[0]: {'dataset_id': row[0], 'title': row[1], 'publisher': row[2],
+                                  'records_count': row[3]} for row in rows}
+        return [summaries[dataset_id] for dataset_id in dataset_ids if dataset_id in summaries]
+
+    def metadata(self, scope, dataset_id):
+        """Metadata of an indexed dataset, shaped like the answer of the catalog endpoint, or None."""
+        with self._connect() as connection:
+            row = connection.execute('SELECT dataset FROM datasets WHERE scope = ? AND dataset_id = ?',
+                                     (scope, dataset_id)).fetchone()
+        if row is None:
+            return None
+        return {'total_count': 1, 'results': [json.loads(row[0])]}
+
+    def clear(self):
+        with self._connect() as connection:
+            for table in ('catalogs', 'datasets', 'datasets_search'):
+                connection.execute('DELETE FROM {}'.format(table))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # One connection per call: the index is written by background tasks and read by the dialog
+        connection = sqlite3.connect(self.file_path, timeout=10)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+def has_geo(dataset):
+    if 'geo' in (dataset.get('features') or []):
+        return True
+    return any(field.get('type') in ('geo_point_2d', 'geo_shape') for field in dataset.get('fields') or [])
+
+
+def strip_html(text):
+    return re.sub(r'<[^>]+>', ' ', text or '')
+
+
+def match_expression(text):
+    """FTS5 query matching the words of text, the last one being a prefix as it may still be typed."""
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    return ' '.join('"{}"'.format(word) for word in words) + '*'
+
+
+def default_catalog_index():
+    """Catalog index stored in the QGIS profile folder, kept as long as the catalog cache entries."""
+    ttl = int(QSettings().value(catalog_cache.TTL_SETTINGS_KEY, catalog_cache.DEFAULT_TTL))
+    return open_catalog_index(os.path.join(QgsApplication.qgisSettingsDirPath(), INDEX_FILE_NAME), ttl)
+
+
+@functools.lru_cache(maxsize=None)
+def open_catalog_index(file_path, ttl):
+    """CatalogIndex of a file, its tables being created once per session only."""
+    return CatalogIndex(file_path, ttl)
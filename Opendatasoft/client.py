@@ -0,0 +1,266 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import contextlib
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from PyQt5.QtCore import QSettings
+
+from . import instrumentation
+from .exceptions import AccessError, DomainError, InternalError, OdsqlError, RateLimitError, RequestTimeoutError
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_CONCURRENT_REQUESTS = 6
+DEFAULT_MAX_REQUESTS_PER_SECOND = 0
+CONNECT_TIMEOUT_SETTINGS_KEY = 'ods_plugin/connect_timeout'
+READ_TIMEOUT_SETTINGS_KEY = 'ods_plugin/read_timeout'
+MAX_CONCURRENT_REQUESTS_SETTINGS_KEY = 'ods_plugin/max_concurrent_requests'
+MAX_REQUESTS_PER_SECOND_SETTINGS_KEY = 'ods_plugin/max_requests_per_second'
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+MAX_BACKOFF = 30
+# Longer Retry-After delays are not waited for: the request fails right away
+MAX_RETRY_AFTER = 120
+
+
+class OdsClient:
+    """
+    HTTP client for the Explore API v2.1 of one Opendatasoft domain.
+    Connections are kept alive in a pool shared by every call, and all responses go through
+    the same mapping of HTTP errors to the plugin exceptions. Requests are sent through the
+    RequestScheduler of the domain and retried when throttled or when the server is unavailable.
+    """
+    def __init__(self, domain_url, apikey=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, pool_size=DEFAULT_POOL_SIZE, scheduler=None):
+        self.domain_url = domain_url
+        self.apikey = apikey
+        self.timeout = (connect_timeout, read_timeout)
+        self.scheduler = scheduler or RequestScheduler()
+        self.session = requests.Session()
+        adapter = instrumentation.TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if apikey:
+            self.session.headers['Authorization'] = 'apikey {}'.format(apikey)
+
+    def url(self, path):
+        if '://' in self.domain_url:
+            # Domain given with its scheme, e.g. a local server such as the one of the benchmarks
+            return "{}/api/explore/v2.1/{}".format(self.domain_url.rstrip('/'), path)
+        return "https://{}/api/explore/v2.1/{}".format(self.domain_url, path)
+
+    def get(self, path, params=None, headers=None, stream=False, not_found_error=DomainError, timeout=None):
+        """
+        GET an Explore API path, e.g. 'catalog/datasets'.
+        404 responses raise not_found_error, since its meaning depends on the path.
+        Streamed responses keep their query_params and get a reopen(extra_headers, params) method
+        sending the same request again, with other params if given, e.g. to resume the stream after
+        the connection dropped.
+        """
+        response = self.send(path, params, headers, stream, timeout)
+        check_response(response, not_found_error)
+        if stream:
+            response.query_params = dict(params or {})
+            response.reopen = lambda extra_headers=None, params=None: self.get(
+                path, response.query_params if params is None else params, dict(headers or {}, **(extra_headers or {})),
+                stream, not_found_error, timeout)
+        return response
+
+    def send(self, path, params=None, headers=None, stream=False, timeout=None):
+        """
+        GET an Explore API path without checking the status of the response, timeout (in seconds)
+        replacing the connect and read timeouts of the client if given.
+        429 and 5xx responses are retried up to MAX_RETRIES times, after the delay given by their
+        Retry-After header or an exponential backoff with jitter. A 429 response pauses every
+        request to the domain for that delay. 429 responses still throttled after the last retry
+        raise RateLimitError. Latencies and sizes of the call are recorded by the instrumentation module.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            instrumentation.start_request()
+            start = time.monotonic()
+            try:
+                with self.scheduler.slot(self.apikey):
+                    response = self.session.get(self.url(path), params=params, headers=headers, stream=stream,
+                                                timeout=timeout or self.timeout)
+            except requests.exceptions.ReadTimeout:
+                record_failure(path, start, 'timeout')
+                raise RequestTimeoutError
+            except (requests.exceptions.ConnectionError, requests.exceptions.InvalidURL):
+                record_failure(path, start, 'connection error')
+                raise DomainError
+            response = instrumentation.track_response(response, self.url(path), start)
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                break
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            elif delay > MAX_RETRY_AFTER:
+                break
+            response.close()
+            instrumentation.record('retry', path, status=response.status_code, attempt=attempt + 1, delay=delay)
+            if response.status_code == 429:
+                self.scheduler.pause(delay)
+            else:
+                time.sleep(delay)
+        if response.status_code == 429:
+            raise RateLimitError('Too many requests to {}, retry later.'.format(self.domain_url))
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, with bursts of at most capacity requests."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Wait until a request can be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class RequestScheduler:
+    """
+    Shared by every client of a domain: at most max_concurrent requests are sent to the domain at a
+    time, each API key (or anonymous access) gets a token bucket of max_requests_per_second requests
+    if set, and every request waits while the domain is paused after a 429 response.
+    Streamed responses free their slot once their headers are received.
+    """
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 max_requests_per_second=DEFAULT_MAX_REQUESTS_PER_SECOND):
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.max_requests_per_second = max_requests_per_second
+        self.buckets = {}
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self, apikey=None):
+        with self.slots:
+            self.wait_while_paused()
+            bucket = self.bucket(apikey)
+            if bucket is not None:
+                bucket.take()
+            yield
+
+    def bucket(self, apikey):
+        if not self.max_requests_per_second:
+            return None
+        with self._lock:
+            if apikey not in self.buckets:
+                self.buckets[apikey] = TokenBucket(self.max_requests_per_second)
+            return self.buckets[apikey]
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_while_paused(self):
+        while True:
+            with self._lock:
+                delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+
+def retry_after(response):
+    """Delay in seconds asked by the Retry-After header of a response, None if there is none."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter: a random delay up to BACKOFF_BASE * 2 ** attempt seconds."""
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt))
+
+
+def record_failure(path, start, error):
+    instrumentation.record('http', path, total=time.monotonic() - start, error=error,
+                           **instrumentation.connection_timings())
+
+
+def check_response(response, not_found_error=DomainError):
+    if response.status_code >= 500:
+        raise InternalError
+    if response.status_code == 404:
+        raise not_found_error
+    if response.status_code == 401:
+        raise AccessError
+    if response.status_code == 400:
+        try:
+            message = response.json()['message']
+        except (ValueError, KeyError, TypeError):
+            message = response.text
+        raise OdsqlError(message)
+
+
+_clients = {}
+_schedulers = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(domain_url, apikey=None):
+    """
+    Shared client of a domain, so that every call to the same domain reuses its connections.
+    Clients of the same domain with different API keys share its RequestScheduler.
+    """
+    key = (domain_url, apikey)
+    with _clients_lock:
+        if key not in _clients:
+            settings = QSettings()
+            if domain_url not in _schedulers:
+                _schedulers[domain_url] = RequestScheduler(
+                    int(settings.value(MAX_CONCURRENT_REQUESTS_SETTINGS_KEY, DEFAULT_MAX_CONCURRENT_REQUESTS)),
+                    float(settings.value(MAX_REQUESTS_PER_SECOND_SETTINGS_KEY, DEFAULT_MAX_REQUESTS_PER_SECOND)))
+            _clients[key] = OdsClient(
+                domain_url, apikey,
+                connect_timeout=float(settings.value(CONNECT_TIMEOUT_SETTINGS_KEY, DEFAULT_CONNECT_TIMEOUT)),
+                read_timeout=float(settings.value(READ_TIMEOUT_SETTINGS_KEY, DEFAULT_READ_TIMEOUT)),
+                scheduler=_schedulers[domain_url])
+        return _clients[key]
+
+
+def close_clients():
+    with _clients_lock:
+        for ods_client in _clients.values():
+            ods_client.close()
+        _clients.clear()
+        _schedulers.clear()
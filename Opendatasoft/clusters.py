@@ -0,0 +1,91 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+
+DEFAULT_PRECISION = 5
+MAX_PRECISION = 12
+REFINE_STEP = 2
+CLUSTER_ALIAS = 'cluster'
+COUNT_ALIAS = 'count'
+# Layer custom property holding the query of a summary layer, to run it again at a finer precision
+LAYER_PROPERTY = 'ods_plugin/clusters'
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def cluster_params(params, geom_column, precision, aggregates='', extent=None):
+    """
+    Export query grouping the records of a point dataset by geo cluster at the given precision, with
+    their count and the ODSQL aggregates given (e.g. 'avg(price) as price'). extent, a
+    (lon_min, lat_min, lon_max, lat_max) tuple, restricts the query to a part of the map.
+    """
+    select = 'count(*) as {}'.format(COUNT_ALIAS)
+    if aggregates:
+        select += ', {}'.format(aggregates)
+    clustered_params = {'select': select,
+                        'group_by': 'geo_cluster({}, {}) as {}'.format(geom_column, precision, CLUSTER_ALIAS)}
+    wheres = [params['where']] if params.get('where') else []
+    if extent is not None:
+        lon_min, lat_min, lon_max, lat_max = extent
+        wheres.append('in_bbox({}, {}, {}, {}, {})'.format(geom_column, lat_min, lon_min, lat_max, lon_max))
+    if wheres:
+        clustered_params['where'] = ' and '.join('({})'.format(where) for where in wheres)
+    return clustered_params
+
+
+def cluster_to_feature(row):
+    """GeoJSON point feature of a grouped row, located at the center of its cluster."""
+    properties = dict(row)
+    center = cluster_center(properties.pop(CLUSTER_ALIAS, None))
+    geometry = {'type': 'Point', 'coordinates': list(center)} if center else None
+    return {'type': 'Feature', 'geometry': geometry, 'properties': properties}
+
+
+def cluster_center(value):
+    """(lon, lat) of a cluster value, whether it comes as a point, a GeoJSON geometry or a geohash."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return decode_geohash(value)
+    if not isinstance(value, dict):
+        return None
+    if 'lon' in value and 'lat' in value:
+        return value['lon'], value['lat']
+    if value.get('type') == 'Feature':
+        value = value.get('geometry') or {}
+    if value.get('type') == 'Point':
+        return tuple(value['coordinates'][:2])
+    return None
+
+
+def decode_geohash(geohash):
+    """Center (lon, lat) of a geohash cell, or None if it is not a geohash."""
+    lon_range, lat_range = [-180.0, 180.0], [-90.0, 90.0]
+    is_lon = True
+    for character in geohash.lower():
+        index = GEOHASH_ALPHABET.find(character)
+        if index == -1:
+            return None
+        for bit in (16, 8, 4, 2, 1):
+            bounds = lon_range if is_lon else lat_range
+            middle = (bounds[0] + bounds[1]) / 2
+            if index & bit:
+                bounds[0] = middle
+            else:
+                bounds[1] = middle
+            is_lon = not is_lon
+    if not geohash:
+        return None
+    return (lon_range[0] + lon_range[1]) / 2, (lat_range[0] + lat_range[1]) / 2
+
+
+def refined_precision(precision):
+    return min(precision + REFINE_STEP, MAX_PRECISION)
@@ -0,0 +1,258 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QSettings, Qt, pyqtSignal
+from qgis.core import QgsApplication, QgsTask
+
+from . import utils
+from .exceptions import AccessError, DomainError, InternalError, OdsqlError, RequestTimeoutError
+
+PLACEHOLDER = '--Choose a dataset identifier--'
+PAGE_SIZE = 100
+DOMAIN_ROLE = Qt.UserRole
+DATASET_ID_ROLE = Qt.UserRole + 1
+DEFAULT_FEDERATED_TIMEOUT = 10
+FEDERATED_TIMEOUT_SETTINGS_KEY = 'ods_plugin/federated_search_timeout'
+FETCH_ERRORS = (OSError, ValueError, requests.exceptions.RequestException, AccessError, DomainError,
+                InternalError, OdsqlError, RequestTimeoutError)
+
+
+class DatasetPageTask(QgsTask):
+    """
+    Load one page of the datasets of a catalog query on one domain in a background thread.
+    The first page also resolves local_search when the catalog index or a fresh catalog cache entry
+    knows the query, so that the next pages are read without any network access.
+    """
+    def __init__(self, query, generation, offset=0):
+        super(DatasetPageTask, self).__init__('Search datasets of {}'.format(query['domains'][0]), QgsTask.CanCancel)
+        self.query = query
+        self.generation = generation
+        self.offset = offset
+        self.local_search = None
+        self.dataset_ids = None
+        self.total_count = None
+        self.error = None
+
+    def run(self):
+        try:
+            if self.offset == 0 and not self.query['force_refresh']:
+                self.local_search = local_dataset_search(self.query['domains'][0], self.query['apikey'],
+                                                         self.query['include_non_geo_dataset'],
+                                                         self.query['text_search'])
+            if self.local_search is not None:
+                self.dataset_ids, self.total_count = self.local_search(self.offset, PAGE_SIZE)
+            else:
+                self.dataset_ids, self.total_count = remote_dataset_page(self.query, self.offset)
+        except FETCH_ERRORS as error:
+            self.error = error
+            return False
+        return True
+
+
+class FederatedSearchTask(QgsTask):
+    """
+    Search the catalogs of several domains concurrently, each one with its own timeout.
+    domainSearched is emitted as soon as a domain answers or fails, whatever the others do.
+    """
+    domainSearched = pyqtSignal(str, object, object)
+
+    def __init__(self, query, generation, timeout):
+        super(FederatedSearchTask, self).__init__('Search datasets of {} domains'.format(len(query['domains'])),
+                                                  QgsTask.CanCancel)
+        self.query = query
+        self.generation = generation
+        self.timeout = timeout
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=len(self.query['domains'])) as executor:
+            futures = {executor.submit(self.searchDomain, domain): domain for domain in self.query['domains']}
+            for future in as_completed(futures):
+                if self.isCanceled():
+                    return False
+                try:
+                    self.domainSearched.emit(futures[future], future.result(), None)
+                except FETCH_ERRORS as error:
+                    self.domainSearched.emit(futures[future], None, error)
+        return not self.isCanceled()
+
+    def searchDomain(self, domain):
+        indexed_search = utils.indexed_dataset_search(domain, self.query['apikey'],
+                                                      self.query['include_non_geo_dataset'], self.query['text_search'])
+        if indexed_search is not None:
+            return indexed_search(0, PAGE_SIZE)[0]
+        return utils.import_dataset_page(domain, self.query['apikey'], self.query['include_non_geo_dataset'],
+                                         self.query['text_search'], 0, PAGE_SIZE, timeout=self.timeout)[0]
+
+
+class DatasetListModel(QAbstractListModel):
+    """
+    Lazy list of the datasets matching a catalog query, the first row being a placeholder.
+    Pages are loaded by background tasks so that setting a query never blocks, views asking for the
+    next ones through canFetchMore/fetchMore while they are scrolled. They are read from the local
+    catalog index or a fresh catalog cache entry when one knows the query, otherwise requested from
+    the catalog endpoint one at a time. Results of an outdated query are dropped.
+    A query on several domains shows the first page of each domain, labelled by its domain, as
+    soon as the domain answers.
+    """
+    fetchFailed = pyqtSignal(object)
+    domainFailed = pyqtSignal(str, object)
+    pageLoaded = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(DatasetListModel, self).__init__(parent)
+        # (domain, dataset identifier) of each row after the placeholder
+        self.datasets = []
+        self.total_count = 0
+        self.query = None
+        # search(offset, limit) reading the next pages without any network access, set with the first page
+        self.local_search = None
+        self.pending_task = None
+        self.generation = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.datasets) + 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if index.row() == 0:
+            return PLACEHOLDER if role in (Qt.DisplayRole, Qt.EditRole) else None
+        domain, dataset_id = self.datasets[index.row() - 1]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return '{} ({})'.format(dataset_id, domain) if self.isFederated() else dataset_id
+        if role == DOMAIN_ROLE:
+            return domain
+        if role == DATASET_ID_ROLE:
+            return dataset_id
+        return None
+
+    def flags(self, index):
+        flags = super(DatasetListModel, self).flags(index)
+        if index.isValid() and index.row() == 0:
+            # The placeholder can be shown by the dataset combobox but never picked in a list of datasets
+            flags &= ~Qt.ItemIsSelectable
+        return flags
+
+    def isFederated(self):
+        return self.query is not None and len(self.query['domains']) > 1
+
+    def setQuery(self, domains, apikey, include_non_geo_dataset, text_search, force_refresh=False):
+        """Replace the rows with the first page of the datasets of each domain matching text_search."""
+        self.generation += 1
+        if self.pending_task is not None:
+            self.pending_task.cancel()
+            self.pending_task = None
+        self.beginResetModel()
+        self.datasets = []
+        self.total_count = 0
+        self.query = {'domains': list(domains), 'apikey': apikey, 'include_non_geo_dataset': include_non_geo_dataset,
+                      'text_search': text_search, 'force_refresh': force_refresh}
+        self.local_search = None
+        self.endResetModel()
+        if self.isFederated():
+            self.searchDomains()
+        else:
+            self.fetchFirstPage()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.query is None or self.isFederated() or self.pending_task is not None:
+            return False
+        return len(self.datasets) < self.total_count
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        if self.local_search is not None:
+            dataset_ids, self.total_count = self.local_search(len(self.datasets), PAGE_SIZE)
+            self.appendPage(self.query['domains'][0], dataset_ids)
+        else:
+            self.fetchPage(len(self.datasets))
+
+    def fetchFirstPage(self):
+        self.fetchPage(0)
+
+    def fetchPage(self, offset):
+        task = DatasetPageTask(self.query, self.generation, offset)
+        task.taskCompleted.connect(lambda: self.pageFetched(task))
+        task.taskTerminated.connect(lambda: self.pageFetched(task))
+        self.pending_task = task
+        QgsApplication.taskManager().addTask(task)
+
+    def pageFetched(self, task):
+        if task.generation != self.generation:
+            return
+        self.pending_task = None
+        if task.error is not None:
+            self.fetchFailed.emit(task.error)
+            return
+        # Rows may have been added meanwhile
+        if task.dataset_ids is None or task.offset != len(self.datasets):
+            return
+        if task.offset == 0:
+            self.local_search = task.local_search
+        self.total_count = task.total_count
+        self.appendPage(self.query['domains'][0], task.dataset_ids)
+
+    def searchDomains(self):
+        timeout = float(QSettings().value(FEDERATED_TIMEOUT_SETTINGS_KEY, DEFAULT_FEDERATED_TIMEOUT))
+        task = FederatedSearchTask(self.query, self.generation, timeout)
+        task.domainSearched.connect(lambda domain, dataset_ids, error: self.domainSearched(
+            task, domain, dataset_ids, error))
+        task.taskCompleted.connect(lambda: self.searchFinished(task))
+        task.taskTerminated.connect(lambda: self.searchFinished(task))
+        self.pending_task = task
+        QgsApplication.taskManager().addTask(task)
+
+    def domainSearched(self, task, domain, dataset_ids, error):
+        if task.generation != self.generation:
+            return
+        if error is not None:
+            self.domainFailed.emit(domain, error)
+            return
+        self.total_count += len(dataset_ids)
+        self.appendPage(domain, dataset_ids)
+
+    def searchFinished(self, task):
+        if task.generation == self.generation:
+            self.pending_task = None
+
+    def appendPage(self, domain, dataset_ids):
+        if dataset_ids:
+            first_row = len(self.datasets) + 1
+            self.beginInsertRows(QModelIndex(), first_row, first_row + len(dataset_ids) - 1)
+            self.datasets.extend((domain, dataset_id) for dataset_id in dataset_ids)
+            self.endInsertRows()
+        self.pageLoaded.emit()
+
+
+def remote_dataset_page(query, offset):
+    """One page of the catalog endpoint for a query on one domain, with the number of datasets it can page through."""
+    domain = query['domains'][0]
+    dataset_ids, total_count = utils.import_dataset_page(domain, query['apikey'], query['include_non_geo_dataset'],
+                                                         query['text_search'], offset, PAGE_SIZE)
+    # Offsets past the query size limit of the catalog endpoint are rejected
+    return dataset_ids, min(total_count, utils.catalog_query_size_limit(domain))
+
+
+def local_dataset_search(domain, apikey, include_non_geo_dataset, text_search):
+    """
+    search(offset, limit) function reading the datasets matching a catalog query without any network
+    access, from the catalog index or a fresh catalog cache entry. None when neither knows the query.
+    """
+    indexed_search = utils.indexed_dataset_search(domain, apikey, include_non_geo_dataset, text_search)
+    if indexed_search is not None:
+        return indexed_search
+    cached_dataset_ids = utils.cached_dataset_id_list(domain, apikey, include_non_geo_dataset, text_search)
+    if cached_dataset_ids is not None:
+        return lambda offset, limit: (cached_dataset_ids[offset:offset + limit], len(cached_dataset_ids))
+    return None
@@ -0,0 +1,83 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from qgis.core import QgsApplication
+
+STORE_FILE_NAME = 'ods_dataset_store.json'
+
+
+class DatasetStore:
+    """
+    Index of the datasets imported on disk, keyed by domain, dataset and query parameters.
+    Each entry remembers where the layer was written and the modification metadata of the dataset
+    at that time, plus the last value of the timestamp field used for incremental refreshes.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(domain_url, dataset_id, params):
+        raw_key = json.dumps([domain_url, dataset_id, params], sort_keys=True)
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if entry and not os.path.exists(entry['file_path']):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            entries = self._load()
+            entries[key] = entry
+            self._save(entries)
+
+    def remove(self, key):
+        with self._lock:
+            entries = self._load()
+            if entries.pop(key, None):
+                self._save(entries)
+
+    def _load(self):
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        directory = os.path.dirname(self.file_path)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.file_path)
+
+
+def modification_signature(metadata):
+    """
+    What changes in the metadata of a dataset when its records change, or None if the
+    dataset does not publish any modification date.
+    """
+    default_metas = metadata['results'][0]['metas']['default']
+    signature = [default_metas.get('modified'), default_metas.get('data_processed')]
+    if not any(signature):
+        return None
+    return signature
+
+
+def default_dataset_store():
+    return DatasetStore(os.path.join(QgsApplication.qgisSettingsDirPath(), STORE_FILE_NAME))
@@ -0,0 +1,62 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+
+class NotModifiedError(Exception):
+    pass
+
+
+class ExportUnavailableError(Exception):
+    pass
+
+
+class DomainError(Exception):
+    pass
+
+
+class OdsqlError(Exception):
+    pass
+
+
+class NumberOfLinesError(Exception):
+    pass
+
+
+class DatasetError(Exception):
+    pass
+
+
+class AccessError(Exception):
+    pass
+
+
+class InternalError(Exception):
+    pass
+
+
+class RequestTimeoutError(Exception):
+    pass
+
+
+class RateLimitError(InternalError):
+    """The domain kept answering 429 Too Many Requests: the quota of the domain or API key is exhausted."""
+    pass
+
+
+class PartitionFieldError(Exception):
+    pass
+
+
+class GeometryFieldError(Exception):
+    pass
+
+
+class PointFieldError(Exception):
+    pass
@@ -0,0 +1,201 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import contextlib
+import json
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from qgis.core import Qgis, QgsMessageLog
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util import connection
+
+LOG_TAG = 'Opendatasoft performance'
+MAX_EVENTS = 2000
+
+_events = deque(maxlen=MAX_EVENTS)
+_events_lock = threading.Lock()
+# Timings of the connection opened by the request running in the current thread, if any
+_connection_timings = threading.local()
+
+
+def record(kind, name, **metrics):
+    """
+    Keep a performance event, e.g. record('http', url, ttfb=0.2, bytes=1024), and show it in the
+    Opendatasoft performance tab of the QGIS log panel. Durations are in seconds.
+    """
+    event = dict(metrics, time=datetime.now(timezone.utc).isoformat(), kind=kind, name=name)
+    with _events_lock:
+        _events.append(event)
+    QgsMessageLog.logMessage('{} {}: {}'.format(kind, name, ', '.join(
+        '{}={}'.format(metric, format_metric(value)) for metric, value in metrics.items())), LOG_TAG, Qgis.Info)
+    return event
+
+
+@contextlib.contextmanager
+def phase(name, **metrics):
+    """
+    Record how long the body of a with statement takes. Metrics known at the end only can be
+    added to the yielded dict. The phase is recorded with failed=True when the body raises.
+    """
+    metrics = dict(metrics)
+    start = time.monotonic()
+    try:
+        yield metrics
+    except BaseException:
+        metrics['failed'] = True
+        raise
+    finally:
+        record('phase', name, duration=time.monotonic() - start, **metrics)
+
+
+def events():
+    with _events_lock:
+        return list(_events)
+
+
+def clear():
+    with _events_lock:
+        _events.clear()
+
+
+def export_json(file_path):
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(events(), f, indent=2)
+
+
+def format_metric(value):
+    if isinstance(value, float):
+        return '{:.3f}'.format(value)
+    return value
+
+
+def start_request():
+    _connection_timings.value = {}
+
+
+def connection_timings():
+    """DNS, connect and TLS times of the connection opened by the current request, empty if it reused one."""
+    if not hasattr(_connection_timings, 'value'):
+        _connection_timings.value = {}
+    return _connection_timings.value
+
+
+def track_response(response, url, start):
+    """
+    Record the latencies of a response sent at start (a time.monotonic() value): time to first byte,
+    total time and bytes read. Streamed responses are recorded when closed, once their content was read.
+    """
+    timings = connection_timings()
+    metrics = {'status': response.status_code, 'reused_connection': not timings,
+               'ttfb': response.elapsed.total_seconds()}
+    metrics.update(timings)
+    if response._content_consumed:
+        record('http', url, total=time.monotonic() - start, bytes=len(response.content or b''), **metrics)
+        return response
+    counter = {'bytes': 0}
+    iter_content = response.iter_content
+    close = response.close
+
+    def counted_iter_content(*args, **kwargs):
+        for chunk in iter_content(*args, **kwargs):
+            counter['bytes'] += len(chunk)
+            yield chunk
+
+    def recorded_close():
+        if not counter.get('recorded'):
+            counter['recorded'] = True
+            record('http', url, total=time.monotonic() - start, bytes=counter['bytes'], **metrics)
+        close()
+
+    response.iter_content = counted_iter_content
+    response.close = recorded_close
+    return response
+
+
+# The plugin may be reloaded: wrap the function of urllib3, not the wrapper of a previous load
+_create_connection = getattr(connection.create_connection, 'wrapped', connection.create_connection)
+
+
+def timed_create_connection(address, *args, **kwargs):
+    """
+    urllib3's create_connection, timing the resolution of the host when called from a timed
+    connection: the resolved addresses are then tried in order, like urllib3 does.
+    """
+    if not getattr(_connection_timings, 'timed', False):
+        return _create_connection(address, *args, **kwargs)
+    host, port = address
+    start = time.monotonic()
+    try:
+        addresses = socket.getaddrinfo(host.strip('[]'), port, connection.allowed_gai_family(), socket.SOCK_STREAM)
+    finally:
+        connection_timings()['dns'] = time.monotonic() - start
+    error = OSError('getaddrinfo returns an empty list')
+    for *_, socket_address in addresses:
+        try:
+            return _create_connection(socket_address[:2], *args, **kwargs)
+        except OSError as e:
+            error = e
+    raise error
+
+
+# urllib3 connections look create_connection up in its module when connecting
+timed_create_connection.wrapped = _create_connection
+connection.create_connection = timed_create_connection
+
+
+class TimedConnectionMixin:
+    """Measure DNS resolution, TCP connection and TLS handshake of the new connections of a pool."""
+    def _new_conn(self):
+        timings = connection_timings()
+        timings.pop('dns', None)
+        _connection_timings.timed = True
+        start = time.monotonic()
+        try:
+            return super(TimedConnectionMixin, self)._new_conn()
+        finally:
+            _connection_timings.timed = False
+            timings['connect'] = time.monotonic() - start - timings.get('dns', 0)
+
+    def connect(self):
+        start = time.monotonic()
+        super(TimedConnectionMixin, self).connect()
+        timings = connection_timings()
+        if 'connect' in timings and isinstance(self, HTTPSConnection):
+            timings['tls'] = max(time.monotonic() - start - timings.get('dns', 0) - timings['connect'], 0)
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose new connections report their DNS, connect and TLS times to connection_timings()."""
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
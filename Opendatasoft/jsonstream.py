@@ -0,0 +1,141 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import codecs
+import itertools
+import json
+
+_DECODER = json.JSONDecoder()
+_SEPARATORS = ' \t\n\r,'
+
+
+def iter_json_array(chunks, key=None):
+    """
+    Incrementally yield the items of a JSON array read from an iterable of byte chunks.
+    If key is None the whole document is the array (catalog exports), otherwise the array is the
+    value of this top-level key (e.g. 'features' of a GeoJSON FeatureCollection).
+    Raises ValueError if the stream ends before the array is closed.
+    """
+    for item, _ in _iter_json_array(chunks, key):
+        yield item
+
+
+def array_prefix(chunks, key=None):
+    """
+    Number of complete items at the start of a JSON array, read like iter_json_array from a
+    possibly truncated document, and the number of bytes up to the end of the last one (None if there is none).
+    """
+    count, end = 0, None
+    try:
+        for _, end in _iter_json_array(chunks, key, count_bytes=True):
+            count += 1
+    except ValueError:
+        pass
+    return count, end
+
+
+def _iter_json_array(chunks, key, count_bytes=False):
+    """(item, bytes read up to its end) of iter_json_array, bytes being only counted if count_bytes is set."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    # Bytes of the text before buffer[counted_position]
+    counted_bytes = 0
+    counted_position = 0
+    # Size the buffer must reach before trying again to decode an item that was incomplete,
+    # so that a single huge item is not re-parsed for every incoming chunk.
+    retry_size = 0
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if count_bytes:
+            counted_bytes += len(buffer[counted_position:position].encode('utf-8'))
+            counted_position = 0
+        buffer = buffer[position:] + decoder.decode(b'' if final else chunk, final=final)
+        retry_size -= position
+        position = 0
+        if not started:
+            start = _find_array_start(buffer, key)
+            if start is None:
+                continue
+            position = start + 1
+            started = True
+        if len(buffer) < retry_size and not final:
+            continue
+        while True:
+            while position < len(buffer) and buffer[position] in _SEPARATORS:
+                position += 1
+            if position >= len(buffer):
+                break
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = _DECODER.raw_decode(buffer, position)
+            except ValueError:
+                retry_size = position + 2 * (len(buffer) - position)
+                break
+            if end == len(buffer) and not final and not isinstance(item, (dict, list)):
+                # A scalar at the very end of the buffer may continue in the next chunk
+                retry_size = len(buffer) + 1
+                break
+            retry_size = 0
+            if count_bytes:
+                counted_bytes += len(buffer[counted_position:end].encode('utf-8'))
+                counted_position = end
+            yield item, counted_bytes if count_bytes else None
+            position = end
+    raise ValueError('JSON stream ended before the end of the array')
+
+
+def _find_array_start(buffer, key):
+    if key is None:
+        start = buffer.find('[')
+        return start if start != -1 else None
+    key_position = buffer.find('"{}"'.format(key))
+    if key_position == -1:
+        return None
+    position = key_position + len(key) + 2
+    while position < len(buffer) and buffer[position] in ' \t\n\r:':
+        position += 1
+    if position >= len(buffer):
+        return None
+    if buffer[position] != '[':
+        raise ValueError('"{}" is not a JSON array'.format(key))
+    return position
+
+
+class FeatureCounter:
+    """Count the GeoJSON features going through a byte stream, even when split across chunks."""
+    FEATURE_PATTERN = b'"Feature"'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._tail = b''
+
+    def update(self, chunk):
+        data = self._tail + chunk
+        self.count += data.count(self.FEATURE_PATTERN)
+        self._tail = data[-(len(self.FEATURE_PATTERN) - 1):]
+
+
+def iter_json_lines(chunks):
+    """Incrementally yield the documents of a JSON lines stream read from an iterable of byte chunks."""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
@@ -0,0 +1,158 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import jsonstream, resumable, writers
+from .exceptions import DatasetError, PartitionFieldError
+
+MAX_PARALLEL_DOWNLOADS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 64
+
+
+def partition_params(ods_client, dataset_id, params, field, partitions_count):
+    """
+    Split an export query into disjoint queries covering the same records, by cutting the range of
+    values of an orderable (numeric or date) field into partitions_count intervals.
+    Records where the field is empty get a partition of their own.
+    """
+    bounds_params = {'select': 'min({0}) as min_value, max({0}) as max_value'.format(field)}
+    if 'where' in params:
+        bounds_params['where'] = params['where']
+    query = ods_client.get('catalog/datasets/{}/records'.format(dataset_id), bounds_params,
+                           not_found_error=DatasetError)
+    bounds = query.json()['results'][0]
+    min_value, max_value = bounds['min_value'], bounds['max_value']
+
+    partition_wheres = ['{} is null'.format(field)]
+    if min_value is not None:
+        for lower, upper, is_last in _split_range(min_value, max_value, partitions_count):
+            partition_wheres.append('{0} >= {1} and {0} {2} {3}'.format(field, lower, '<=' if is_last else '<', upper))
+
+    partitions = []
+    for partition_where in partition_wheres:
+        partition = dict(params)
+        partition['where'] = '({}) and ({})'.format(params['where'], partition_where) if 'where' in params \
+            else partition_where
+        partitions.append(partition)
+    return partitions
+
+
+def _split_range(min_value, max_value, partitions_count):
+    if isinstance(min_value, (int, float)) and isinstance(max_value, (int, float)):
+        lower_bound, upper_bound = min_value, max_value
+        to_literal = repr
+        first_literal, last_literal = repr(min_value), repr(max_value)
+    else:
+        try:
+            lower_bound = parse_date(min_value).timestamp()
+            upper_bound = parse_date(max_value).timestamp()
+        except (AttributeError, TypeError, ValueError):
+            raise PartitionFieldError
+
+        def to_literal(timestamp):
+            return "date'{}'".format(datetime.fromtimestamp(timestamp).astimezone().isoformat())
+        first_literal, last_literal = "date'{}'".format(min_value), "date'{}'".format(max_value)
+
+    if lower_bound == upper_bound:
+        partitions_count = 1
+    step = (upper_bound - lower_bound) / partitions_count
+    literals = [first_literal] + [to_literal(lower_bound + index * step) for index in range(1, partitions_count)] \
+        + [last_literal]
+    for index in range(partitions_count):
+        yield literals[index], literals[index + 1], index == partitions_count - 1
+
+
+def parse_date(value):
+    """Date of an ISO 8601 value of the API, whose UTC offset may be written Z, unknown to datetime.fromisoformat."""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.fromisoformat(value)
+
+
+class DownloadProgress:
+    """Thread-safe totals of the partitions being downloaded concurrently."""
+    def __init__(self):
+        self.downloaded = 0
+        self.downloaded_records = 0
+        self._lock = threading.Lock()
+
+    def add(self, downloaded, downloaded_records):
+        with self._lock:
+            self.downloaded += downloaded
+            self.downloaded_records += downloaded_records
+
+
+def download_partitions(ods_client, dataset_id, partitions, file_path, report_progress, is_canceled,
+                        output_format=writers.GEOJSON, max_workers=MAX_PARALLEL_DOWNLOADS, field_types=None,
+                        report_merge=None):
+    """
+    Download the GeoJSON export of every partition concurrently, then merge them into a single
+    layer written to file_path in output_format. report_progress(downloaded, downloaded_records) is
+    called from the calling thread while the partitions are downloaded. Each partition reconnects
+    through resumable.ResumableDownload when its connection drops. report_merge(merged_records,
+    downloaded_records), if given, is called while the partitions are merged.
+    """
+    progress = DownloadProgress()
+    partition_paths = ['{}.part{}'.format(file_path, index) for index in range(len(partitions))]
+
+    def download_partition(partition, partition_path):
+        feature_counter = jsonstream.FeatureCounter()
+        with ods_client.get('catalog/datasets/{}/exports/geojson'.format(dataset_id), partition, stream=True,
+                            not_found_error=DatasetError) as response:
+            download = resumable.ResumableDownload(response, partition_path, feature_counter, 'features')
+            downloaded, downloaded_records = 0, 0
+            # Totals go back when a partition starts over or is cut to its last complete feature
+            for _ in download.chunks(is_canceled):
+                progress.add(download.downloaded - downloaded, feature_counter.count - downloaded_records)
+                downloaded, downloaded_records = download.downloaded, feature_counter.count
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download_partition, partition, partition_path)
+                       for partition, partition_path in zip(partitions, partition_paths)]
+            while not all(future.done() for future in futures):
+                report_progress(progress.downloaded, progress.downloaded_records)
+                time.sleep(0.25)
+            for future in futures:
+                future.result()
+        if not is_canceled():
+            report_merged = (lambda merged: report_merge(merged, progress.downloaded_records)) if report_merge \
+                else None
+            merge_geojson_files(partition_paths, file_path, output_format, dataset_id, is_canceled, field_types,
+                                report_merged)
+    finally:
+        for partition_path in partition_paths:
+            for path in (partition_path, resumable.checkpoint_path(partition_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def merge_geojson_files(paths, file_path, output_format=writers.GEOJSON, layer_name=None, is_canceled=lambda: False,
+                        field_types=None, report_progress=None):
+    """
+    Concatenate the features of several GeoJSON FeatureCollection files, streaming them one by one.
+    report_progress(merged_records), if given, is called after every feature written.
+    """
+    def features():
+        merged = 0
+        for path in paths:
+            with open(path, 'rb') as f:
+                for feature in jsonstream.iter_json_array(iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''), 'features'):
+                    yield feature
+                    merged += 1
+                    if report_progress is not None:
+                        report_progress(merged)
+
+    writers.write_features(features(), file_path, output_format, layer_name, is_canceled, field_types)
@@ -0,0 +1,242 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+import os
+
+from qgis.core import (QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingOutputNumber,
+                       QgsProcessingOutputString, QgsProcessingParameterBoolean, QgsProcessingParameterEnum,
+                       QgsProcessingParameterFileDestination, QgsProcessingParameterFolderDestination,
+                       QgsProcessingParameterNumber, QgsProcessingParameterString, QgsProcessingProvider)
+from PyQt5.QtGui import QIcon
+
+from . import api, tasks, writers
+from .exceptions import (AccessError, DatasetError, DomainError, InternalError, NumberOfLinesError, OdsqlError,
+                         RateLimitError, RequestTimeoutError)
+
+ERROR_MESSAGES = {
+    DomainError: 'This domain does not exist.',
+    DatasetError: 'The dataset does not exist on this domain, or an API key is needed to access it.',
+    NumberOfLinesError: 'Limit has to be a positive int.',
+    AccessError: 'The apikey to access this domain or dataset is wrong.',
+    InternalError: 'InternalError from Opendatasoft: contact support@opendatasoft.com for more information.',
+    RateLimitError: 'The domain is receiving too many requests, or the quota of the API key is exhausted: retry later.',
+    RequestTimeoutError: 'The domain took too long to answer.',
+}
+EXPORT_FORMATS = list(writers.EXPORT_FORMATS)
+
+
+class OdsProcessingProvider(QgsProcessingProvider):
+    """Processing algorithms listing, describing and downloading the datasets of Opendatasoft domains."""
+    def id(self):
+        return 'opendatasoft'
+
+    def name(self):
+        return 'Opendatasoft'
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), 'icon.png'))
+
+    def loadAlgorithms(self):
+        for algorithm in (ListDatasetsAlgorithm(), DatasetSchemaAlgorithm(), ExportDatasetAlgorithm(),
+                          ExportDatasetsAlgorithm()):
+            self.addAlgorithm(algorithm)
+
+
+class OdsAlgorithm(QgsProcessingAlgorithm):
+    """Base of the algorithms of the provider, all taking a domain and an optional API key."""
+    DOMAIN = 'DOMAIN'
+    APIKEY = 'APIKEY'
+
+    def createInstance(self):
+        return type(self)()
+
+    def addDomainParameters(self):
+        self.addParameter(QgsProcessingParameterString(self.DOMAIN, 'Domain address',
+                                                       defaultValue='data.opendatasoft.com'))
+        self.addParameter(QgsProcessingParameterString(self.APIKEY, 'API key', optional=True))
+
+    def domainParameters(self, parameters, context):
+        return (self.parameterAsString(parameters, self.DOMAIN, context),
+                self.parameterAsString(parameters, self.APIKEY, context) or None)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        try:
+            return self.process(parameters, context, feedback)
+        except OdsqlError as error:
+            raise QgsProcessingException(str(error))
+        except tuple(ERROR_MESSAGES) as error:
+            raise QgsProcessingException(ERROR_MESSAGES[type(error)])
+        except tasks.DOWNLOAD_ERRORS as error:
+            raise QgsProcessingException(str(error) or type(error).__name__)
+
+
+class ListDatasetsAlgorithm(OdsAlgorithm):
+    TEXT_SEARCH = 'TEXT_SEARCH'
+    INCLUDE_NON_GEO = 'INCLUDE_NON_GEO'
+    DATASETS = 'DATASETS'
+    COUNT = 'COUNT'
+
+    def name(self):
+        return 'listdatasets'
+
+    def displayName(self):
+        return 'List datasets'
+
+    def shortHelpString(self):
+        return 'Lists the identifiers of the datasets of a domain, one per line.'
+
+    def initAlgorithm(self, config=None):
+        self.addDomainParameters()
+        self.addParameter(QgsProcessingParameterString(self.TEXT_SEARCH, 'Text search', optional=True))
+        self.addParameter(QgsProcessingParameterBoolean(self.INCLUDE_NON_GEO, 'Include non-geo datasets',
+                                                        defaultValue=False))
+        self.addOutput(QgsProcessingOutputString(self.DATASETS, 'Dataset identifiers'))
+        self.addOutput(QgsProcessingOutputNumber(self.COUNT, 'Number of datasets'))
+
+    def process(self, parameters, context, feedback):
+        domain, apikey = self.domainParameters(parameters, context)
+        dataset_ids = api.list_datasets(domain, apikey,
+                                        self.parameterAsBool(parameters, self.INCLUDE_NON_GEO, context),
+                                        self.parameterAsString(parameters, self.TEXT_SEARCH, context) or None)
+        return {self.DATASETS: '\n'.join(dataset_ids), self.COUNT: len(dataset_ids)}
+
+
+class DatasetSchemaAlgorithm(OdsAlgorithm):
+    DATASET_ID = 'DATASET_ID'
+    FIELDS = 'FIELDS'
+    GEOMETRY_FIELD = 'GEOMETRY_FIELD'
+    RECORDS_COUNT = 'RECORDS_COUNT'
+
+    def name(self):
+        return 'datasetschema'
+
+    def displayName(self):
+        return 'Describe dataset'
+
+    def shortHelpString(self):
+        return 'Returns the fields of a dataset as JSON, its geometry field and its number of records.'
+
+    def initAlgorithm(self, config=None):
+        self.addDomainParameters()
+        self.addParameter(QgsProcessingParameterString(self.DATASET_ID, 'Dataset identifier'))
+        self.addOutput(QgsProcessingOutputString(self.FIELDS, 'Fields'))
+        self.addOutput(QgsProcessingOutputString(self.GEOMETRY_FIELD, 'Geometry field'))
+        self.addOutput(QgsProcessingOutputNumber(self.RECORDS_COUNT, 'Number of records'))
+
+    def process(self, parameters, context, feedback):
+        domain, apikey = self.domainParameters(parameters, context)
+        dataset_schema = api.get_schema(domain, self.parameterAsString(parameters, self.DATASET_ID, context), apikey)
+        return {self.FIELDS: json.dumps(dataset_schema.fields), self.GEOMETRY_FIELD: dataset_schema.geom_column,
+                self.RECORDS_COUNT: dataset_schema.metas['default']['records_count']}
+
+
+class ExportDatasetAlgorithm(OdsAlgorithm):
+    DATASET_ID = 'DATASET_ID'
+    SELECT = 'SELECT'
+    WHERE = 'WHERE'
+    ORDER_BY = 'ORDER_BY'
+    LIMIT = 'LIMIT'
+    FIELDS = 'FIELDS'
+    EXPORT_FORMAT = 'EXPORT_FORMAT'
+    OUTPUT = 'OUTPUT'
+
+    def name(self):
+        return 'exportdataset'
+
+    def displayName(self):
+        return 'Download dataset'
+
+    def shortHelpString(self):
+        return 'Downloads a dataset, optionally filtered with ODSQL clauses, to a GeoJSON or GeoPackage file.'
+
+    def initAlgorithm(self, config=None):
+        self.addDomainParameters()
+        self.addParameter(QgsProcessingParameterString(self.DATASET_ID, 'Dataset identifier'))
+        self.addParameter(QgsProcessingParameterString(self.SELECT, 'Select', optional=True))
+        self.addParameter(QgsProcessingParameterString(self.WHERE, 'Where', optional=True))
+        self.addParameter(QgsProcessingParameterString(self.ORDER_BY, 'Order by', optional=True))
+        self.addParameter(QgsProcessingParameterNumber(self.LIMIT, 'Limit (-1 for all records)', defaultValue=-1,
+                                                       minValue=-1))
+        self.addParameter(QgsProcessingParameterString(
+            self.FIELDS, 'Fields to keep, separated by commas (replaces Select, the geometry field is always kept)',
+            optional=True))
+        self.addParameter(QgsProcessingParameterEnum(self.EXPORT_FORMAT, 'Download format',
+                                                     [writers.EXPORT_FORMATS[name] for name in EXPORT_FORMATS],
+                                                     defaultValue=0))
+        self.addParameter(QgsProcessingParameterFileDestination(
+            self.OUTPUT, 'Output file', ';;'.join(writers.FILE_FILTERS[name] for name in writers.OUTPUT_FORMATS)))
+
+    def process(self, parameters, context, feedback):
+        domain, apikey = self.domainParameters(parameters, context)
+        file_path = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+
+        def report_progress(text, percentage):
+            if percentage is not None:
+                feedback.setProgress(percentage)
+
+        api.export_dataset(
+            domain, self.parameterAsString(parameters, self.DATASET_ID, context), file_path, apikey,
+            self.parameterAsString(parameters, self.SELECT, context) or None,
+            self.parameterAsString(parameters, self.WHERE, context) or None,
+            self.parameterAsString(parameters, self.ORDER_BY, context) or None,
+            self.parameterAsInt(parameters, self.LIMIT, context),
+            export_format=EXPORT_FORMATS[self.parameterAsEnum(parameters, self.EXPORT_FORMAT, context)],
+            report_progress=report_progress, is_canceled=feedback.isCanceled,
+            fields=[field.strip() for field in self.parameterAsString(parameters, self.FIELDS, context).split(',')
+                    if field.strip()])
+        return {self.OUTPUT: file_path}
+
+
+class ExportDatasetsAlgorithm(OdsAlgorithm):
+    DATASET_IDS = 'DATASET_IDS'
+    OUTPUT_FORMAT = 'OUTPUT_FORMAT'
+    PARALLEL_DOWNLOADS = 'PARALLEL_DOWNLOADS'
+    OUTPUT = 'OUTPUT'
+    FAILED = 'FAILED'
+
+    def name(self):
+        return 'exportdatasets'
+
+    def displayName(self):
+        return 'Download several datasets'
+
+    def shortHelpString(self):
+        return 'Downloads several datasets concurrently to a folder, one <dataset identifier> file per dataset. ' \
+               'The identifiers of the datasets which could not be downloaded are returned in FAILED.'
+
+    def initAlgorithm(self, config=None):
+        self.addDomainParameters()
+        self.addParameter(QgsProcessingParameterString(self.DATASET_IDS, 'Dataset identifiers, one per line',
+                                                       multiLine=True))
+        self.addParameter(QgsProcessingParameterEnum(self.OUTPUT_FORMAT, 'Save as',
+                                                     list(writers.OUTPUT_FORMATS.values()), defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber(self.PARALLEL_DOWNLOADS, 'Parallel downloads',
+                                                       defaultValue=tasks.MAX_PARALLEL_IMPORTS, minValue=1,
+                                                       maxValue=16))
+        self.addParameter(QgsProcessingParameterFolderDestination(self.OUTPUT, 'Output folder'))
+        self.addOutput(QgsProcessingOutputString(self.FAILED, 'Datasets which failed'))
+
+    def process(self, parameters, context, feedback):
+        domain, apikey = self.domainParameters(parameters, context)
+        dataset_ids = [dataset_id.strip() for dataset_id in
+                       self.parameterAsString(parameters, self.DATASET_IDS, context).replace(',', '\n').splitlines()
+                       if dataset_id.strip()]
+        directory = self.parameterAsString(parameters, self.OUTPUT, context)
+        os.makedirs(directory, exist_ok=True)
+        output_format = list(writers.OUTPUT_FORMATS)[self.parameterAsEnum(parameters, self.OUTPUT_FORMAT, context)]
+        exported, errors = api.export_datasets(
+            domain, dataset_ids, directory, apikey, output_format,
+            max_workers=self.parameterAsInt(parameters, self.PARALLEL_DOWNLOADS, context),
+            is_canceled=feedback.isCanceled)
+        for dataset_id, error in errors.items():
+            feedback.reportError('{}: {}'.format(dataset_id, ERROR_MESSAGES.get(type(error)) or str(error)
+                                                 or type(error).__name__))
+        return {self.OUTPUT: directory, self.FAILED: '\n'.join(errors)}
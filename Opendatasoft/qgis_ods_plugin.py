@@ -11,18 +11,26 @@
 import os
 
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import QSettings
 from PyQt5.QtGui import *
+from qgis.core import QgsApplication
 
-from . import ui_methods, utils
+from . import client, instrumentation, processing_provider, ui_methods, utils
 
 
 class QgisOdsPlugin:
     def __init__(self, iface):
         self.iface = iface
+        self.provider = None
+
+    # noinspection PyPep8Naming
+    def initProcessing(self):
+        """Register the Processing algorithms, also called by qgis_process without any GUI."""
+        self.provider = processing_provider.OdsProcessingProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
 
     # noinspection PyPep8Naming
     def initGui(self):
+        self.initProcessing()
         self.action = QtWidgets.QAction(
             QIcon(os.path.join(os.path.dirname(__file__), "icon.png")),
             "ODS plugin",
@@ -30,22 +38,83 @@ class QgisOdsPlugin:
         self.action.triggered.connect(self.run)
         self.iface.addToolBarIcon(self.action)
         self.iface.addPluginToWebMenu('Opendatasoft', self.action)
+        self.refineClustersAction = QtWidgets.QAction("Refine ODS clusters in map view", self.iface.mainWindow())
+        self.refineClustersAction.triggered.connect(self.refineClusters)
+        self.iface.addPluginToWebMenu('Opendatasoft', self.refineClustersAction)
+        self.exportPerformanceLogAction = QtWidgets.QAction("Export ODS performance log...", self.iface.mainWindow())
+        self.exportPerformanceLogAction.triggered.connect(self.exportPerformanceLog)
+        self.iface.addPluginToWebMenu('Opendatasoft', self.exportPerformanceLogAction)
 
     def unload(self):
         self.iface.removeToolBarIcon(self.action)
+        self.iface.removePluginWebMenu('Opendatasoft', self.action)
+        self.iface.removePluginWebMenu('Opendatasoft', self.refineClustersAction)
+        self.iface.removePluginWebMenu('Opendatasoft', self.exportPerformanceLogAction)
         del self.action
+        del self.refineClustersAction
+        del self.exportPerformanceLogAction
+        QgsApplication.processingRegistry().removeProvider(self.provider)
+        client.close_clients()
 
     def run(self):
         """
-        Init the main dialog window and init the ods_cache, used for storing credentials.
+        Init the main dialog window and restore the inputs of the last import, including credentials.
         """
-        dialog = ui_methods.ODSDialog(self.iface)
-        settings = QSettings()
-        if 'ods_cache' in settings.allKeys():
-            try:
-                apikey = utils.get_apikey_from_cache()
-                dialog.push_ods_cache(settings.value('ods_cache'), apikey)
-            except KeyError:
-                pass
+        dialog = self.openDialog()
         if dialog.exec():
             pass
+
+    def openDialog(self):
+        """
+        Create the main dialog with the inputs of the last import. Nothing is fetched before it shows up:
+        the dataset list and the schema of the last dataset are loaded by background tasks.
+        """
+        with instrumentation.phase('dialog open'):
+            dialog = ui_methods.ODSDialog(self.iface)
+            ods_cache = utils.session_state()
+            if ods_cache is not None:
+                try:
+                    # The authentication database is only opened when an API key was stored
+                    apikey = utils.get_apikey_from_cache() if ods_cache.get('store_apikey_in_cache') else None
+                    dialog.push_ods_cache(ods_cache, apikey)
+                except KeyError:
+                    pass
+        return dialog
+
+    def refineClusters(self):
+        """
+        Import the clusters of the selected summary layer again at a finer precision, for the map view only.
+        """
+        layer = self.iface.activeLayer()
+        try:
+            if layer is None or utils.refine_clustered_layer_to_qgis(self.iface, layer) is None:
+                QtWidgets.QMessageBox.information(None, "ERROR:", "Select a layer of clusters imported from "
+                                                                  "Opendatasoft first.")
+        except (utils.DomainError, utils.DatasetError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The dataset of this layer is no longer available.")
+        except utils.AccessError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The apikey to access this dataset is wrong.")
+        except utils.OdsqlError as error:
+            QtWidgets.QMessageBox.information(None, "ERROR:", str(error))
+        except utils.RateLimitError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain is receiving too many requests, or the quota of "
+                                                              "your API key is exhausted: retry later.")
+        except utils.InternalError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "InternalError from Opendatasoft while importing the dataset: "
+                                                              "contact support@opendatasoft.com for more information.")
+        except utils.RequestTimeoutError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain took too long to answer.")
+
+    def exportPerformanceLog(self):
+        """
+        Save the timings of the HTTP calls and import phases shown in the Opendatasoft performance
+        tab of the log panel as JSON.
+        """
+        file_path = QtWidgets.QFileDialog.getSaveFileName(self.iface.mainWindow(), "Export performance log", "",
+                                                          "JSON Files (*.json)")[0]
+        if not file_path:
+            return
+        try:
+            instrumentation.export_json(file_path)
+        except OSError as error:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "Could not write the performance log: {}".format(error))
@@ -0,0 +1,251 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+import os
+import time
+
+import requests
+
+from . import instrumentation, jsonstream
+from .exceptions import DomainError, RequestTimeoutError
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 64
+CHECKPOINT_INTERVAL = 8 * 1024 * 1024
+MAX_RETRIES = 5
+RETRY_DELAY = 2
+# DomainError and RequestTimeoutError are raised by the client when reconnecting fails
+RETRYABLE_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout, DomainError, RequestTimeoutError)
+
+
+class Retries:
+    """Count the reconnections in a row to an export, waiting longer before each one."""
+    def __init__(self, url):
+        self.url = url
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def wait(self, downloaded):
+        """Wait before reconnecting, raising the error being handled once MAX_RETRIES reconnections failed."""
+        self.count += 1
+        instrumentation.record('retry', self.url, attempt=self.count, downloaded=downloaded)
+        if self.count > MAX_RETRIES:
+            raise
+        time.sleep(RETRY_DELAY * 2 ** (self.count - 1))
+
+
+class ResumableDownload:
+    """
+    Write a streamed export to a file, reconnecting when the connection drops.
+    When the server honors Range requests for an export identified by an ETag or a Last-Modified
+    date, the download continues from the last byte written. Otherwise, if records_key names the
+    array of records of the export ('features' of GeoJSON exports), the file is cut after its last
+    complete record and the export is requested again without the records already written, in the
+    order of the query. Other downloads start over.
+    Progress is checkpointed next to the partial file, so that a later download of the same
+    export to the same file resumes where a failed one stopped.
+    response is a streamed response of OdsClient.get, reopened through the same client.
+    """
+    def __init__(self, response, file_path, feature_counter=None, records_key=None):
+        self.response = response
+        self.file_path = file_path
+        self.feature_counter = feature_counter
+        self.records_key = records_key
+        self.checkpoint_path = checkpoint_path(file_path)
+        self.request = response.request
+        self.validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        self.downloaded = 0
+        # Set when the records of the next response continue the array of records of the file
+        self.continues_records = False
+
+    def chunks(self, is_canceled):
+        """
+        Yield the chunks written to the file, the file being truncated when the download has to
+        start over. Raises the last connection error once MAX_RETRIES reconnections in a row failed,
+        the count of failures starting over whenever bytes are received.
+        """
+        response = self._resume_from_checkpoint()
+        retries = Retries(self.request.url)
+        while True:
+            try:
+                if response is None:
+                    response = self._reopen()
+                chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+                if self.continues_records:
+                    chunks = continued_array(chunks, self.records_key)
+                with open(self.file_path, 'ab' if self.downloaded else 'wb') as f:
+                    next_checkpoint = self.downloaded + CHECKPOINT_INTERVAL
+                    for chunk in chunks:
+                        f.write(chunk)
+                        self.downloaded += len(chunk)
+                        retries.reset()
+                        if self.feature_counter is not None:
+                            self.feature_counter.update(chunk)
+                        yield chunk
+                        if is_canceled():
+                            return
+                        if self.downloaded >= next_checkpoint:
+                            f.flush()
+                            self._save_checkpoint()
+                            next_checkpoint = self.downloaded + CHECKPOINT_INTERVAL
+                self.remove_checkpoint()
+                return
+            except RETRYABLE_ERRORS:
+                if response is not None:
+                    response.close()
+                response = None
+                self._save_checkpoint()
+                retries.wait(self.downloaded)
+
+    def remove_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def _resume_from_checkpoint(self):
+        """Response to read from: the initial one, or None when a checkpoint allows to resume."""
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return self.response
+        if checkpoint['url'] != self.request.url or not (self.validator or self.records_key) \
+                or checkpoint['validator'] != self.validator \
+                or not os.path.exists(self.file_path) or os.path.getsize(self.file_path) < checkpoint['downloaded']:
+            return self.response
+        self.downloaded = checkpoint['downloaded']
+        if self.feature_counter is not None:
+            self.feature_counter.count = checkpoint['records']
+        with open(self.file_path, 'ab') as f:
+            f.truncate(self.downloaded)
+        self.response.close()
+        return None
+
+    def _reopen(self):
+        """Request the export again, from the last byte or record written when possible."""
+        self.continues_records = False
+        response = None
+        if self.downloaded and self.validator:
+            response = self.response.reopen({'Range': 'bytes={}-'.format(self.downloaded),
+                                             'If-Range': self.validator})
+            if response.status_code == 206:
+                return response
+        elif self.downloaded and self.records_key:
+            with open(self.file_path, 'rb') as f:
+                records, end = jsonstream.array_prefix(iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''),
+                                                       self.records_key)
+            if records:
+                with open(self.file_path, 'ab') as f:
+                    f.truncate(end)
+                self.downloaded = end
+                if self.feature_counter is not None:
+                    self.feature_counter.reset()
+                    self.feature_counter.count = records
+                self.continues_records = True
+                return self.response.reopen(params=resumed_params(self.response.query_params, records))
+        self.downloaded = 0
+        if self.feature_counter is not None:
+            self.feature_counter.reset()
+        # A Range request answered with the whole export starts it over
+        return response if response is not None else self.response.reopen()
+
+    def _save_checkpoint(self):
+        with open(self.checkpoint_path, 'w', encoding='utf-8') as f:
+            json.dump({'url': self.request.url, 'validator': self.validator, 'downloaded': self.downloaded,
+                       'records': self.feature_counter.count if self.feature_counter is not None else 0}, f)
+
+
+def iter_records(response, parse):
+    """
+    Records parsed by parse(chunks), e.g. jsonstream.iter_json_lines, from a streamed export
+    response of OdsClient.get, reconnecting when the connection drops: from the last byte read when
+    the server honors Range requests for an export identified by an ETag or a Last-Modified date,
+    otherwise by requesting the export again without the records already read, in the order of the
+    query. Raises the last connection error once MAX_RETRIES reconnections in a row failed.
+    """
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    retries = Retries(response.request.url)
+    state = {'response': response, 'downloaded': 0}
+
+    def chunks():
+        while True:
+            try:
+                for chunk in state['response'].iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    state['downloaded'] += len(chunk)
+                    retries.reset()
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS:
+                state['response'].close()
+                if not validator:
+                    raise
+                retries.wait(state['downloaded'])
+            reopened = response.reopen({'Range': 'bytes={}-'.format(state['downloaded']), 'If-Range': validator})
+            if reopened.status_code != 206:
+                # The export changed: its records cannot be read from the middle of the new one
+                reopened.close()
+                raise requests.exceptions.ConnectionError('The export changed while it was downloaded')
+            state['response'] = reopened
+
+    records = 0
+    while True:
+        try:
+            for record in parse(chunks()):
+                records += 1
+                yield record
+            return
+        except RETRYABLE_ERRORS:
+            state['response'].close()
+            retries.wait(state['downloaded'])
+        state['response'] = response.reopen(params=resumed_params(response.query_params, records))
+        state['downloaded'] = 0
+
+
+def continued_array(chunks, key):
+    """
+    Chunks of a JSON document from the first item of its key array, preceded by a comma if there
+    is one, so that they continue an array whose previous items were already written.
+    """
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        key_position = buffer.find('"{}"'.format(key).encode('utf-8'))
+        start = buffer.find(b'[', key_position) if key_position != -1 else -1
+        if start == -1:
+            continue
+        first_item = start + 1
+        while first_item < len(buffer) and buffer[first_item:first_item + 1] in b' \t\n\r':
+            first_item += 1
+        if first_item == len(buffer):
+            continue
+        yield buffer[first_item:] if buffer[first_item:first_item + 1] == b']' else b',' + buffer[first_item:]
+        break
+    else:
+        raise ValueError('JSON stream ended before the start of the array')
+    yield from chunks
+
+
+def resumed_params(params, records_read):
+    """Query of the records of an export following its first records_read ones."""
+    resumed = dict(params, offset=int(params.get('offset', 0)) + records_read)
+    limit = int(params.get('limit', -1))
+    if limit != -1:
+        resumed['limit'] = max(limit - records_read, 0)
+    return resumed
+
+
+def checkpoint_path(file_path):
+    return '{}.part.json'.format(file_path)
+
+
+def has_checkpoint(file_path):
+    return os.path.exists(checkpoint_path(file_path))
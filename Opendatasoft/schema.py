@@ -0,0 +1,108 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from qgis.core import QgsTask
+
+from . import instrumentation, utils
+from .exceptions import AccessError, DatasetError, DomainError, InternalError, OdsqlError, RequestTimeoutError
+
+SCHEMA_CACHE_SIZE = 64
+
+
+class DatasetSchema:
+    """Everything the plugin needs to know about a dataset before importing it."""
+    def __init__(self, metadata, first_record):
+        self.metadata = metadata
+        self.first_record = first_record
+        self.fields = metadata['results'][0]['fields']
+        self.metas = metadata['results'][0]['metas']
+        self.geom_column = utils.get_geom_column(metadata)
+        self.geom_type = next((field['type'] for field in self.fields if field['name'] == self.geom_column), None)
+
+    def sample_value(self, field_name):
+        if not self.first_record['results']:
+            return None
+        return self.first_record['results'][0].get(field_name)
+
+
+class SchemaCache:
+    """
+    LRU cache of dataset schemas. On a miss, the metadata of the dataset is read from the local
+    catalog index if the dataset is indexed, and the first record is fetched; both are fetched
+    concurrently otherwise. Indexed datasets still get a schema offline, without sample values.
+    """
+    def __init__(self, max_size=SCHEMA_CACHE_SIZE):
+        self.max_size = max_size
+        self._schemas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, domain_url, dataset_id, apikey):
+        key = (domain_url, dataset_id, apikey)
+        with self._lock:
+            if key in self._schemas:
+                self._schemas.move_to_end(key)
+                return self._schemas[key]
+        indexed_metadata = utils.indexed_dataset_metadata(domain_url, dataset_id, apikey)
+        if indexed_metadata is not None:
+            with instrumentation.phase('schema', dataset_id=dataset_id, source='index'):
+                try:
+                    first_record = utils.import_first_record(domain_url, dataset_id, apikey)
+                except (DomainError, RequestTimeoutError, requests.exceptions.RequestException):
+                    # Offline: the schema is not cached, so that sample values show up once back online
+                    return DatasetSchema(indexed_metadata, {'total_count': 0, 'results': []})
+                dataset_schema = DatasetSchema(indexed_metadata, first_record)
+        else:
+            with instrumentation.phase('schema', dataset_id=dataset_id), \
+                    ThreadPoolExecutor(max_workers=2) as executor:
+                metadata_future = executor.submit(utils.import_dataset_metadata, domain_url, dataset_id, apikey)
+                first_record_future = executor.submit(utils.import_first_record, domain_url, dataset_id, apikey)
+                dataset_schema = DatasetSchema(metadata_future.result(), first_record_future.result())
+        with self._lock:
+            self._schemas[key] = dataset_schema
+            while len(self._schemas) > self.max_size:
+                self._schemas.popitem(last=False)
+        return dataset_schema
+
+    def clear(self):
+        with self._lock:
+            self._schemas.clear()
+
+
+_session_schema_cache = SchemaCache()
+
+
+class SchemaTask(QgsTask):
+    """Fetch the schema of a dataset into the session cache in a background thread, storing it or the error raised."""
+    def __init__(self, domain_url, dataset_id, apikey):
+        super(SchemaTask, self).__init__('Describe {} from Opendatasoft'.format(dataset_id), QgsTask.CanCancel)
+        self.domain_url = domain_url
+        self.dataset_id = dataset_id
+        self.apikey = apikey
+        self.dataset_schema = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.dataset_schema = get_dataset_schema(self.domain_url, self.dataset_id, self.apikey)
+        except (OSError, ValueError, KeyError, IndexError, requests.exceptions.RequestException, AccessError,
+                DatasetError, DomainError, InternalError, OdsqlError, RequestTimeoutError) as error:
+            self.error = error
+            return False
+        return True
+
+
+def get_dataset_schema(domain_url, dataset_id, apikey):
+    """Schema of a dataset, cached for the whole QGIS session."""
+    return _session_schema_cache.get(domain_url, dataset_id, apikey)
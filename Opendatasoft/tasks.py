@@ -0,0 +1,564 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import functools
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from PyQt5.QtCore import pyqtSignal
+from qgis.core import QgsApplication, QgsMessageLog, QgsProject, QgsTask, QgsVectorLayer
+
+from . import clusters, instrumentation, jsonstream, partitions, resumable, writers
+from .exceptions import AccessError, DatasetError, DomainError, InternalError, OdsqlError, RequestTimeoutError
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 64
+PROGRESS_INTERVAL = 0.25
+REFRESH_INTERVAL = 1
+MAX_PARALLEL_IMPORTS = 4
+DOWNLOAD_ERRORS = (OSError, ValueError, requests.exceptions.RequestException, AccessError, DatasetError, DomainError,
+                   InternalError, OdsqlError, RequestTimeoutError)
+
+# QgsTaskManager owns the C++ side of the tasks, the Python side must be kept alive until they finish
+_active_tasks = set()
+
+
+class ImportDatasetTask(QgsTask):
+    """
+    Download a dataset export to a file in a background thread, then add it to the current
+    project as a vector layer. Progress is reported at most every PROGRESS_INTERVAL seconds.
+    field_types ({field name: Opendatasoft field type}) gives its type to each field of converted exports.
+    """
+    progressTextChanged = pyqtSignal(str)
+    # Message for the user when the task fails, shown by the UI following the task if any
+    errorOccurred = pyqtSignal(str)
+
+    def __init__(self, dataset_id, imported_dataset, file_path, records_count=None, output_format=writers.GEOJSON,
+                 export_format=writers.GEOJSON, geom_column=None, field_types=None):
+        super(ImportDatasetTask, self).__init__('Import {} from Opendatasoft'.format(dataset_id), QgsTask.CanCancel)
+        self.dataset_id = dataset_id
+        self.imported_dataset = imported_dataset
+        self.file_path = file_path
+        self.records_count = records_count
+        self.output_format = output_format
+        self.export_format = export_format
+        self.geom_column = geom_column
+        self.field_types = field_types
+        # Custom properties set on the layer once added to the project
+        self.layer_properties = {}
+        self.error = None
+
+    def run(self):
+        progress_reporter = ProgressReporter(self.records_count, self.reportProgress)
+        try:
+            with instrumentation.phase('download', dataset_id=self.dataset_id, export_format=self.export_format,
+                                       output_format=self.output_format) as metrics:
+                try:
+                    self.download(progress_reporter)
+                finally:
+                    metrics.update(progress_reporter.metrics())
+        except DOWNLOAD_ERRORS as error:
+            self.error = error
+            return False
+        return not self.isCanceled()
+
+    def download(self, progress_reporter):
+        download_to_file(self.imported_dataset, self.file_path, progress_reporter, self.isCanceled,
+                         self.output_format, self.dataset_id, self.export_format, self.geom_column,
+                         field_types=self.field_types)
+
+    def downloadPath(self):
+        """File the export stream is written to, binary exports being converted afterwards."""
+        if self.export_format in writers.BINARY_EXPORT_DRIVERS:
+            return '{}.{}'.format(self.file_path, self.export_format)
+        return self.file_path
+
+    def reportProgress(self, text, percentage):
+        self.progressTextChanged.emit(text)
+        if percentage is not None:
+            self.setProgress(percentage)
+
+    def finished(self, result):
+        _active_tasks.discard(self)
+        if self.imported_dataset is not None:
+            self.imported_dataset.close()
+        if result:
+            with instrumentation.phase('layer load', dataset_id=self.dataset_id):
+                vector_layer = QgsVectorLayer(writers.layer_uri(self.file_path, self.output_format, self.dataset_id),
+                                              self.dataset_id, "ogr")
+                for name, value in self.layer_properties.items():
+                    vector_layer.setCustomProperty(name, value)
+                QgsProject.instance().addMapLayer(vector_layer)
+            return
+        resumable_download = self.error is not None and resumable.has_checkpoint(self.downloadPath())
+        if not resumable_download:
+            remove_partial_file(self.downloadPath())
+            remove_partial_file(self.file_path)
+        if self.error:
+            QgsMessageLog.logMessage('Import of {} failed: {}'.format(self.dataset_id, self.error), 'Opendatasoft')
+            message = "The import of {} was interrupted: {}".format(
+                self.dataset_id, str(self.error) or type(self.error).__name__)
+            if resumable_download:
+                message += "\nImport it again to the same file to resume the download."
+            self.errorOccurred.emit(message)
+
+
+class ProgressiveImportDatasetTask(ImportDatasetTask):
+    """
+    Same as ImportDatasetTask for a GeoJSON or JSONL export converted to GeoPackage, the layer being
+    added to the project after the first committed batch and reloaded at most every REFRESH_INTERVAL
+    seconds while the next batches are written. The layer is removed if the import fails or is canceled.
+    """
+    batchCommitted = pyqtSignal(int)
+
+    def __init__(self, dataset_id, imported_dataset, file_path, records_count=None, export_format=writers.GEOJSON,
+                 geom_column=None, field_types=None):
+        super(ProgressiveImportDatasetTask, self).__init__(dataset_id, imported_dataset, file_path, records_count,
+                                                           writers.GEOPACKAGE, export_format, geom_column,
+                                                           field_types)
+        self.layer_id = None
+        self.last_refresh = None
+        # The task lives in the main thread: batches committed by run() are shown from there
+        self.batchCommitted.connect(self.showBatch)
+
+    def download(self, progress_reporter):
+        download_to_file(self.imported_dataset, self.file_path, progress_reporter, self.isCanceled,
+                         self.output_format, self.dataset_id, self.export_format, self.geom_column,
+                         writers.PROGRESSIVE_BATCH_SIZE, self.batchWritten, self.field_types)
+
+    def batchWritten(self, count):
+        now = time.monotonic()
+        if self.last_refresh is not None and now - self.last_refresh < REFRESH_INTERVAL:
+            return
+        self.last_refresh = now
+        self.batchCommitted.emit(count)
+
+    def showBatch(self, count):
+        if self.isCanceled():
+            return
+        layer = self.layer()
+        if layer is None and self.layer_id is None:
+            layer = QgsVectorLayer(writers.layer_uri(self.file_path, self.output_format, self.dataset_id),
+                                   self.dataset_id, "ogr")
+            QgsProject.instance().addMapLayer(layer)
+            self.layer_id = layer.id()
+        elif layer is not None:
+            layer.reload()
+            layer.updateFields()
+            layer.updateExtents()
+            layer.triggerRepaint()
+        instrumentation.record('render', self.dataset_id, records=count)
+
+    def layer(self):
+        """Layer added while downloading, None if it was not added yet or was removed from the project."""
+        return QgsProject.instance().mapLayer(self.layer_id) if self.layer_id else None
+
+    def finished(self, result):
+        layer = self.layer()
+        if layer is None:
+            super(ProgressiveImportDatasetTask, self).finished(result)
+            return
+        if not result:
+            # Release the file before the partial download is removed
+            QgsProject.instance().removeMapLayer(self.layer_id)
+            super(ProgressiveImportDatasetTask, self).finished(result)
+            return
+        _active_tasks.discard(self)
+        self.imported_dataset.close()
+        with instrumentation.phase('layer load', dataset_id=self.dataset_id):
+            layer.reload()
+            layer.updateFields()
+            layer.updateExtents()
+            for name, value in self.layer_properties.items():
+                layer.setCustomProperty(name, value)
+            layer.triggerRepaint()
+
+
+class PartitionedImportDatasetTask(ImportDatasetTask):
+    """
+    Import task downloading disjoint partitions of the export concurrently, merged into a single layer.
+    """
+    def __init__(self, dataset_id, ods_client, partition_params, file_path, records_count=None,
+                 output_format=writers.GEOJSON, field_types=None):
+        super(PartitionedImportDatasetTask, self).__init__(dataset_id, None, file_path, records_count, output_format,
+                                                           field_types=field_types)
+        self.ods_client = ods_client
+        self.partition_params = partition_params
+
+    def download(self, progress_reporter):
+        partitions.download_partitions(self.ods_client, self.dataset_id, self.partition_params, self.file_path,
+                                       progress_reporter.report, self.isCanceled, self.output_format,
+                                       field_types=self.field_types, report_merge=functools.partial(
+                                           progress_reporter.report_step, 'Merging partitions'))
+
+
+class RefreshDatasetTask(ImportDatasetTask):
+    """
+    Download the records modified since a previous import and upsert them into its GeoPackage layer,
+    which is then reloaded (or added back) in the current project.
+    """
+    def __init__(self, dataset_id, imported_dataset, file_path, records_count=None, key_field=None):
+        super(RefreshDatasetTask, self).__init__(dataset_id, imported_dataset, file_path, records_count,
+                                                 writers.GEOPACKAGE)
+        self.key_field = key_field
+
+    def download(self, progress_reporter):
+        features = resumable.iter_records(self.imported_dataset, lambda chunks: jsonstream.iter_json_array(
+            progress_reporter.track(chunks), 'features'))
+
+        def reported_features():
+            for count, feature in enumerate(features, 1):
+                yield feature
+                progress_reporter.report(progress_reporter.downloaded, count)
+
+        writers.upsert_features(reported_features(), self.file_path, self.dataset_id, self.key_field, self.isCanceled)
+
+    def finished(self, result):
+        _active_tasks.discard(self)
+        self.imported_dataset.close()
+        if result:
+            add_layer_to_project(self.file_path, self.output_format, self.dataset_id)
+        elif self.error:
+            QgsMessageLog.logMessage('Refresh of {} failed: {}'.format(self.dataset_id, self.error), 'Opendatasoft')
+            self.errorOccurred.emit("The refresh of {} was interrupted: {}".format(
+                self.dataset_id, str(self.error) or type(self.error).__name__))
+
+
+class ClusterImportTask(ImportDatasetTask):
+    """
+    Import task writing the grouped rows of a clustered export as a point layer, one point per cluster.
+    """
+    def __init__(self, dataset_id, imported_dataset, file_path, output_format=writers.GEOJSON):
+        super(ClusterImportTask, self).__init__(dataset_id, imported_dataset, file_path, None, output_format)
+
+    def download(self, progress_reporter):
+        rows = jsonstream.iter_json_array(
+            progress_reporter.track(self.imported_dataset.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)))
+
+        def reported_features():
+            for count, row in enumerate(rows, 1):
+                yield clusters.cluster_to_feature(row)
+                progress_reporter.report(progress_reporter.downloaded, count)
+
+        writers.write_features(reported_features(), self.file_path, self.output_format, self.dataset_id,
+                               self.isCanceled)
+
+
+class BatchImportTask(QgsTask):
+    """
+    Download the exports of several datasets with at most max_workers downloads at a time, then add
+    all the imported layers to the current project at once. A failed dataset does not stop the others.
+    open_export(dataset_id) opens the export of a dataset and returns the streamed response, the
+    number of records expected, the export format, the geometry column of JSONL exports and the
+    types of the fields of the export.
+    """
+    progressTextChanged = pyqtSignal(str)
+    errorOccurred = pyqtSignal(str)
+
+    def __init__(self, dataset_ids, open_export, file_paths, output_format=writers.GEOJSON,
+                 max_workers=MAX_PARALLEL_IMPORTS):
+        super(BatchImportTask, self).__init__('Import {} datasets from Opendatasoft'.format(len(dataset_ids)),
+                                              QgsTask.CanCancel)
+        # Title of the CancelImportDialog following the task
+        self.dataset_id = '{} datasets'.format(len(dataset_ids))
+        self.dataset_ids = dataset_ids
+        self.open_export = open_export
+        self.file_paths = file_paths
+        self.output_format = output_format
+        self.max_workers = max_workers
+        self.percentages = {dataset_id: 0 for dataset_id in dataset_ids}
+        self.downloaded = {dataset_id: 0 for dataset_id in dataset_ids}
+        self.imported = []
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def run(self):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.importDataset, dataset_id): dataset_id for dataset_id in self.dataset_ids}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        future.result()
+                    except Exception as error:
+                        # Whatever the error, the other datasets are still imported
+                        with self._lock:
+                            self.errors[futures[future]] = error
+                self.reportProgress(time.monotonic() - start)
+        return not self.isCanceled()
+
+    def importDataset(self, dataset_id):
+        if self.isCanceled():
+            return
+        imported_dataset, records_count, export_format, geom_column, field_types = self.open_export(dataset_id)
+
+        def report_progress(text, percentage):
+            with self._lock:
+                self.downloaded[dataset_id] = progress_reporter.downloaded
+                if percentage is not None:
+                    self.percentages[dataset_id] = percentage
+
+        progress_reporter = ProgressReporter(records_count, report_progress, response_size(imported_dataset))
+        try:
+            with instrumentation.phase('download', dataset_id=dataset_id, export_format=export_format,
+                                       output_format=self.output_format) as metrics:
+                try:
+                    download_to_file(imported_dataset, self.file_paths[dataset_id], progress_reporter,
+                                     self.isCanceled, self.output_format, dataset_id, export_format, geom_column,
+                                     field_types=field_types)
+                finally:
+                    metrics.update(progress_reporter.metrics())
+        finally:
+            imported_dataset.close()
+        if not self.isCanceled():
+            with self._lock:
+                self.percentages[dataset_id] = 100
+                self.imported.append(dataset_id)
+
+    def reportProgress(self, elapsed_seconds):
+        with self._lock:
+            percentages = dict(self.percentages)
+            downloaded = sum(self.downloaded.values())
+            finished = len(self.imported)
+            failed = len(self.errors)
+        lines = ['Datasets: {}/{} imported'.format(finished, len(self.dataset_ids)),
+                 progress_text(downloaded, 0, None, elapsed_seconds)]
+        if failed:
+            lines.append('Failed: {}'.format(failed))
+        lines += ['{}: {:.0f}%'.format(dataset_id, percentage) for dataset_id, percentage in percentages.items()
+                  if 0 < percentage < 100]
+        self.progressTextChanged.emit('\n'.join(lines))
+        self.setProgress(sum(percentages.values()) / len(percentages))
+
+    def finished(self, result):
+        _active_tasks.discard(self)
+        imported = self.imported if result else []
+        layers = [QgsVectorLayer(writers.layer_uri(self.file_paths[dataset_id], self.output_format, dataset_id),
+                                 dataset_id, "ogr") for dataset_id in self.dataset_ids if dataset_id in imported]
+        if layers:
+            with instrumentation.phase('layer load', datasets=len(layers)):
+                QgsProject.instance().addMapLayers(layers)
+        for dataset_id in self.dataset_ids:
+            if dataset_id not in imported:
+                for export_format in writers.BINARY_EXPORT_DRIVERS:
+                    remove_partial_file('{}.{}'.format(self.file_paths[dataset_id], export_format))
+                remove_partial_file(self.file_paths[dataset_id])
+        if self.errors:
+            for dataset_id, error in self.errors.items():
+                QgsMessageLog.logMessage('Import of {} failed: {}'.format(dataset_id, error), 'Opendatasoft')
+            self.errorOccurred.emit("The import of {} failed:\n{}".format(
+                'these datasets' if len(self.errors) > 1 else 'this dataset',
+                '\n'.join('{}: {}'.format(dataset_id, str(error) or type(error).__name__)
+                          for dataset_id, error in self.errors.items())))
+
+
+class CatalogIndexTask(QgsTask):
+    """Fill the local catalog index of a domain in a background thread, with index_catalog()."""
+    # Scopes being indexed, so that a catalog is not indexed twice at the same time
+    running_scopes = set()
+
+    def __init__(self, domain_url, scope, index_catalog):
+        super(CatalogIndexTask, self).__init__('Index the catalog of {}'.format(domain_url), QgsTask.CanCancel)
+        self.domain_url = domain_url
+        self.scope = scope
+        self.index_catalog = index_catalog
+        self.error = None
+        CatalogIndexTask.running_scopes.add(scope)
+
+    def run(self):
+        try:
+            self.index_catalog()
+        except DOWNLOAD_ERRORS as error:
+            self.error = error
+            return False
+        return True
+
+    def finished(self, result):
+        _active_tasks.discard(self)
+        CatalogIndexTask.running_scopes.discard(self.scope)
+        if self.error:
+            QgsMessageLog.logMessage('Indexing the catalog of {} failed: {}'.format(
+                self.domain_url, str(self.error) or type(self.error).__name__), 'Opendatasoft')
+
+
+def add_layer_to_project(file_path, output_format, dataset_id):
+    """Reload the layers of the project reading this file, or add a new one if there are none."""
+    uri = writers.layer_uri(file_path, output_format, dataset_id)
+    existing_layers = [layer for layer in QgsProject.instance().mapLayers().values() if layer.source() == uri]
+    for layer in existing_layers:
+        layer.dataProvider().reloadData()
+        layer.triggerRepaint()
+    if not existing_layers:
+        QgsProject.instance().addMapLayer(QgsVectorLayer(uri, dataset_id, "ogr"))
+
+
+def start_task(task):
+    _active_tasks.add(task)
+    QgsApplication.taskManager().addTask(task)
+
+
+class ProgressReporter:
+    """
+    Turn download totals into progress text and percentage, reported at most every PROGRESS_INTERVAL.
+    Binary streams, whose records cannot be counted, get a percentage of expected_bytes if given.
+    """
+    def __init__(self, records_count, report_progress, expected_bytes=None):
+        self.records_count = records_count
+        self.expected_bytes = expected_bytes
+        self.report_progress = report_progress
+        self.downloaded = 0
+        self.downloaded_records = None
+        # Time spent writing features to the output file, when they are converted while downloaded
+        self.write_seconds = 0
+        self.start = time.monotonic()
+        self.last_report = 0
+
+    def track(self, chunks):
+        """Count the bytes of a stream of chunks while passing them through."""
+        for chunk in chunks:
+            self.downloaded += len(chunk)
+            yield chunk
+
+    def metrics(self):
+        """Totals of the download, for the instrumentation module."""
+        metrics = {'bytes': self.downloaded, 'write': self.write_seconds}
+        if self.downloaded_records is not None:
+            metrics['records'] = self.downloaded_records
+        return metrics
+
+    def report_step(self, text, done, total):
+        """Progress of a step following the download, e.g. merging partitions: done records out of total."""
+        now = time.monotonic()
+        if now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        self.report_progress('{}: {}/{} records'.format(text, done, total),
+                             100 * min(done, total) / total if total else None)
+
+    def report(self, downloaded, downloaded_records):
+        self.downloaded = downloaded
+        self.downloaded_records = downloaded_records
+        now = time.monotonic()
+        if now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        if downloaded_records is None:
+            # Records cannot be counted in binary streams
+            percentage = 100 * min(downloaded, self.expected_bytes) / self.expected_bytes \
+                if self.expected_bytes else None
+            self.report_progress(progress_text(downloaded, 0, None, now - self.start), percentage)
+            return
+        percentage = 100 * min(downloaded_records, self.records_count) / self.records_count \
+            if self.records_count else None
+        self.report_progress(progress_text(downloaded, downloaded_records, self.records_count, now - self.start),
+                             percentage)
+
+
+def download_to_file(imported_dataset, file_path, progress_reporter, is_canceled, output_format=writers.GEOJSON,
+                     layer_name=None, export_format=writers.GEOJSON, geom_column=None, batch_size=writers.BATCH_SIZE,
+                     on_commit=None, field_types=None):
+    """
+    Write the export stream to file_path in output_format. A GeoJSON export saved as GeoJSON is
+    written as it comes; GeoJSON and JSONL exports are otherwise converted feature by feature while
+    the stream is parsed, so that memory stays bounded. Binary exports are downloaded next to
+    file_path, then converted by OGR. Files written as they come are resumable downloads, and
+    converted exports reconnect from the last record read when the connection drops.
+    batch_size, on_commit and field_types are given to the GeoPackage writer of converted exports.
+    """
+    if export_format in writers.BINARY_EXPORT_DRIVERS:
+        export_path = '{}.{}'.format(file_path, export_format)
+        if not write_chunks(imported_dataset, export_path, progress_reporter, is_canceled):
+            remove_partial_file(export_path)
+            return
+        with instrumentation.phase('convert', dataset_id=layer_name, export_format=export_format,
+                                   output_format=output_format):
+            writers.convert_file(export_path, file_path, output_format, layer_name)
+        os.remove(export_path)
+        return
+    if export_format == writers.GEOJSON and output_format == writers.GEOJSON:
+        write_chunks(imported_dataset, file_path, progress_reporter, is_canceled, jsonstream.FeatureCounter(),
+                     'features')
+        return
+
+    if export_format == writers.JSONL:
+        records = resumable.iter_records(
+            imported_dataset, lambda chunks: jsonstream.iter_json_lines(progress_reporter.track(chunks)))
+        features = (writers.record_to_feature(record, geom_column) for record in records)
+    else:
+        features = resumable.iter_records(
+            imported_dataset, lambda chunks: jsonstream.iter_json_array(progress_reporter.track(chunks), 'features'))
+    writer = writers.open_writer(file_path, output_format, layer_name, batch_size, on_commit, field_types)
+    try:
+        for feature in features:
+            if is_canceled():
+                return
+            write_start = time.monotonic()
+            writer.write(feature)
+            progress_reporter.write_seconds += time.monotonic() - write_start
+            progress_reporter.report(progress_reporter.downloaded, writer.count)
+    finally:
+        write_start = time.monotonic()
+        writer.close()
+        progress_reporter.write_seconds += time.monotonic() - write_start
+
+
+def write_chunks(imported_dataset, file_path, progress_reporter, is_canceled, feature_counter=None, records_key=None):
+    """
+    Write a byte stream as it comes, reconnecting and resuming when the connection drops.
+    records_key is given to resumable.ResumableDownload. Returns False if canceled before the end of the stream.
+    """
+    download = resumable.ResumableDownload(imported_dataset, file_path, feature_counter, records_key)
+    for _ in download.chunks(is_canceled):
+        progress_reporter.report(download.downloaded, feature_counter.count if feature_counter is not None else None)
+    return not is_canceled()
+
+
+def response_size(response):
+    """Bytes of the body of a response, None if unknown or compressed."""
+    if response.headers.get('Content-Encoding'):
+        return None
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def remove_partial_file(file_path):
+    for path in (file_path, resumable.checkpoint_path(file_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def progress_text(downloaded, downloaded_records, records_count, elapsed_seconds):
+    text = 'Downloaded: {}MB\nSpeed: {:.2f}kB/s'.format(
+        downloaded // 1024 // 1024,
+        (downloaded / 1024) / max(elapsed_seconds, 0.001))
+    if records_count:
+        downloaded_records = min(downloaded_records, records_count)
+        text += '\nRecords: {}/{} ({:.0f}%)'.format(
+            downloaded_records, records_count, 100 * downloaded_records / records_count)
+        if downloaded_records:
+            remaining_seconds = elapsed_seconds * (records_count - downloaded_records) / downloaded_records
+            text += '\nTime left: {}'.format(format_duration(remaining_seconds))
+    return text
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m'.format(hours, minutes)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
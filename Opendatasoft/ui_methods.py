@@ -9,17 +9,23 @@
 # ---------------------------------------------------------------------
 
 import os
+import re
 from urllib.parse import urlparse
 
 from PyQt5 import QtWidgets, uic
 from PyQt5.QtCore import QCoreApplication
-from PyQt5.QtCore import QSettings
+from PyQt5.QtCore import QTimer
+from qgis.core import QgsMessageLog
 
-from . import utils
+from . import dataset_model, schema, tasks, utils, writers
+
+SEARCH_DELAY = 300
+# Compiled once when the plugin is loaded, rather than each time the dialog opens
+FORM_CLASS, _ = uic.loadUiType(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugin_dialog.ui'))
 
 
 # noinspection PyPep8Naming
-class ODSDialog(QtWidgets.QDialog):
+class ODSDialog(QtWidgets.QDialog, FORM_CLASS):
     """
     Main dialog window. Allows the user to:
     - fetch the catalog of datasets for a given Opendatasoft domain
@@ -29,9 +35,7 @@ class ODSDialog(QtWidgets.QDialog):
     """
     def __init__(self, iface):
         super(ODSDialog, self).__init__()
-        ui_dir = os.path.dirname(os.path.abspath(__file__))
-        ui_path = os.path.join(ui_dir, 'plugin_dialog.ui')
-        uic.loadUi(ui_path, self)
+        self.setupUi(self)
         self.iface = iface
 
         for button in self.dialogButtonBox.buttons():
@@ -40,6 +44,10 @@ class ODSDialog(QtWidgets.QDialog):
                 button.setText('Import dataset')
                 button.setEnabled(False)
         self.filePathButton.clicked.connect(self.getFilePath)
+        for output_format, output_format_name in writers.OUTPUT_FORMATS.items():
+            self.outputFormatComboBox.addItem(output_format_name, output_format)
+        for export_format, export_format_name in writers.EXPORT_FORMATS.items():
+            self.exportFormatComboBox.addItem(export_format_name, export_format)
         self.datasetLabel.setVisible(False)
         self.datasetListComboBox.setVisible(False)
         self.metadataWidget.setVisible(False)
@@ -48,8 +56,37 @@ class ODSDialog(QtWidgets.QDialog):
         self.showFilterCheckBox.stateChanged.connect(self.showFilterUI)
         self.resize(self.width(), 0)
         self.updateListButton.clicked.connect(self.updateListButtonPressed)
+        self.forceRefreshButton.clicked.connect(self.forceRefreshButtonPressed)
+        self.datasetListModel = dataset_model.DatasetListModel(self)
+        self.datasetListModel.pageLoaded.connect(self.showDatasetList)
+        self.datasetListModel.fetchFailed.connect(self.showDatasetListError)
+        self.datasetListModel.domainFailed.connect(self.showDomainError)
+        self.failedDomains = []
+        self.datasetListModel.modelReset.connect(lambda: self.batchDatasetListView.setRowHidden(0, True))
         self.datasetListComboBox.setEditable(True)
+        self.datasetListComboBox.setInsertPolicy(QtWidgets.QComboBox.NoInsert)
+        self.datasetListComboBox.setModel(self.datasetListModel)
+        # Typed text is searched on the server: the completer shows the results without filtering them again
+        self.datasetCompleter = QtWidgets.QCompleter(self.datasetListModel, self)
+        self.datasetCompleter.setCompletionMode(QtWidgets.QCompleter.UnfilteredPopupCompletion)
+        self.datasetListComboBox.setCompleter(self.datasetCompleter)
         self.datasetListComboBox.currentIndexChanged.connect(self.updateSchemaTable)
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(SEARCH_DELAY)
+        self.searchTimer.timeout.connect(self.searchDatasets)
+        self.datasetListComboBox.lineEdit().textEdited.connect(self.searchTimer.start)
+        self.isSearching = False
+        self.schemaTask = None
+        # Schema of the dataset shown in the schema table, and the (domain, dataset identifier, API key) it describes
+        self.datasetSchema = None
+        self.datasetSchemaKey = None
+        self.batchCheckBox.setVisible(False)
+        self.batchCheckBox.stateChanged.connect(self.showBatchUI)
+        self.batchDatasetListView.setModel(self.datasetListModel)
+        self.batchDatasetListView.setRowHidden(0, True)
+        self.batchDatasetListView.selectionModel().selectionChanged.connect(self.updateImportButton)
+        self.showBatchUI()
         self.schemaTableWidget.setEditTriggers(QtWidgets.QTableWidget.NoEditTriggers)
         self.clearFiltersButton.clicked.connect(self.clearFilters)
         self.dialogButtonBox.accepted.connect(self.importDataset)
@@ -57,76 +94,212 @@ class ODSDialog(QtWidgets.QDialog):
         self.show()
 
     def updateListButtonPressed(self):
+        self.updateDatasetList()
+
+    def forceRefreshButtonPressed(self):
+        self.updateDatasetList(force_refresh=True)
+
+    def updateDatasetList(self, force_refresh=False):
         """
-        Fetch datasets list from the remote catalog server.
+        Fetch the first page of the datasets list, from the local catalog cache or the remote catalog server.
+        Next pages are fetched in the background while the list is scrolled.
         """
-        self.datasetListComboBox.clear()
-        self.datasetListComboBox.addItems(["--Choose a dataset identifier--"])
-        try:
-            dataset_id_list = utils.datasets_to_dataset_id_list(utils.import_dataset_list(
-                self.domain(), self.apikey(), self.nonGeoCheckBox.isChecked(), self.text_search()))
-            self.datasetListComboBox.addItems(dataset_id_list)
-            self.datasetLabel.setVisible(True)
-            self.datasetListComboBox.setVisible(True)
-        except utils.DomainError:
+        self.searchTimer.stop()
+        self.isSearching = False
+        self.setDatasetQuery(self.text_search(), force_refresh)
+        for domain in self.domains():
+            if domain:
+                utils.index_catalog_in_background(domain, self.apikey(), force_refresh)
+
+    def searchDatasets(self):
+        """
+        Search the datasets matching the text typed in the dataset combobox on the server, once typing stops.
+        """
+        text = self.datasetListComboBox.currentText().strip()
+        if text == dataset_model.PLACEHOLDER:
+            return
+        self.isSearching = bool(text)
+        self.setDatasetQuery(text or self.text_search(), edit_text=self.datasetListComboBox.currentText())
+
+    def setDatasetQuery(self, text_search, force_refresh=False, edit_text=None):
+        # Resetting the model must neither clear the text being typed nor trigger updateSchemaTable
+        self.datasetListComboBox.blockSignals(True)
+        self.failedDomains = []
+        self.datasetLabel.setText("Dataset identifier:")
+        self.datasetLabel.setToolTip("")
+        self.datasetListModel.setQuery(self.domains(), self.apikey(), self.nonGeoCheckBox.isChecked(), text_search,
+                                       force_refresh)
+        if edit_text is None:
+            self.datasetListComboBox.setCurrentIndex(0)
+        else:
+            self.datasetListComboBox.setEditText(edit_text)
+        self.datasetListComboBox.blockSignals(False)
+
+    def showDatasetList(self):
+        self.datasetLabel.setVisible(True)
+        self.datasetListComboBox.setVisible(True)
+        # A batch is imported from a single domain
+        if self.datasetListModel.isFederated():
+            self.batchCheckBox.setChecked(False)
+        self.batchCheckBox.setVisible(not self.datasetListModel.isFederated())
+        if self.isSearching:
+            self.isSearching = False
+            if self.datasetListComboBox.lineEdit().hasFocus():
+                self.datasetCompleter.complete()
+
+    def showDatasetListError(self, error):
+        self.isSearching = False
+        if isinstance(error, utils.DomainError):
             QtWidgets.QMessageBox.information(None, "ERROR:", "This domain does not exist.")
-        except utils.AccessError:
+        elif isinstance(error, utils.AccessError):
             QtWidgets.QMessageBox.information(None, "ERROR:", "You need an API key to access this domain or "
                                                               "the apikey to search for datasets is wrong.")
-        except utils.InternalError:
+        elif isinstance(error, utils.RateLimitError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain is receiving too many requests, or the quota of "
+                                                              "your API key is exhausted: retry later.")
+        elif isinstance(error, utils.InternalError):
             QtWidgets.QMessageBox.information(None, "ERROR:", "InternalError from Opendatasoft while updating dataset list: "
                                                               "contact support@opendatasoft.com for more information.")
+        elif isinstance(error, utils.RequestTimeoutError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain took too long to answer.")
+        else:
+            QtWidgets.QMessageBox.information(None, "ERROR:", str(error) or type(error).__name__)
+
+    def showDomainError(self, domain, error):
+        """A domain of a multi-domain search did not answer: the datasets of the other domains are still listed."""
+        QgsMessageLog.logMessage('Search of the datasets of {} failed: {}'.format(
+            domain, str(error) or type(error).__name__), 'Opendatasoft')
+        self.failedDomains.append(domain)
+        self.datasetLabel.setVisible(True)
+        self.datasetListComboBox.setVisible(True)
+        self.datasetLabel.setText("Dataset identifier ({} domain(s) did not answer):".format(len(self.failedDomains)))
+        self.datasetLabel.setToolTip("No answer from: {}".format(', '.join(self.failedDomains)))
 
     def updateSchemaTable(self):
         """
-        Fetch selected dataset metadata and first records in order to fill the schema.
+        Fetch selected dataset metadata and first records in the background in order to fill the schema.
         """
         if self.datasetListComboBox.currentText() and \
-                self.datasetListComboBox.currentText() != "--Choose a dataset identifier--":
-            self.schemaTableWidget.setColumnCount(0)
-            try:
-                if self.apikey():
-                    metadata = utils.import_dataset_metadata(self.domain(), self.dataset_id(), self.apikey())
-                    first_record = utils.import_first_record(self.domain(), self.dataset_id(), self.apikey())
-                else:
-                    metadata = utils.import_dataset_metadata(self.domain(), self.dataset_id(), None)
-                    first_record = utils.import_first_record(self.domain(), self.dataset_id(), None)
-                self.datasetNameLabel.setText("Dataset name: {}".format(metadata['results'][0]['metas']['default']['title']))
-                self.publisherLabel.setText("Publisher: {}".format(metadata['results'][0]['metas']['default']['publisher']))
-                self.recordsNumberLabel.setText("Number of records: {}".format(
-                    metadata['results'][0]['metas']['default']['records_count']))
-                for field in metadata['results'][0]['fields']:
-                    column_position = self.schemaTableWidget.columnCount()
-                    self.schemaTableWidget.insertColumn(column_position)
-                    self.schemaTableWidget.setItem(0, column_position, QtWidgets.QTableWidgetItem(field['label']))
-                    self.schemaTableWidget.setItem(1, column_position, QtWidgets.QTableWidgetItem(field['name']))
-                    self.schemaTableWidget.setItem(2, column_position, QtWidgets.QTableWidgetItem(field['type']))
-                    first_record_value = first_record['results'][0][field['name']]
-                    self.schemaTableWidget.setItem(3, column_position, QtWidgets.QTableWidgetItem(str(first_record_value)))
-                    self.schemaTableWidget.resizeColumnsToContents()
-                for button in self.dialogButtonBox.buttons():
-                    if button.text() == 'Import dataset':
-                        button.setEnabled(True)
-            except utils.DatasetError:
-                QtWidgets.QMessageBox.information(None, "ERROR:", "This dataset is private. "
-                                                                  "You need an API key to access it.")
-            self.metadataWidget.setVisible(True)
-            self.saveWidget.setVisible(True)
-            self.clearFilters()
+                self.datasetListComboBox.currentText() != dataset_model.PLACEHOLDER:
+            self.fetchSchema(clear_filters=True)
         else:
-            if self.datasetListComboBox.currentText() != "--Choose a dataset identifier--":
-                self.datasetLabel.setVisible(False)
-                self.datasetListComboBox.setVisible(False)
+            self.hideSchema()
 
-            self.metadataWidget.setVisible(False)
-            self.showFilterCheckBox.setChecked(False)
-            self.saveWidget.setVisible(False)
+    def fetchSchema(self, clear_filters=False, import_dataset=False):
+        """
+        Fetch the schema of the selected dataset in the background, then show it. With import_dataset,
+        the dataset is imported once its schema is fetched, the schema table being left as it is if filled.
+        """
+        if not import_dataset:
+            self.schemaTableWidget.setColumnCount(0)
             for button in self.dialogButtonBox.buttons():
                 if button.text() == 'Import dataset':
                     button.setEnabled(False)
+        task = schema.SchemaTask(self.domain(), self.dataset_id(), self.apikey())
+        task.taskCompleted.connect(lambda: self.schemaFetched(task, clear_filters, import_dataset))
+        task.taskTerminated.connect(lambda: self.schemaFetched(task, clear_filters, import_dataset))
+        self.schemaTask = task
+        tasks.start_task(task)
+
+    def schemaFetched(self, task, clear_filters=False, import_dataset=False):
+        if task is not self.schemaTask:
+            return
+        self.schemaTask = None
+        # Another dataset may have been picked meanwhile
+        if (task.domain_url, task.dataset_id) != self.selected_dataset():
+            return
+        if task.error is not None:
+            self.showSchemaError(task.error)
+        elif task.dataset_schema is not None:
+            self.datasetSchema = task.dataset_schema
+            self.datasetSchemaKey = (task.domain_url, task.dataset_id, task.apikey)
+            if not import_dataset or not self.schemaTableWidget.columnCount():
+                self.showSchema(task.dataset_schema, clear_filters)
+            if import_dataset:
+                self.importDataset()
+
+    def loadedSchema(self):
+        """Schema of the selected dataset fetched by fetchSchema, None if it was not fetched yet."""
+        if self.datasetSchemaKey != (self.domain(), self.dataset_id(), self.apikey()):
+            return None
+        return self.datasetSchema
+
+    def showSchema(self, dataset_schema, clear_filters=True):
+        self.schemaTableWidget.setColumnCount(0)
+        self.datasetNameLabel.setText("Dataset name: {}".format(dataset_schema.metas['default']['title']))
+        self.publisherLabel.setText("Publisher: {}".format(dataset_schema.metas['default']['publisher']))
+        self.recordsNumberLabel.setText("Number of records: {}".format(
+            dataset_schema.metas['default']['records_count']))
+        for field in dataset_schema.fields:
+            column_position = self.schemaTableWidget.columnCount()
+            self.schemaTableWidget.insertColumn(column_position)
+            self.schemaTableWidget.setItem(0, column_position, QtWidgets.QTableWidgetItem(field['label']))
+            self.schemaTableWidget.setItem(1, column_position, QtWidgets.QTableWidgetItem(field['name']))
+            self.schemaTableWidget.setItem(2, column_position, QtWidgets.QTableWidgetItem(field['type']))
+            first_record_value = dataset_schema.sample_value(field['name'])
+            self.schemaTableWidget.setItem(3, column_position, QtWidgets.QTableWidgetItem(str(first_record_value)))
+            self.schemaTableWidget.resizeColumnsToContents()
+        for button in self.dialogButtonBox.buttons():
+            if button.text() == 'Import dataset':
+                button.setEnabled(True)
+        self.metadataWidget.setVisible(True)
+        self.saveWidget.setVisible(True)
+        if clear_filters:
+            self.clearFilters()
+
+    def showSchemaError(self, error):
+        if isinstance(error, utils.DatasetError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "This dataset is private. "
+                                                              "You need an API key to access it.")
+        elif isinstance(error, utils.AccessError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The apikey to access this dataset is wrong.")
+        elif isinstance(error, utils.DomainError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "This domain does not exist.")
+        elif isinstance(error, utils.RateLimitError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain is receiving too many requests, or the quota of "
+                                                              "your API key is exhausted: retry later.")
+        elif isinstance(error, utils.InternalError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "InternalError from Opendatasoft while fetching the schema: "
+                                                              "contact support@opendatasoft.com for more information.")
+        elif isinstance(error, utils.RequestTimeoutError):
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain took too long to answer.")
+        else:
+            QtWidgets.QMessageBox.information(None, "ERROR:", str(error) or type(error).__name__)
+
+    def hideSchema(self):
+        if self.datasetListComboBox.currentText() != dataset_model.PLACEHOLDER:
+            self.datasetLabel.setVisible(False)
+            self.datasetListComboBox.setVisible(False)
+
+        self.metadataWidget.setVisible(False)
+        self.showFilterCheckBox.setChecked(False)
+        self.saveWidget.setVisible(self.batchCheckBox.isChecked())
+        for button in self.dialogButtonBox.buttons():
+            if button.text() == 'Import dataset':
+                button.setEnabled(False)
+        self.updateImportButton()
+        QCoreApplication.processEvents()
+        self.resize(self.width(), 0)
+
+    def showBatchUI(self):
+        is_batch = self.batchCheckBox.isChecked()
+        self.batchDatasetListView.setVisible(is_batch)
+        self.batchWorkersLabel.setVisible(is_batch)
+        self.batchWorkersSpinBox.setVisible(is_batch)
+        if is_batch:
+            self.saveWidget.setVisible(True)
+        self.updateImportButton()
+        if not is_batch:
             QCoreApplication.processEvents()
             self.resize(self.width(), 0)
 
+    def updateImportButton(self):
+        if not self.batchCheckBox.isChecked():
+            return
+        for button in self.dialogButtonBox.buttons():
+            if button.text() == 'Import dataset':
+                button.setEnabled(bool(self.batch_dataset_ids()))
+
     def showFilterUI(self):
         self.filterGroupBox.setVisible(self.showFilterCheckBox.isChecked())
         if not self.showFilterCheckBox.isChecked():
@@ -143,21 +316,35 @@ class ODSDialog(QtWidgets.QDialog):
         fileDialog = QtWidgets.QFileDialog(self)
         fileDialog.setFileMode(QtWidgets.QFileDialog.AnyFile)
         fileName = fileDialog.getSaveFileName(self, "Choose save location", "/Users",
-                                              "Geojson Files (*.geojson)")
+                                              writers.FILE_FILTERS[self.output_format()])
         self.pathInput.setText(fileName[0])
 
     def path(self):
         return self.pathInput.text()
 
+    def output_format(self):
+        return self.outputFormatComboBox.currentData()
+
+    def export_format(self):
+        return self.exportFormatComboBox.currentData()
+
     def domain(self):
-        url = self.domainInput.text()
-        if urlparse(url).scheme:
-            # https://data.opendatasoft.com format
-            ods_domain_url = urlparse(url).netloc
-        else:
-            # no scheme, urlparse cannot parse: let's do best effort
-            ods_domain_url = url.split('/')[0]
-        return ods_domain_url
+        """Domain of the selected dataset: the domain address, or the domain listing it in multi-domain mode."""
+        return self.selected_dataset()[0]
+
+    def domains(self):
+        """Domains to search, several ones being separated by commas in the domain address field."""
+        domains = []
+        for url in re.split(r'[\s,;]+', self.domainInput.text().strip()):
+            if urlparse(url).scheme:
+                # https://data.opendatasoft.com format
+                ods_domain_url = urlparse(url).netloc
+            else:
+                # no scheme, urlparse cannot parse: let's do best effort
+                ods_domain_url = url.split('/')[0]
+            if ods_domain_url not in domains:
+                domains.append(ods_domain_url)
+        return domains
 
     def apikey(self):
         if self.apikeyInput.text():
@@ -170,7 +357,46 @@ class ODSDialog(QtWidgets.QDialog):
         return None
 
     def dataset_id(self):
-        return self.datasetListComboBox.currentText()
+        return self.selected_dataset()[1]
+
+    def selected_dataset(self):
+        """(domain, dataset identifier) picked in the list, or typed in the dataset combobox."""
+        index = self.datasetListComboBox.currentIndex()
+        text = self.datasetListComboBox.currentText()
+        if index > 0 and text == self.datasetListComboBox.itemText(index):
+            return (self.datasetListComboBox.itemData(index, dataset_model.DOMAIN_ROLE),
+                    self.datasetListComboBox.itemData(index, dataset_model.DATASET_ID_ROLE))
+        domains = self.domains()
+        if len(domains) == 1:
+            return domains[0], text
+        # Multi-domain lists label each dataset with its domain: "dataset_id (domain)"
+        labelled_dataset = re.fullmatch(r'\s*(\S+) \((\S+)\)\s*', text)
+        if labelled_dataset and labelled_dataset.group(2) in domains:
+            return labelled_dataset.group(2), labelled_dataset.group(1)
+        return '', text
+
+    def batch_dataset_ids(self):
+        if not self.batchCheckBox.isChecked():
+            return []
+        return [index.data(dataset_model.DATASET_ID_ROLE) for index in sorted(
+            self.batchDatasetListView.selectionModel().selectedRows(), key=lambda index: index.row())]
+
+    def partition_field(self):
+        return self.partitionFieldInput.text().strip()
+
+    def timestamp_field(self):
+        return self.timestampFieldInput.text().strip() or None
+
+    def key_field(self):
+        return self.keyFieldInput.text().strip() or None
+
+    def kept_fields(self):
+        """Names of the fields whose columns are selected in the schema table."""
+        columns = sorted(index.column() for index in self.schemaTableWidget.selectionModel().selectedColumns())
+        return [self.schemaTableWidget.item(1, column).text() for column in columns]
+
+    def aggregates(self):
+        return self.aggregatesInput.text().strip()
 
     def params(self):
         params = {}
@@ -180,9 +406,9 @@ class ODSDialog(QtWidgets.QDialog):
                 params['select'] = select_input[len("select="):]
             else:
                 params['select'] = select_input
-            if self.defaultGeomCheckBox.isChecked():
-                geom_column_name = utils.get_geom_column(
-                    utils.import_dataset_metadata(self.domain(), self.dataset_id(), self.apikey()))
+            dataset_schema = self.loadedSchema()
+            if self.defaultGeomCheckBox.isChecked() and dataset_schema is not None:
+                geom_column_name = dataset_schema.geom_column
                 if geom_column_name:
                     if geom_column_name not in params['select']:
                         params['select'] += ',' + geom_column_name
@@ -222,17 +448,18 @@ class ODSDialog(QtWidgets.QDialog):
         if apikey and ods_cache['store_apikey_in_cache']:
             self.apikeyCacheCheckBox.setChecked(True)
             self.apikeyInput.setText(apikey)
+        if 'value' in ods_cache['dataset_id'] or (apikey and ods_cache['store_apikey_in_cache']):
+            # The list and the schema are both loaded in the background: the dialog shows up right away
             self.updateListButtonPressed()
-            self.datasetListComboBox.setCurrentIndex(ods_cache['dataset_id']['index'])
-        else:
-            if 'items' in ods_cache['dataset_id']:
+            dataset_id = ods_cache['dataset_id'].get('value')
+            if dataset_id:
                 self.datasetLabel.setVisible(True)
                 self.datasetListComboBox.setVisible(True)
-                self.datasetListComboBox.addItems(ods_cache['dataset_id']['items'])
-                self.datasetListComboBox.setCurrentIndex(ods_cache['dataset_id']['index'])
-            else:
-                self.datasetLabel.setVisible(False)
-                self.datasetListComboBox.setVisible(False)
+                self.datasetListComboBox.setEditText(dataset_id)
+                self.fetchSchema()
+        else:
+            self.datasetLabel.setVisible(False)
+            self.datasetListComboBox.setVisible(False)
         if 'select' in ods_cache['params']:
             self.selectInput.setText(ods_cache['params']['select'])
         if 'where' in ods_cache['params']:
@@ -243,17 +470,62 @@ class ODSDialog(QtWidgets.QDialog):
             self.limitInput.setText(ods_cache['params']['limit'])
         if 'path' in ods_cache:
             self.pathInput.setText(ods_cache['path'])
+        if 'output_format' in ods_cache:
+            self.outputFormatComboBox.setCurrentIndex(self.outputFormatComboBox.findData(ods_cache['output_format']))
+        if 'export_format' in ods_cache:
+            self.exportFormatComboBox.setCurrentIndex(self.exportFormatComboBox.findData(ods_cache['export_format']))
+        if 'incremental' in ods_cache:
+            self.incrementalCheckBox.setChecked(ods_cache['incremental'])
+            self.timestampFieldInput.setText(ods_cache['timestamp_field'] or '')
+            self.keyFieldInput.setText(ods_cache['key_field'] or '')
+        if 'viewport_layer' in ods_cache:
+            self.viewportCheckBox.setChecked(ods_cache['viewport_layer'])
+        if 'progressive' in ods_cache:
+            self.progressiveCheckBox.setChecked(ods_cache['progressive'])
+        if 'prune_fields' in ods_cache:
+            self.pruneCheckBox.setChecked(ods_cache['prune_fields'])
+        if 'batch_workers' in ods_cache:
+            self.batchWorkersSpinBox.setValue(ods_cache['batch_workers'])
+        if 'clusters' in ods_cache:
+            self.clusterCheckBox.setChecked(ods_cache['clusters'])
+            self.clusterPrecisionSpinBox.setValue(ods_cache['cluster_precision'])
+            self.aggregatesInput.setText(ods_cache['aggregates'])
+
+    def prunedSelect(self):
+        """
+        select keeping only the fields selected in the schema table and the geometry field, None
+        when every field is downloaded. The refresh of an incremental import also needs its own fields.
+        """
+        kept_fields = self.kept_fields()
+        if not self.pruneCheckBox.isChecked() or not kept_fields:
+            return None
+        if self.incrementalCheckBox.isChecked():
+            kept_fields += [field for field in (self.timestamp_field(), self.key_field())
+                            if field and field not in kept_fields]
+        return utils.pruned_select(kept_fields, self.loadedSchema().geom_column)
+
+    def storedImportEntry(self, params):
+        if not self.incrementalCheckBox.isChecked():
+            return None
+        return utils.stored_import_entry(self.domain(), self.dataset_id(), params, self.output_format(),
+                                         self.timestamp_field())
 
     def importDataset(self):
         """
         Fetch the selected dataset from remote Opendatasoft catalog
         and add it to the current project as a vector layer.
         """
-        settings = QSettings()
-        if self.domain() == "" or self.dataset_id() == "":
+        if self.domain() == "" or (self.dataset_id() == "" and not self.batch_dataset_ids()):
             QtWidgets.QMessageBox.information(None, "ERROR:", "Domain and dataset fields must be filled to import a "
                                                               "dataset.")
             return
+        dataset_schema = None
+        if not self.batch_dataset_ids():
+            dataset_schema = self.loadedSchema()
+            if dataset_schema is None:
+                # The import goes on once the schema is fetched in the background
+                self.fetchSchema(import_dataset=True)
+                return
         path = self.path()
         if self.showFilterCheckBox.isChecked():
             params = self.params()
@@ -262,11 +534,63 @@ class ODSDialog(QtWidgets.QDialog):
         if self.apikey():
             params['apikey'] = self.apikey()
         try:
-            fetched_dataset = utils.import_dataset_to_qgis(self.domain(), self.dataset_id(), params)
-            self.setVisible(False)
-            utils.load_dataset_to_qgis(path, self.dataset_id(), fetched_dataset)
-            all_datasets = [self.datasetListComboBox.itemText(i) for i in range(self.datasetListComboBox.count())]
-            dataset_index = self.datasetListComboBox.currentIndex()
+            pruned_select = None
+            if not self.batch_dataset_ids() and not self.clusterCheckBox.isChecked() and 'select' not in params:
+                pruned_select = self.prunedSelect()
+                if pruned_select:
+                    params['select'] = pruned_select
+            if self.batch_dataset_ids():
+                batch_params = {'apikey': params['apikey']} if 'apikey' in params else {}
+                utils.load_datasets_batch_to_qgis(path, self.domain(), self.batch_dataset_ids(), batch_params,
+                                                  self.output_format(), self.export_format(),
+                                                  self.batchWorkersSpinBox.value())
+                self.setVisible(False)
+            elif self.viewportCheckBox.isChecked():
+                utils.add_viewport_layer_to_qgis(self.iface, self.domain(), self.dataset_id(), params,
+                                                 dataset_schema.geom_column)
+                self.setVisible(False)
+            elif self.clusterCheckBox.isChecked():
+                fetched_dataset, cluster_query = utils.import_clustered_dataset_to_qgis(
+                    self.domain(), self.dataset_id(), params, dataset_schema.geom_column, dataset_schema.geom_type,
+                    self.clusterPrecisionSpinBox.value(), self.aggregates())
+                self.setVisible(False)
+                utils.load_clustered_dataset_to_qgis(path, self.dataset_id(), fetched_dataset, cluster_query,
+                                                     self.output_format())
+            elif self.incrementalCheckBox.isChecked() and utils.refresh_dataset_to_qgis(
+                    self.domain(), self.dataset_id(), params, self.output_format(), self.timestamp_field(),
+                    self.key_field()):
+                self.setVisible(False)
+            elif self.partitionsSpinBox.value() > 1 and self.partition_field() and utils.can_partition(params):
+                stored_import = self.storedImportEntry(params)
+                ods_client, partition_params, records_count = utils.import_partitioned_dataset_to_qgis(
+                    self.domain(), self.dataset_id(), params, self.partition_field(), self.partitionsSpinBox.value())
+                field_types = utils.export_field_types(dataset_schema.fields, params) \
+                    if writers.needs_field_types(self.output_format(), writers.GEOJSON) else None
+                self.setVisible(False)
+                task = utils.load_partitioned_dataset_to_qgis(path, self.dataset_id(), ods_client, partition_params,
+                                                              records_count, self.output_format(), field_types)
+                if stored_import:
+                    utils.remember_import(task, *stored_import)
+            else:
+                stored_import = self.storedImportEntry(params)
+                export_format = writers.resolve_export_format(self.export_format())
+                progressive = self.progressiveCheckBox.isChecked() and self.output_format() == writers.GEOPACKAGE
+                if progressive and export_format in writers.BINARY_EXPORT_DRIVERS:
+                    # Binary exports can only be read once complete
+                    export_format = writers.GEOJSON
+                geom_column = dataset_schema.geom_column if export_format == writers.JSONL else None
+                field_types = utils.export_field_types(dataset_schema.fields, params) \
+                    if writers.needs_field_types(self.output_format(), export_format) else None
+                fetched_dataset, records_count = utils.import_dataset_to_qgis(self.domain(), self.dataset_id(), params,
+                                                                              export_format)
+                self.setVisible(False)
+                task = utils.load_dataset_to_qgis(path, self.dataset_id(), fetched_dataset, records_count,
+                                                  self.output_format(), export_format, geom_column, progressive,
+                                                  field_types)
+                if stored_import:
+                    utils.remember_import(task, *stored_import)
+            # The label of the dataset, which includes its domain in multi-domain mode
+            dataset_id = '' if self.batch_dataset_ids() else self.datasetListComboBox.currentText()
 
             if self.apikey():
                 params.pop('apikey')
@@ -274,22 +598,34 @@ class ODSDialog(QtWidgets.QDialog):
                     utils.create_new_ods_auth_config(self.apikey())
             else:
                 utils.remove_ods_auth_config()
+            if pruned_select:
+                # The pruned fields are picked again in the schema table, not restored as a select filter
+                params.pop('select')
 
-            ods_cache = {'domain': self.domain(), 'include_non_geo_dataset': self.nonGeoCheckBox.isChecked(),
+            ods_cache = {'domain': ', '.join(self.domains()), 'include_non_geo_dataset': self.nonGeoCheckBox.isChecked(),
                          'text_search': self.text_search(),
                          'store_apikey_in_cache': self.apikeyCacheCheckBox.isChecked(),
-                         'dataset_id': {'index': dataset_index},
+                         'dataset_id': {},
                          'default_geom_column': self.defaultGeomCheckBox.isChecked(),
                          'are_filters_shown': self.showFilterCheckBox.isChecked(),
-                         'params': params, 'path': self.path()}
-
-            if not self.apikey():
-                ods_cache['dataset_id'] = {'items': all_datasets, 'index': dataset_index}
-            settings.setValue('ods_cache', ods_cache)
+                         'params': params, 'path': self.path(), 'output_format': self.output_format(),
+                         'export_format': self.export_format(),
+                         'incremental': self.incrementalCheckBox.isChecked(),
+                         'timestamp_field': self.timestamp_field(), 'key_field': self.key_field(),
+                         'viewport_layer': self.viewportCheckBox.isChecked(),
+                         'progressive': self.progressiveCheckBox.isChecked(),
+                         'prune_fields': self.pruneCheckBox.isChecked(),
+                         'clusters': self.clusterCheckBox.isChecked(),
+                         'batch_workers': self.batchWorkersSpinBox.value(),
+                         'cluster_precision': self.clusterPrecisionSpinBox.value(), 'aggregates': self.aggregates()}
+
+            if not self.apikey() or self.apikeyCacheCheckBox.isChecked():
+                ods_cache['dataset_id'] = {'value': dataset_id}
+            utils.save_session_state(ods_cache)
 
             self.close()
-        except utils.OdsqlError:
-            pass
+        except utils.OdsqlError as error:
+            QtWidgets.QMessageBox.information(None, "ERROR:", str(error))
         except utils.DomainError:
             QtWidgets.QMessageBox.information(None, "ERROR:", "This domain does not exist.")
         except utils.DatasetError:
@@ -302,20 +638,47 @@ class ODSDialog(QtWidgets.QDialog):
             QtWidgets.QMessageBox.information(None, "ERROR:", "Permission required to write on this file.")
         except utils.AccessError:
             QtWidgets.QMessageBox.information(None, "ERROR:", "The apikey to access this dataset is wrong.")
+        except utils.RateLimitError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain is receiving too many requests, or the quota of "
+                                                              "your API key is exhausted: retry later.")
+        except utils.InternalError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "InternalError from Opendatasoft while importing the dataset: "
+                                                              "contact support@opendatasoft.com for more information.")
+        except utils.RequestTimeoutError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The domain took too long to answer.")
+        except utils.PartitionFieldError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "The export can only be split on a numeric or date field.")
+        except utils.PointFieldError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "Only datasets with a geo_point_2d field can be imported "
+                                                              "as clusters.")
+        except utils.GeometryFieldError:
+            QtWidgets.QMessageBox.information(None, "ERROR:", "Only datasets with a geometry field can be loaded "
+                                                              "from the map view.")
 
 
 # noinspection PyPep8Naming
 class CancelImportDialog(QtWidgets.QDialog):
-    def __init__(self):
+    """
+    Non-modal window following the progress of a background import task, which can be canceled from it.
+    """
+    def __init__(self, task):
         super(CancelImportDialog, self).__init__()
         ui_dir = os.path.dirname(os.path.abspath(__file__))
         ui_path = os.path.join(ui_dir, 'cancel_import.ui')
         uic.loadUi(ui_path, self)
 
-        self.isCanceled = False
+        self.task = task
+        self.setWindowTitle(task.dataset_id)
         self.cancelButton.clicked.connect(self.cancelImport)
+        task.progressTextChanged.connect(self.chunkLabel.setText)
+        task.taskCompleted.connect(self.close)
+        task.taskTerminated.connect(self.close)
+        task.errorOccurred.connect(self.showError)
 
         self.show()
 
     def cancelImport(self):
-        self.isCanceled = True
+        self.task.cancel()
+
+    def showError(self, message):
+        QtWidgets.QMessageBox.information(None, "ERROR:", message)
@@ -8,29 +8,80 @@
 # the Free Software Foundation; version 3 of the License.
 # ---------------------------------------------------------------------
 
+import functools
+import json
+import os
+import re
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from PyQt5 import QtWidgets
-from PyQt5.QtCore import QCoreApplication, QElapsedTimer
-from qgis.core import QgsApplication, QgsAuthMethodConfig, QgsProject, QgsVectorLayer
+from PyQt5.QtCore import QSettings
+from qgis.core import (QgsApplication, QgsAuthMethodConfig, QgsCoordinateReferenceSystem, QgsCoordinateTransform,
+                       QgsProject)
 
-from . import ui_methods
+from . import (catalog_cache, catalog_index, client, clusters, dataset_store, instrumentation, jsonstream, partitions,
+               resumable, tasks, ui_methods, viewport_layer, writers)
+from .exceptions import (AccessError, DatasetError, DomainError, ExportUnavailableError,  # noqa: F401
+                         GeometryFieldError, InternalError, NotModifiedError, NumberOfLinesError, OdsqlError,
+                         PartitionFieldError, PointFieldError, RateLimitError, RequestTimeoutError)
 
 V2_QUERY_SIZE_LIMIT = 10000
 V2_QUERY_SIZE_LIMIT_DATA_OPENDATASOFT = 30000
 V2_API_CHUNK_SIZE = 100
-
-
-def import_dataset_list(domain_url, apikey, include_non_geo_dataset, text_search_param):
-    """HTTP call to Opendatasoft Explore API to get the dataset list of the input domain."""
+CATALOG_EXPORT_CHUNK_SIZE = 1024 * 64
+CATALOG_PAGE_WORKERS = 4
+# Errors of a connection dropping while a catalog export is streamed
+CATALOG_STREAM_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError)
+# Inputs of the dialog at the last import, restored when it is opened again
+SESSION_STATE_SETTINGS_KEY = 'ods_cache'
+
+
+def import_dataset_list(domain_url, apikey, include_non_geo_dataset, text_search_param, force_refresh=False):
+    """
+    HTTP call to Opendatasoft Explore API to get the dataset list of the input domain.
+    The whole list is streamed from the catalog export endpoint in a single response; the paginated
+    catalog endpoint is only used as a fallback when the export is not available.
+    Results are kept in the on-disk catalog cache: a fresh entry is returned without any network
+    traffic, a stale one is revalidated with a conditional request unless force_refresh is set.
+    """
+    params = catalog_params(include_non_geo_dataset, text_search_param)
+    headers = {}
+    with instrumentation.phase('catalog listing', domain=domain_url) as metrics:
+        cache = catalog_cache.default_catalog_cache()
+        cache_key = cache.key(domain_url, text_search_param, include_non_geo_dataset, apikey)
+        cache_entry = None if force_refresh else cache.get(cache_key)
+        if cache_entry:
+            if cache.is_fresh(cache_entry):
+                metrics.update(source='cache', datasets=cache_entry['json_dataset']['total_count'])
+                return cache_entry['json_dataset']
+            if cache_entry['etag']:
+                headers['If-None-Match'] = cache_entry['etag']
+            if cache_entry['last_modified']:
+                headers['If-Modified-Since'] = cache_entry['last_modified']
+
+        ods_client = client.get_client(domain_url, apikey)
+        try:
+            json_dataset, etag, last_modified = import_dataset_list_from_export(ods_client, params, headers)
+            metrics['source'] = 'export'
+        except NotModifiedError:
+            cache.touch(cache_key, cache_entry)
+            metrics.update(source='not modified', datasets=cache_entry['json_dataset']['total_count'])
+            return cache_entry['json_dataset']
+        except ExportUnavailableError as error:
+            record_export_fallback(domain_url, error)
+            json_dataset, etag, last_modified = import_dataset_list_paginated(ods_client, params), None, None
+            metrics['source'] = 'paginated'
+        metrics['datasets'] = json_dataset['total_count']
+        cache.put(cache_key, json_dataset, etag, last_modified)
+        return json_dataset
+
+
+def catalog_params(include_non_geo_dataset, text_search_param):
+    """Catalog query listing the dataset identifiers, filtered by a full-text search and on geo datasets."""
     params = {
         'select': 'dataset_id',
-        'limit': V2_API_CHUNK_SIZE,
         'order_by': 'dataset_id'}
-    headers = {}
-    if apikey:
-        headers['Authorization'] = 'apikey {}'.format(apikey)
     if text_search_param:
         params['where'] = ['"{}"'.format(text_search_param)]
         params.pop('order_by')
@@ -39,35 +90,162 @@ def import_dataset_list(domain_url, apikey, include_non_geo_dataset, text_search
             params['where'].append("features='geo'")
         else:
             params['where'] = ["features='geo'"]
+    return params
+
+
+def cached_dataset_id_list(domain_url, apikey, include_non_geo_dataset, text_search_param):
+    """Dataset identifiers of a fresh catalog cache entry of the query, None when there is none."""
+    cache = catalog_cache.default_catalog_cache()
+    cache_entry = cache.get(cache.key(domain_url, text_search_param, include_non_geo_dataset, apikey))
+    if cache_entry and cache.is_fresh(cache_entry):
+        return datasets_to_dataset_id_list(cache_entry['json_dataset'])
+    return None
+
+
+def import_dataset_page(domain_url, apikey, include_non_geo_dataset, text_search_param, offset,
+                        limit=V2_API_CHUNK_SIZE, timeout=None):
+    """
+    HTTP call to Opendatasoft Explore API to get one page of the dataset list of the input domain.
+    Returns the dataset identifiers of the page and the number of datasets matching the query.
+    """
+    params = dict(catalog_params(include_non_geo_dataset, text_search_param), offset=offset, limit=limit)
+    with instrumentation.phase('catalog page', domain=domain_url, offset=offset) as metrics:
+        json_dataset = client.get_client(domain_url, apikey).get('catalog/datasets', params, timeout=timeout).json()
+        metrics['datasets'] = len(json_dataset['results'])
+    return datasets_to_dataset_id_list(json_dataset), json_dataset['total_count']
+
+
+def catalog_query_size_limit(domain_url):
+    """Number of datasets of the paginated catalog endpoint reachable with offsets."""
+    return V2_QUERY_SIZE_LIMIT_DATA_OPENDATASOFT if domain_url == 'data.opendatasoft.com' else V2_QUERY_SIZE_LIMIT
 
+
+def import_dataset_list_from_export(ods_client, params, headers):
+    """
+    Stream the catalog export of the domain and parse it incrementally, without any size limit.
+    Returns the dataset list along with the ETag and Last-Modified validators of the response.
+    """
     try:
-        first_query = requests.get("https://{}/api/explore/v2.1/catalog/datasets".format(domain_url),
-                                   params=params,
-                                   headers=headers)
-        if first_query.status_code >= 500:
-            raise InternalError
-        if first_query.status_code == 404:
-            raise DomainError
-        if first_query.status_code == 401:
-            raise AccessError
-    except (requests.exceptions.ConnectionError, requests.exceptions.InvalidURL):
-        raise DomainError
-    json_dataset = first_query.json()
-    print(json_dataset)
+        with ods_client.send('catalog/exports/json', params, headers, stream=True) as query:
+            if query.status_code == 304:
+                raise NotModifiedError
+            if query.status_code == 401:
+                raise AccessError
+            if query.status_code != 200:
+                raise ExportUnavailableError('status {}'.format(query.status_code))
+            datasets = jsonstream.iter_json_array(query.iter_content(chunk_size=CATALOG_EXPORT_CHUNK_SIZE))
+            results = [{'dataset_id': dataset['dataset_id']} for dataset in datasets]
+            etag = query.headers.get('ETag')
+            last_modified = query.headers.get('Last-Modified')
+    except CATALOG_STREAM_ERRORS as error:
+        raise ExportUnavailableError(type(error).__name__) from error
+    return {'total_count': len(results), 'results': results}, etag, last_modified
+
+
+def import_dataset_list_paginated(ods_client, params):
+    """Fetch the catalog of the domain page by page, up to the API query size limit."""
+    params = dict(params, limit=V2_API_CHUNK_SIZE)
+    json_dataset = ods_client.get('catalog/datasets', params).json()
     total_count = json_dataset['total_count']
     params['offset'] = V2_API_CHUNK_SIZE
-    query_size_limit = V2_QUERY_SIZE_LIMIT_DATA_OPENDATASOFT if domain_url == 'data.opendatasoft.com' else V2_QUERY_SIZE_LIMIT - V2_API_CHUNK_SIZE
-    while params['offset'] <= total_count and params['offset'] < query_size_limit:
-        query = requests.get("https://{}/api/explore/v2.1/catalog/datasets".format(domain_url),
-                             params=params,
-                             headers=headers)
-        if query.status_code >= 500:
-            raise InternalError
-        json_dataset['results'] += query.json()['results']
+    query_size_limit = catalog_query_size_limit(ods_client.domain_url)
+    while params['offset'] < total_count and params['offset'] + V2_API_CHUNK_SIZE <= query_size_limit:
+        json_dataset['results'] += ods_client.get('catalog/datasets', params).json()['results']
         params['offset'] += V2_API_CHUNK_SIZE
     return json_dataset
 
 
+def index_catalog(domain_url, apikey, force_refresh=False):
+    """
+    Store the metadata and fields of every dataset of the domain in the local catalog index, unless
+    it was indexed less than a TTL ago and force_refresh is not set. Returns the number of datasets
+    indexed, None when the index was fresh.
+    """
+    index = catalog_index.default_catalog_index()
+    scope = index.scope(domain_url, apikey)
+    if not force_refresh and index.is_fresh(scope):
+        return None
+    ods_client = client.get_client(domain_url, apikey)
+    with instrumentation.phase('catalog index', domain=domain_url) as metrics:
+        try:
+            metrics['datasets'] = index.replace(scope, domain_url, import_catalog_datasets_from_export(ods_client))
+            metrics['source'] = 'export'
+        except ExportUnavailableError as error:
+            record_export_fallback(domain_url, error)
+            metrics['datasets'] = index.replace(scope, domain_url, import_catalog_datasets_paginated(ods_client))
+            metrics['source'] = 'paginated'
+    return metrics['datasets']
+
+
+def index_catalog_in_background(domain_url, apikey, force_refresh=False):
+    """Start index_catalog in a background task if the index of the domain is missing or stale."""
+    index = catalog_index.default_catalog_index()
+    scope = index.scope(domain_url, apikey)
+    if (not force_refresh and index.is_fresh(scope)) or scope in tasks.CatalogIndexTask.running_scopes:
+        return None
+    task = tasks.CatalogIndexTask(domain_url, scope, functools.partial(index_catalog, domain_url, apikey, True))
+    tasks.start_task(task)
+    return task
+
+
+def import_catalog_datasets_from_export(ods_client):
+    """Stream the metadata and fields of every dataset of the catalog export, without any size limit."""
+    try:
+        with ods_client.send('catalog/exports/json', stream=True) as query:
+            if query.status_code == 401:
+                raise AccessError
+            if query.status_code != 200:
+                raise ExportUnavailableError('status {}'.format(query.status_code))
+            for dataset in jsonstream.iter_json_array(query.iter_content(chunk_size=CATALOG_EXPORT_CHUNK_SIZE)):
+                yield dataset
+    except CATALOG_STREAM_ERRORS as error:
+        raise ExportUnavailableError(type(error).__name__) from error
+
+
+def record_export_fallback(domain_url, error):
+    """Record that the catalog export of a domain could not be read, the paginated catalog being read instead."""
+    instrumentation.record('fallback', domain_url, endpoint='catalog/exports/json', reason=str(error))
+
+
+def import_catalog_datasets_paginated(ods_client):
+    """
+    Fetch the metadata and fields of the datasets of the catalog page by page, CATALOG_PAGE_WORKERS
+    pages at a time, up to the API query size limit. Pages are sorted by identifier, so that
+    concurrent offsets neither skip nor repeat datasets.
+    """
+    params = {'limit': V2_API_CHUNK_SIZE, 'order_by': 'dataset_id'}
+    first_page = ods_client.get('catalog/datasets', params).json()
+    for dataset in first_page['results']:
+        yield dataset
+    last_offset = min(first_page['total_count'], catalog_query_size_limit(ods_client.domain_url))
+    offsets = range(V2_API_CHUNK_SIZE, last_offset, V2_API_CHUNK_SIZE)
+    with ThreadPoolExecutor(max_workers=CATALOG_PAGE_WORKERS) as executor:
+        pages = executor.map(lambda offset: ods_client.get('catalog/datasets', dict(
+            params, limit=min(V2_API_CHUNK_SIZE, last_offset - offset), offset=offset)).json(), offsets)
+        for page in pages:
+            for dataset in page['results']:
+                yield dataset
+
+
+def indexed_dataset_search(domain_url, apikey, include_non_geo_dataset, text_search_param):
+    """
+    search(offset, limit) function returning a page of the dataset identifiers matching the query
+    in the local catalog index, with their total count. None when the domain was never indexed.
+    """
+    index = catalog_index.default_catalog_index()
+    scope = index.scope(domain_url, apikey)
+    if index.indexed_at(scope) is None:
+        return None
+    return lambda offset, limit: index.search(scope, text_search_param, not include_non_geo_dataset,
+                                              offset=offset, limit=limit)
+
+
+def indexed_dataset_metadata(domain_url, dataset_id, apikey):
+    """Metadata of a dataset from the local catalog index, None if it is not indexed."""
+    index = catalog_index.default_catalog_index()
+    return index.metadata(index.scope(domain_url, apikey), dataset_id)
+
+
 def datasets_to_dataset_id_list(json_dataset):
     dataset_id_list = [dataset['dataset_id'] for dataset in json_dataset['results']]
     return dataset_id_list
@@ -76,16 +254,8 @@ def datasets_to_dataset_id_list(json_dataset):
 def import_dataset_metadata(domain_url, dataset_id, apikey):
     """HTTP call to Opendatasoft Explore API to fetch the metadata of a given dataset."""
     params = {'where': 'datasetid:"{}"'.format(dataset_id)}
-    headers = {}
-    if apikey:
-        headers['Authorization'] = 'apikey {}'.format(apikey)
-    try:
-        query = requests.get("https://{}/api/explore/v2.1/catalog/datasets".format(domain_url),
-                             params=params,
-                             headers=headers)
-    except requests.exceptions.ConnectionError:
-        raise DomainError
-    if query.status_code == 404 or query.json()['total_count'] == 0:
+    query = client.get_client(domain_url, apikey).get('catalog/datasets', params, not_found_error=DatasetError)
+    if query.json()['total_count'] == 0:
         raise DatasetError
     return query.json()
 
@@ -93,16 +263,9 @@ def import_dataset_metadata(domain_url, dataset_id, apikey):
 def import_first_record(domain_url, dataset_id, apikey):
     """HTTP call to Opendatasoft Explore API to fetch the first record of a given dataset."""
     params = {'limit': 1}
-    headers = {}
-    if apikey:
-        headers['Authorization'] = 'apikey {}'.format(apikey)
-    try:
-        query = requests.get("https://{}/api/explore/v2.1/catalog/datasets/{}/records".format(domain_url, dataset_id),
-                             params=params,
-                             headers=headers)
-    except requests.exceptions.ConnectionError:
-        raise DomainError
-    if query.status_code == 404 or query.json()['total_count'] == 0:
+    query = client.get_client(domain_url, apikey).get('catalog/datasets/{}/records'.format(dataset_id), params,
+                                                       not_found_error=DatasetError)
+    if query.json()['total_count'] == 0:
         raise DatasetError
     return query.json()
 
@@ -117,6 +280,25 @@ def get_geom_column(metadata):
     return None
 
 
+def export_field_types(fields, params):
+    """
+    Opendatasoft types of the fields of an export, {field name: type}, used to create the fields of
+    the layer with explicit types. Empty when the select computes or renames fields, whose types are unknown.
+    """
+    select = params.get('select') or ''
+    if '(' in select or re.search(r'\bas\b', select, re.IGNORECASE):
+        return {}
+    return {field['name']: field['type'] for field in fields}
+
+
+def pruned_select(field_names, geom_column=None):
+    """select of an export keeping only field_names and the geometry field."""
+    kept_fields = list(field_names)
+    if geom_column and geom_column not in kept_fields:
+        kept_fields.append(geom_column)
+    return ','.join('`{}`'.format(field_name) for field_name in kept_fields)
+
+
 def create_new_ods_auth_config(apikey):
 
     auth_manager = QgsApplication.authManager()
@@ -136,6 +318,31 @@ def remove_ods_auth_config():
             break
 
 
+def session_state():
+    """
+    Dialog inputs saved by the last import, None if there are none. The state saved by older
+    versions of the plugin, which held the whole dataset list, is compacted the first time it is read.
+    """
+    settings = QSettings()
+    if not settings.contains(SESSION_STATE_SETTINGS_KEY):
+        return None
+    state = settings.value(SESSION_STATE_SETTINGS_KEY)
+    if not isinstance(state, dict):
+        return None
+    dataset_state = state.get('dataset_id') or {}
+    if 'items' in dataset_state:
+        items = dataset_state['items']
+        index = dataset_state.get('index', 0)
+        state['dataset_id'] = {'value': items[index] if 0 < index < len(items) else ''}
+        save_session_state(state)
+    return state
+
+
+def save_session_state(state):
+    """Save the dialog inputs, which must stay small: they are read each time the dialog opens."""
+    QSettings().setValue(SESSION_STATE_SETTINGS_KEY, state)
+
+
 def get_apikey_from_cache():
     auth_manager = QgsApplication.authManager()
     config_dict = auth_manager.availableAuthMethodConfigs()
@@ -148,88 +355,289 @@ def get_apikey_from_cache():
     return apikey
 
 
-def import_dataset_to_qgis(domain, dataset_id, params):
-    try:
-        params_no_limit = dict(params)
-        if 'limit' in params_no_limit.keys():
-            params_no_limit.pop('limit')
-        test_query = requests.get("https://{}/api/explore/v2.1/catalog/datasets/{}/records".format(domain, dataset_id),
-                                  params_no_limit)
-
-    except (requests.exceptions.ConnectionError, requests.exceptions.InvalidURL):
-        raise DomainError
-    if test_query.status_code == 404:
-        raise DatasetError
-    if test_query.status_code == 400:
-        QtWidgets.QMessageBox.information(None, "ERROR:", test_query.json()['message'])
-        raise OdsqlError
-    if test_query.status_code == 401:
-        raise AccessError
+def import_dataset_to_qgis(domain, dataset_id, params, export_format=writers.GEOJSON):
+    """
+    Validate the query with a cheap pre-flight request, then open the export stream of the dataset
+    in export_format (one of writers.EXPORT_FORMATS, other than auto).
+    Returns the streamed response along with the number of records it is expected to contain.
+    """
+    params = dict(params)
+    ods_client = client.get_client(domain, params.pop('apikey', None))
+    limit = get_limit(params)
+
+    records_count = count_records(ods_client, dataset_id, params)
+    if limit != -1:
+        records_count = min(records_count, limit)
+
+    imported_dataset = ods_client.get('catalog/datasets/{}/exports/{}'.format(dataset_id, export_format), params,
+                                      stream=True, not_found_error=DatasetError)
+    return imported_dataset, records_count
+
+
+def import_partitioned_dataset_to_qgis(domain, dataset_id, params, partition_field, partitions_count):
+    """
+    Validate the query, then split it into disjoint partitions on the values of partition_field,
+    to be downloaded concurrently. Returns the client, the query of each partition and the number
+    of records expected in total.
+    """
+    params = dict(params)
+    ods_client = client.get_client(domain, params.pop('apikey', None))
+    records_count = count_records(ods_client, dataset_id, params)
+    partition_params = partitions.partition_params(ods_client, dataset_id, params, partition_field, partitions_count)
+    return ods_client, partition_params, records_count
+
+
+def add_viewport_layer_to_qgis(iface, domain, dataset_id, params, geom_column):
+    """
+    Validate the query, then add a layer only showing the records inside the map view, fetched
+    again as the view moves. Returns the controller keeping the layer up to date.
+    """
+    if not geom_column:
+        raise GeometryFieldError
+    params = dict(params)
+    ods_client = client.get_client(domain, params.pop('apikey', None))
+    count_records(ods_client, dataset_id, params)
+    return viewport_layer.ViewportLayerController(iface, ods_client, dataset_id, params, geom_column)
+
+
+def import_clustered_dataset_to_qgis(domain, dataset_id, params, geom_column, geom_type,
+                                     precision=clusters.DEFAULT_PRECISION, aggregates='', extent=None):
+    """
+    Open the export stream of the records grouped by geo cluster of a point dataset, instead of
+    the records themselves. Only the where clause of params is kept. Returns the streamed response
+    along with the query to store on the summary layer, to run it again at a finer precision.
+    """
+    if geom_type != 'geo_point_2d':
+        raise PointFieldError
+    params = dict(params)
+    ods_client = client.get_client(domain, params.pop('apikey', None))
+    clustered_params = clusters.cluster_params(params, geom_column, precision, aggregates, extent)
+    imported_dataset = ods_client.get('catalog/datasets/{}/exports/json'.format(dataset_id), clustered_params,
+                                      stream=True, not_found_error=DatasetError)
+    cluster_query = {'domain': domain, 'dataset_id': dataset_id, 'where': params.get('where'),
+                     'geom_column': geom_column, 'precision': precision, 'aggregates': aggregates}
+    return imported_dataset, cluster_query
+
+
+def refine_clustered_layer_to_qgis(iface, layer):
+    """
+    Run the query of a summary layer again at a finer precision, restricted to the map view.
+    Returns the started task, or None when the layer is not a summary layer.
+    """
+    cluster_query = layer.customProperty(clusters.LAYER_PROPERTY)
+    if not cluster_query:
+        return None
+    cluster_query = json.loads(cluster_query)
+    canvas = iface.mapCanvas()
+    transform = QgsCoordinateTransform(canvas.mapSettings().destinationCrs(),
+                                       QgsCoordinateReferenceSystem('EPSG:4326'), QgsProject.instance())
+    extent = transform.transformBoundingBox(canvas.extent())
+    params = {'where': cluster_query['where']} if cluster_query['where'] else {}
+    apikey = get_apikey_from_cache()
+    if apikey:
+        params['apikey'] = apikey
+    imported_dataset, refined_query = import_clustered_dataset_to_qgis(
+        cluster_query['domain'], cluster_query['dataset_id'], params, cluster_query['geom_column'], 'geo_point_2d',
+        clusters.refined_precision(cluster_query['precision']), cluster_query['aggregates'],
+        (max(extent.xMinimum(), -180), max(extent.yMinimum(), -90),
+         min(extent.xMaximum(), 180), min(extent.yMaximum(), 90)))
+    return load_clustered_dataset_to_qgis('', cluster_query['dataset_id'], imported_dataset, refined_query)
 
-    if 'limit' in params:
-        try:
-            limit = int(params['limit'])
-        except ValueError:
-            raise NumberOfLinesError
-        if limit < -1:
-            raise NumberOfLinesError
 
-    imported_dataset = requests.get("https://{}/api/explore/v2.1/catalog/datasets/{}/exports/geojson".format(domain, dataset_id),
-                                    params, stream=True)
-    return imported_dataset
+def can_partition(params):
+    """Partitions are merged one after the other, which cannot honor a limit or an ordering."""
+    return get_limit(params) == -1 and 'order_by' not in params
 
 
-def load_dataset_to_qgis(path, dataset_id, imported_dataset):
-    cancel_import_dialog = ui_methods.CancelImportDialog()
+def get_limit(params):
+    if 'limit' not in params:
+        return -1
     try:
-        file_path = path
-        if file_path == "":
-            file = tempfile.NamedTemporaryFile(suffix='.geojson')
-            file.close()
-            file_path = file.name
-        downloaded = 0
-        timer = QElapsedTimer()
-        timer.start()
-        with open(file_path, 'wb') as f:
-            for chunk in imported_dataset.iter_content(chunk_size=1024 * 64):
-                f.write(chunk)
-                downloaded += len(chunk)
-                QCoreApplication.processEvents()
-                cancel_import_dialog.chunkLabel.setText(
-                    'Downloaded: {}MB\nSpeed: {:.2f}kB/s'.format(
-                        downloaded // 1024 // 1024,
-                        (downloaded / 1024) / (timer.elapsed() / 1000)))
-                if cancel_import_dialog.isCanceled:
-                    return
-
-    except FileNotFoundError:
-        raise FileNotFoundError
-    except PermissionError:
-        raise PermissionError
-
-    vector_layer = QgsVectorLayer(file_path, dataset_id, "ogr")
-    QgsProject.instance().addMapLayer(vector_layer)
-
-
-class DomainError(Exception):
-    pass
-
-
-class OdsqlError(Exception):
-    pass
-
-
-class NumberOfLinesError(Exception):
-    pass
-
-
-class DatasetError(Exception):
-    pass
-
-
-class AccessError(Exception):
-    pass
-
-
-class InternalError(Exception):
-    pass
+        limit = int(params['limit'])
+    except ValueError:
+        raise NumberOfLinesError
+    if limit < -1:
+        raise NumberOfLinesError
+    return limit
+
+
+def count_records(ods_client, dataset_id, params):
+    """
+    Zero-row records query: the server validates the ODSQL clauses of the export and
+    only returns the number of matching records.
+    """
+    count_params = {key: value for key, value in params.items() if key in ('select', 'where', 'order_by')}
+    count_params['limit'] = 0
+    query = ods_client.get('catalog/datasets/{}/records'.format(dataset_id), count_params, not_found_error=DatasetError)
+    return query.json()['total_count']
+
+
+def refresh_dataset_to_qgis(domain, dataset_id, params, output_format, timestamp_field=None, key_field=None):
+    """
+    Refresh a dataset imported before with the same query instead of downloading it again:
+    - when its modification metadata did not change, the stored layer is reused as it is
+    - otherwise, when a timestamp field is given and the layer is a GeoPackage, only the records
+      with a newer timestamp are downloaded and upserted into the layer, on key_field if given.
+      With a key_field, the records of the last timestamp are downloaded again too, so that records
+      added with that timestamp after the previous import are not missed: the upsert replaces them.
+    Returns False when the dataset has to be imported in full.
+    """
+    params = dict(params)
+    apikey = params.pop('apikey', None)
+    store = dataset_store.default_dataset_store()
+    key = store.key(domain, dataset_id, params)
+    entry = store.get(key)
+    if entry is None or entry['output_format'] != output_format:
+        return False
+
+    signature = dataset_store.modification_signature(import_dataset_metadata(domain, dataset_id, apikey))
+    if signature is not None and signature == entry['signature']:
+        tasks.add_layer_to_project(entry['file_path'], output_format, dataset_id)
+        return True
+    if output_format != writers.GEOPACKAGE or not timestamp_field or timestamp_field != entry['timestamp_field'] \
+            or entry['last_timestamp'] is None or get_limit(params) != -1:
+        return False
+
+    ods_client = client.get_client(domain, apikey)
+    last_timestamp = max_value(ods_client, dataset_id, params, timestamp_field)
+    newer_records = '`{}` {} {}'.format(timestamp_field, '>=' if key_field else '>',
+                                        odsql_literal(entry['last_timestamp']))
+    delta_params = dict(params, where='({}) and ({})'.format(params['where'], newer_records) if 'where' in params
+                        else newer_records)
+    records_count = count_records(ods_client, dataset_id, delta_params)
+    imported_dataset = ods_client.get('catalog/datasets/{}/exports/geojson'.format(dataset_id), delta_params,
+                                      stream=True, not_found_error=DatasetError)
+
+    task = tasks.RefreshDatasetTask(dataset_id, imported_dataset, entry['file_path'], records_count, key_field)
+    task.cancelImportDialog = ui_methods.CancelImportDialog(task)
+    task.taskCompleted.connect(functools.partial(
+        store.put, key, dict(entry, signature=signature, last_timestamp=last_timestamp)))
+    tasks.start_task(task)
+    return True
+
+
+def stored_import_entry(domain, dataset_id, params, output_format, timestamp_field=None):
+    """
+    Dataset store entry describing a full import, to be taken before the export starts so that
+    records added during the download are caught by the next refresh.
+    """
+    params = dict(params)
+    apikey = params.pop('apikey', None)
+    last_timestamp = None
+    if timestamp_field:
+        last_timestamp = max_value(client.get_client(domain, apikey), dataset_id, params, timestamp_field)
+    entry = {'output_format': output_format,
+             'signature': dataset_store.modification_signature(import_dataset_metadata(domain, dataset_id, apikey)),
+             'timestamp_field': timestamp_field,
+             'last_timestamp': last_timestamp}
+    return dataset_store.DatasetStore.key(domain, dataset_id, params), entry
+
+
+def remember_import(task, key, entry):
+    """Record the import of a task in the dataset store once it completes."""
+    store = dataset_store.default_dataset_store()
+    task.taskCompleted.connect(functools.partial(store.put, key, dict(entry, file_path=task.file_path)))
+
+
+def max_value(ods_client, dataset_id, params, field):
+    max_params = {'select': 'max(`{}`) as max_value'.format(field)}
+    if 'where' in params:
+        max_params['where'] = params['where']
+    query = ods_client.get('catalog/datasets/{}/records'.format(dataset_id), max_params, not_found_error=DatasetError)
+    return query.json()['results'][0]['max_value']
+
+
+def odsql_literal(value):
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "date'{}'".format(value)
+
+
+def load_dataset_to_qgis(path, dataset_id, imported_dataset, records_count=None, output_format=writers.GEOJSON,
+                         export_format=writers.GEOJSON, geom_column=None, progressive=False, field_types=None):
+    """
+    Start the download of the export in a background task, the layer is added to the current
+    project once the download completes, or as soon as its first records are written when
+    progressive is set and the export can be rendered progressively. geom_column is needed to build
+    the geometries of JSONL exports, field_types (see export_field_types) types the fields of
+    exports converted to GeoPackage. Returns the started task.
+    """
+    if progressive and writers.can_render_progressively(output_format, export_format):
+        task = tasks.ProgressiveImportDatasetTask(dataset_id, imported_dataset, prepare_file_path(path, output_format),
+                                                  records_count, export_format, geom_column, field_types)
+    else:
+        task = tasks.ImportDatasetTask(dataset_id, imported_dataset, prepare_file_path(path, output_format),
+                                       records_count, output_format, export_format, geom_column, field_types)
+    task.cancelImportDialog = ui_methods.CancelImportDialog(task)
+    tasks.start_task(task)
+    return task
+
+
+def load_partitioned_dataset_to_qgis(path, dataset_id, ods_client, partition_params, records_count=None,
+                                     output_format=writers.GEOJSON, field_types=None):
+    """Same as load_dataset_to_qgis, downloading the partitions of the export concurrently."""
+    task = tasks.PartitionedImportDatasetTask(dataset_id, ods_client, partition_params,
+                                              prepare_file_path(path, output_format), records_count, output_format,
+                                              field_types)
+    task.cancelImportDialog = ui_methods.CancelImportDialog(task)
+    tasks.start_task(task)
+    return task
+
+
+def load_clustered_dataset_to_qgis(path, dataset_id, imported_dataset, cluster_query, output_format=writers.GEOJSON):
+    """Same as load_dataset_to_qgis for a clustered export, the query being stored on the summary layer."""
+    task = tasks.ClusterImportTask(dataset_id, imported_dataset, prepare_file_path(path, output_format), output_format)
+    task.layer_properties[clusters.LAYER_PROPERTY] = json.dumps(cluster_query)
+    task.cancelImportDialog = ui_methods.CancelImportDialog(task)
+    tasks.start_task(task)
+    return task
+
+
+def load_datasets_batch_to_qgis(path, domain, dataset_ids, params, output_format=writers.GEOJSON,
+                                export_format=writers.AUTO, max_workers=tasks.MAX_PARALLEL_IMPORTS):
+    """
+    Start the download of several datasets in a single background task, at most max_workers at
+    a time. With a path, each dataset is saved as <dataset_id>.<output_format> in its folder.
+    Returns the started task.
+    """
+    file_paths = {dataset_id: prepare_file_path(batch_file_path(path, dataset_id, output_format), output_format)
+                  for dataset_id in dataset_ids}
+    open_export = functools.partial(open_dataset_export, domain, params, export_format, output_format)
+    task = tasks.BatchImportTask(dataset_ids, open_export, file_paths, output_format, max_workers)
+    task.cancelImportDialog = ui_methods.CancelImportDialog(task)
+    tasks.start_task(task)
+    return task
+
+
+def open_dataset_export(domain, params, export_format, output_format, dataset_id):
+    """Open the export of one dataset of a batch, from a download thread."""
+    export_format = writers.resolve_export_format(export_format)
+    geom_column = None
+    field_types = None
+    if export_format == writers.JSONL or writers.needs_field_types(output_format, export_format):
+        metadata = import_dataset_metadata(domain, dataset_id, params.get('apikey'))
+        if writers.needs_field_types(output_format, export_format):
+            field_types = export_field_types(metadata['results'][0]['fields'], params)
+        if export_format == writers.JSONL:
+            geom_column = get_geom_column(metadata)
+    imported_dataset, records_count = import_dataset_to_qgis(domain, dataset_id, params, export_format)
+    return imported_dataset, records_count, export_format, geom_column, field_types
+
+
+def batch_file_path(path, dataset_id, output_format):
+    if path == "":
+        return path
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    return os.path.join(directory, '{}.{}'.format(writers.layer_name_for(dataset_id), output_format))
+
+
+def prepare_file_path(path, output_format=writers.GEOJSON):
+    file_path = path
+    if file_path == "":
+        file = tempfile.NamedTemporaryFile(suffix='.{}'.format(output_format))
+        file.close()
+        file_path = file.name
+    # Raises FileNotFoundError or PermissionError right away rather than from the background task,
+    # without truncating the partial file of a download to resume
+    open(file_path, 'ab' if resumable.has_checkpoint(file_path) else 'wb').close()
+    return file_path
@@ -0,0 +1,300 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import hashlib
+import json
+import math
+import os
+from collections import Counter, OrderedDict
+
+import requests
+from PyQt5.QtCore import QObject, QTextCodec, QTimer
+from qgis.core import (QgsApplication, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsJsonUtils,
+                       QgsMessageLog, QgsProject, QgsTask, QgsVectorLayer, QgsWkbTypes)
+
+from . import catalog_cache, jsonstream
+from .exceptions import AccessError, DatasetError, DomainError, InternalError, OdsqlError, RequestTimeoutError
+
+DEBOUNCE_DELAY = 300
+TILES_PER_VIEW = 4
+MAX_ZOOM = 18
+TILE_RECORD_LIMIT = 10000
+# Features of the tiles kept in memory, tiles in view being kept whatever their size
+MEMORY_CACHE_MAX_FEATURES = 200000
+DISK_CACHE_DIRECTORY_NAME = 'ods_tile_cache'
+DISK_CACHE_TTL = 24 * 60 * 60
+DISK_CACHE_MAX_SIZE = 200 * 1024 * 1024
+WGS84 = QgsCoordinateReferenceSystem('EPSG:4326')
+FETCH_ERRORS = (OSError, ValueError, requests.exceptions.RequestException, AccessError, DatasetError, DomainError,
+                InternalError, OdsqlError, RequestTimeoutError)
+
+# Controllers live as long as their layer is in the project
+_controllers = set()
+
+
+class TileCache(catalog_cache.JsonFileCache):
+    """On-disk cache of the features of tiles, one JSON file per tile of a query."""
+    def put(self, key, features):
+        return self.store(key, {'features': features})
+
+
+def tile_key(domain_url, apikey, dataset_id, params, geom_column, tile):
+    """Key of the features of a tile, which depend on the records the API key has access to."""
+    raw_key = json.dumps([domain_url, catalog_cache.apikey_identity(apikey), dataset_id, params, geom_column, tile],
+                         sort_keys=True)
+    return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+
+def feature_key(feature):
+    """Identity of a feature, shapes crossing tile borders being returned by every tile they intersect."""
+    return json.dumps(feature, sort_keys=True)
+
+
+def tile_bounds(tile):
+    """(lon_min, lat_min, lon_max, lat_max) of a (zoom, x, y) tile of a regular lon/lat grid."""
+    zoom, x, y = tile
+    size = 360 / 2 ** zoom
+    return -180 + x * size, -90 + y * size, -180 + (x + 1) * size, -90 + (y + 1) * size
+
+
+def visible_tiles(lon_min, lat_min, lon_max, lat_max):
+    """Tiles covering an extent, at the zoom where about TILES_PER_VIEW tiles span its width."""
+    width = max(lon_max - lon_min, lat_max - lat_min, 1e-9)
+    zoom = min(max(int(math.floor(math.log2(360 * TILES_PER_VIEW / width))), 0), MAX_ZOOM)
+    size = 360 / 2 ** zoom
+    x_range = range(max(int((lon_min + 180) // size), 0), min(int((lon_max + 180) // size), 2 ** zoom - 1) + 1)
+    # Tiles are square, so the grid has half as many rows as columns
+    rows = max(2 ** zoom // 2, 1)
+    y_range = range(max(int((lat_min + 90) // size), 0), min(int((lat_max + 90) // size), rows - 1) + 1)
+    return [(zoom, x, y) for x in x_range for y in y_range]
+
+
+class TileFetchTask(QgsTask):
+    """Fetch the features of one tile in a background thread."""
+    def __init__(self, ods_client, dataset_id, params, geom_column, tile):
+        super(TileFetchTask, self).__init__('Fetch {} tile {}'.format(dataset_id, tile), QgsTask.CanCancel)
+        self.ods_client = ods_client
+        self.dataset_id = dataset_id
+        self.params = params
+        self.geom_column = geom_column
+        self.tile = tile
+        self.features = None
+        # Whether the tile has more than TILE_RECORD_LIMIT records, only the first ones being kept
+        self.truncated = False
+        self.error = None
+
+    def run(self):
+        lon_min, lat_min, lon_max, lat_max = tile_bounds(self.tile)
+        in_tile = 'in_bbox({}, {}, {}, {}, {})'.format(self.geom_column, lat_min, lon_min, lat_max, lon_max)
+        params = dict(self.params, limit=TILE_RECORD_LIMIT + 1)
+        params['where'] = '({}) and ({})'.format(params['where'], in_tile) if 'where' in params else in_tile
+        try:
+            with self.ods_client.get('catalog/datasets/{}/exports/geojson'.format(self.dataset_id), params,
+                                     stream=True, not_found_error=DatasetError) as response:
+                features = []
+                for feature in jsonstream.iter_json_array(response.iter_content(chunk_size=1024 * 64), 'features'):
+                    if self.isCanceled():
+                        return False
+                    features.append(feature)
+        except FETCH_ERRORS as error:
+            self.error = error
+            return False
+        self.truncated = len(features) > TILE_RECORD_LIMIT
+        self.features = features[:TILE_RECORD_LIMIT]
+        return True
+
+
+class ViewportLayerController(QObject):
+    """
+    Memory layer showing the records of a dataset inside the current map extent.
+    The extent is cut into tiles fetched with in_bbox queries once panning stops for DEBOUNCE_DELAY ms.
+    Tiles are kept in a memory LRU cache of at most MEMORY_CACHE_MAX_FEATURES features, backed by
+    a disk cache, and the requests of tiles which left the view are canceled. Tiles are limited to
+    TILE_RECORD_LIMIT records: the other records of a denser tile are shown once zoomed in.
+    The layer only gets the features it does not show yet, and loses the ones of the tiles which left the view.
+    """
+    def __init__(self, iface, ods_client, dataset_id, params, geom_column):
+        super(ViewportLayerController, self).__init__()
+        self.iface = iface
+        self.ods_client = ods_client
+        self.dataset_id = dataset_id
+        self.params = {key: value for key, value in params.items() if key in ('select', 'where')}
+        self.geom_column = geom_column
+        self.layer = None
+        # Feature identifiers in the layer, by feature_key()
+        self.feature_ids = {}
+        self.memory_cache = OrderedDict()
+        self.memory_cache_features = 0
+        self.disk_cache = TileCache(os.path.join(QgsApplication.qgisSettingsDirPath(), DISK_CACHE_DIRECTORY_NAME),
+                                    DISK_CACHE_TTL, DISK_CACHE_MAX_SIZE)
+        self.pending_tasks = {}
+        self.current_tiles = []
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(DEBOUNCE_DELAY)
+        self.debounce_timer.timeout.connect(self.updateTiles)
+        self.iface.mapCanvas().extentsChanged.connect(self.debounce_timer.start)
+        QgsProject.instance().layerWillBeRemoved.connect(self.layerRemoved)
+        _controllers.add(self)
+        self.updateTiles()
+
+    def tileKey(self, tile):
+        return tile_key(self.ods_client.domain_url, self.ods_client.apikey, self.dataset_id, self.params,
+                        self.geom_column, tile)
+
+    def updateTiles(self):
+        canvas = self.iface.mapCanvas()
+        transform = QgsCoordinateTransform(canvas.mapSettings().destinationCrs(), WGS84, QgsProject.instance())
+        extent = transform.transformBoundingBox(canvas.extent())
+        self.showTiles(visible_tiles(max(extent.xMinimum(), -180), max(extent.yMinimum(), -90),
+                                     min(extent.xMaximum(), 180), min(extent.yMaximum(), 90)))
+
+    def showTiles(self, tiles):
+        """Show the cached features of tiles, fetching the tiles which are not cached."""
+        self.current_tiles = tiles
+        for tile, task in list(self.pending_tasks.items()):
+            if tile not in self.current_tiles:
+                task.cancel()
+                del self.pending_tasks[tile]
+        for tile in self.current_tiles:
+            if self.cachedFeatures(tile) is None and tile not in self.pending_tasks:
+                self.fetchTile(tile)
+        self.refreshLayer()
+
+    def cachedFeatures(self, tile):
+        if tile in self.memory_cache:
+            self.memory_cache.move_to_end(tile)
+            return self.memory_cache[tile]
+        disk_entry = self.disk_cache.get(self.tileKey(tile))
+        if disk_entry and self.disk_cache.is_fresh(disk_entry):
+            self.storeFeatures(tile, disk_entry['features'], on_disk=False)
+            return disk_entry['features']
+        return None
+
+    def storeFeatures(self, tile, features, on_disk=True):
+        self.memory_cache_features += len(features) - len(self.memory_cache.get(tile, []))
+        self.memory_cache[tile] = features
+        self.memory_cache.move_to_end(tile)
+        for cached_tile in list(self.memory_cache):
+            if self.memory_cache_features <= MEMORY_CACHE_MAX_FEATURES:
+                break
+            if cached_tile not in self.current_tiles and cached_tile != tile:
+                self.memory_cache_features -= len(self.memory_cache.pop(cached_tile))
+        if on_disk:
+            self.disk_cache.put(self.tileKey(tile), features)
+
+    def fetchTile(self, tile):
+        task = TileFetchTask(self.ods_client, self.dataset_id, self.params, self.geom_column, tile)
+        task.taskCompleted.connect(lambda: self.tileFetched(task))
+        task.taskTerminated.connect(lambda: self.tileFailed(task))
+        self.pending_tasks[tile] = task
+        QgsApplication.taskManager().addTask(task)
+
+    def tileFetched(self, task):
+        if self.pending_tasks.get(task.tile) is task:
+            del self.pending_tasks[task.tile]
+        if task.truncated:
+            QgsMessageLog.logMessage(
+                'Tile {} of {} has more than {} records: only the first ones are shown, zoom in to see the others'
+                .format(task.tile, self.dataset_id, TILE_RECORD_LIMIT), 'Opendatasoft')
+        self.storeFeatures(task.tile, task.features)
+        if task.tile in self.current_tiles:
+            self.refreshLayer()
+
+    def tileFailed(self, task):
+        if self.pending_tasks.get(task.tile) is task:
+            del self.pending_tasks[task.tile]
+        if task.error:
+            QgsMessageLog.logMessage('Could not fetch tile {} of {}: {}'.format(task.tile, self.dataset_id, task.error),
+                                     'Opendatasoft')
+
+    def refreshLayer(self):
+        """Add the features of the visible tiles missing from the layer, and remove the other ones."""
+        features = OrderedDict()
+        for tile in self.current_tiles:
+            for feature in self.memory_cache.get(tile) or []:
+                features.setdefault(feature_key(feature), feature)
+        if self.layer is None:
+            if not features:
+                return
+            self.createLayer(list(features.values()))
+        removed_ids = [self.feature_ids.pop(key) for key in list(self.feature_ids) if key not in features]
+        new_features = OrderedDict((key, feature) for key, feature in features.items() if key not in self.feature_ids)
+        if not removed_ids and not new_features:
+            return
+        if removed_ids:
+            self.layer.dataProvider().deleteFeatures(removed_ids)
+        if new_features:
+            self.addFeatures(new_features)
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
+
+    def addFeatures(self, features):
+        """Add GeoJSON features, by feature_key(), to the layer. Features of another geometry type are skipped."""
+        keys, qgs_features = [], []
+        for key, qgs_feature in zip(features, self.toQgsFeatures(list(features.values()), self.layer.fields())):
+            if qgs_feature is not None and (not qgs_feature.hasGeometry()
+                                            or qgs_feature.geometry().wkbType() == self.layer.wkbType()):
+                keys.append(key)
+                qgs_features.append(qgs_feature)
+        if len(qgs_features) < len(features):
+            QgsMessageLog.logMessage(
+                '{} features of {} could not be read or are not of type {}: they are not shown'.format(
+                    len(features) - len(qgs_features), self.dataset_id,
+                    QgsWkbTypes.displayString(self.layer.wkbType())), 'Opendatasoft')
+        added, added_features = self.layer.dataProvider().addFeatures(qgs_features)
+        if added:
+            self.feature_ids.update(zip(keys, (qgs_feature.id() for qgs_feature in added_features)))
+
+    @staticmethod
+    def toQgsFeatures(features, fields):
+        """
+        QgsFeature of each GeoJSON feature, with a multi-part geometry, or None for features which could not be read.
+        """
+        codec = QTextCodec.codecForName('UTF-8')
+        qgs_features = QgsJsonUtils.stringToFeatureList(
+            json.dumps({'type': 'FeatureCollection', 'features': features}), fields, codec)
+        if len(qgs_features) != len(features):
+            # Features which could not be read are left out: read them one by one to know which ones
+            qgs_features = [next(iter(QgsJsonUtils.stringToFeatureList(json.dumps(feature), fields, codec)), None)
+                            for feature in features]
+        for qgs_feature in qgs_features:
+            if qgs_feature is not None and qgs_feature.hasGeometry():
+                geometry = qgs_feature.geometry()
+                geometry.convertToMultiType()
+                qgs_feature.setGeometry(geometry)
+        return qgs_features
+
+    def createLayer(self, features):
+        """Memory layer of the most frequent geometry type among features."""
+        codec = QTextCodec.codecForName('UTF-8')
+        fields = QgsJsonUtils.stringToFields(json.dumps({'type': 'FeatureCollection', 'features': features}), codec)
+        geometry_types = Counter(qgs_feature.geometry().wkbType()
+                                 for qgs_feature in self.toQgsFeatures(features, fields)
+                                 if qgs_feature is not None and qgs_feature.hasGeometry())
+        geometry_type = geometry_types.most_common(1)[0][0] if geometry_types else QgsWkbTypes.MultiPoint
+        self.layer = QgsVectorLayer('{}?crs=EPSG:4326'.format(QgsWkbTypes.displayString(geometry_type)),
+                                    self.dataset_id, 'memory')
+        self.layer.dataProvider().addAttributes(fields.toList())
+        self.layer.updateFields()
+        self.feature_ids = {}
+        QgsProject.instance().addMapLayer(self.layer)
+
+    def layerRemoved(self, layer_id):
+        if self.layer is None or layer_id != self.layer.id():
+            return
+        for task in self.pending_tasks.values():
+            task.cancel()
+        self.pending_tasks.clear()
+        self.iface.mapCanvas().extentsChanged.disconnect(self.debounce_timer.start)
+        QgsProject.instance().layerWillBeRemoved.disconnect(self.layerRemoved)
+        self.layer = None
+        self.feature_ids = {}
+        _controllers.discard(self)
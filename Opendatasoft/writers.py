@@ -0,0 +1,270 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+import os
+import re
+
+from osgeo import gdal, ogr, osr
+
+GEOJSON = 'geojson'
+GEOPACKAGE = 'gpkg'
+OUTPUT_FORMATS = {GEOJSON: 'GeoJSON', GEOPACKAGE: 'GeoPackage'}
+FILE_FILTERS = {GEOJSON: 'Geojson Files (*.geojson)', GEOPACKAGE: 'GeoPackage Files (*.gpkg)'}
+OGR_DRIVERS = {GEOJSON: 'GeoJSON', GEOPACKAGE: 'GPKG'}
+BATCH_SIZE = 10000
+# Smaller batches when the layer is shown while downloading, so that the first records appear quickly
+PROGRESSIVE_BATCH_SIZE = 2000
+
+AUTO = 'auto'
+FLATGEOBUF = 'fgb'
+PARQUET = 'parquet'
+JSONL = 'jsonl'
+EXPORT_FORMATS = {AUTO: 'Auto', GEOJSON: 'GeoJSON', FLATGEOBUF: 'FlatGeobuf', PARQUET: 'Parquet', JSONL: 'JSONL'}
+# Export formats downloaded as files and read by OGR, with the driver needed to read them
+BINARY_EXPORT_DRIVERS = {FLATGEOBUF: 'FlatGeobuf', PARQUET: 'Parquet'}
+# OGR type and subtype of the fields of each Opendatasoft field type, other types being written as text
+ODS_FIELD_TYPES = {
+    'int': (ogr.OFTInteger64, ogr.OFSTNone),
+    'double': (ogr.OFTReal, ogr.OFSTNone),
+    'boolean': (ogr.OFTInteger, ogr.OFSTBoolean),
+    'date': (ogr.OFTDate, ogr.OFSTNone),
+    'datetime': (ogr.OFTDateTime, ogr.OFSTNone),
+    'json': (ogr.OFTString, ogr.OFSTJSON),
+    'file': (ogr.OFTString, ogr.OFSTJSON),
+    'geo_point_2d': (ogr.OFTString, ogr.OFSTJSON),
+    'geo_shape': (ogr.OFTString, ogr.OFSTJSON),
+}
+
+
+class GeoJSONWriter:
+    """Write features one by one into a GeoJSON FeatureCollection."""
+    def __init__(self, file_path, layer_name=None):
+        self.file = open(file_path, 'w', encoding='utf-8')
+        self.file.write('{"type": "FeatureCollection", "features": [')
+        self.count = 0
+
+    def write(self, feature):
+        if self.count:
+            self.file.write(',\n')
+        json.dump(feature, self.file, ensure_ascii=False)
+        self.count += 1
+
+    def close(self):
+        self.file.write(']}\n')
+        self.file.close()
+
+
+class GeoPackageWriter:
+    """
+    Write GeoJSON features into a GeoPackage layer with a spatial index, committing them in
+    transactions of batch_size features so that memory stays bounded whatever the dataset size.
+    Fields are created from the properties of the features as they show up, with the type given by
+    field_types ({field name: Opendatasoft field type}) if known, guessed from their first value otherwise.
+    on_commit(count) is called after each committed batch, when the features written so far can be
+    read by other connections.
+    """
+    def __init__(self, file_path, layer_name, batch_size=BATCH_SIZE, append=False, on_commit=None,
+                 field_types=None):
+        if append:
+            self.data_source = ogr.Open(file_path, update=1)
+            self.layer = self.data_source.GetLayerByName(layer_name_for(layer_name)) if self.data_source else None
+            if self.layer is None:
+                raise OSError('No layer {} to update in {}'.format(layer_name, file_path))
+            layer_definition = self.layer.GetLayerDefn()
+            self.field_names = {layer_definition.GetFieldDefn(index).GetName()
+                                for index in range(layer_definition.GetFieldCount())}
+        else:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            self.data_source = ogr.GetDriverByName('GPKG').CreateDataSource(file_path)
+            spatial_reference = osr.SpatialReference()
+            spatial_reference.ImportFromEPSG(4326)
+            spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            self.layer = self.data_source.CreateLayer(layer_name_for(layer_name), spatial_reference, ogr.wkbUnknown,
+                                                      ['GEOMETRY_NAME=geom', 'SPATIAL_INDEX=YES'])
+            self.field_names = set()
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        self.field_types = field_types or {}
+        self.count = 0
+        self.layer.StartTransaction()
+
+    def write(self, feature):
+        properties = feature.get('properties') or {}
+        for name, value in properties.items():
+            if name not in self.field_names:
+                self.add_field(name, value)
+        ogr_feature = ogr.Feature(self.layer.GetLayerDefn())
+        for name, value in properties.items():
+            if value is None:
+                continue
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, ensure_ascii=False)
+            ogr_feature.SetField(name, value)
+        if feature.get('geometry'):
+            ogr_feature.SetGeometry(ogr.CreateGeometryFromJson(json.dumps(feature['geometry'])))
+        self.layer.CreateFeature(ogr_feature)
+        self.count += 1
+        if self.count % self.batch_size == 0:
+            self.layer.CommitTransaction()
+            if self.on_commit is not None:
+                self.on_commit(self.count)
+            self.layer.StartTransaction()
+
+    def delete_where_in(self, field_name, values):
+        """Delete the features whose field_name is one of values, e.g. before writing their new version."""
+        if field_name not in self.field_names or not values:
+            return
+        self.data_source.ExecuteSQL('DELETE FROM "{}" WHERE "{}" IN ({})'.format(
+            self.layer.GetName(), field_name, ','.join(sql_literal(value) for value in values)))
+
+    def add_field(self, name, value):
+        if name in self.field_types:
+            field_type, field_subtype = ODS_FIELD_TYPES.get(self.field_types[name], (ogr.OFTString, ogr.OFSTNone))
+        else:
+            field_type = ogr_field_type(value)
+            field_subtype = ogr.OFSTBoolean if isinstance(value, bool) else ogr.OFSTNone
+        field_definition = ogr.FieldDefn(name, field_type)
+        field_definition.SetSubType(field_subtype)
+        self.layer.CreateField(field_definition)
+        self.field_names.add(name)
+
+    def close(self):
+        self.layer.CommitTransaction()
+        self.layer = None
+        self.data_source = None
+
+
+def ogr_field_type(value):
+    if isinstance(value, bool):
+        return ogr.OFTInteger
+    if isinstance(value, int):
+        return ogr.OFTInteger64
+    if isinstance(value, float):
+        return ogr.OFTReal
+    return ogr.OFTString
+
+
+def sql_literal(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def layer_name_for(dataset_id):
+    return re.sub(r'\W', '_', dataset_id)
+
+
+def layer_uri(file_path, output_format, dataset_id):
+    """Data source of the QgsVectorLayer reading a file written in output_format."""
+    if output_format == GEOPACKAGE:
+        return '{}|layername={}'.format(file_path, layer_name_for(dataset_id))
+    return file_path
+
+
+def output_format_for(file_path):
+    """Output format matching the extension of file_path, GeoJSON by default."""
+    extension = os.path.splitext(file_path)[1].lstrip('.').lower()
+    return extension if extension in OUTPUT_FORMATS else GEOJSON
+
+
+def open_writer(file_path, output_format, layer_name, batch_size=BATCH_SIZE, on_commit=None, field_types=None):
+    """Writer of output_format, field_types being only needed by GeoPackage: GeoJSON values carry their own types."""
+    if output_format == GEOPACKAGE:
+        return GeoPackageWriter(file_path, layer_name, batch_size, on_commit=on_commit, field_types=field_types)
+    return GeoJSONWriter(file_path, layer_name)
+
+
+def can_render_progressively(output_format, export_format):
+    """Whether a layer can be read while the export is written, i.e. converted to GeoPackage batch by batch."""
+    return output_format == GEOPACKAGE and export_format in (GEOJSON, JSONL)
+
+
+def needs_field_types(output_format, export_format):
+    """Whether the fields of the layer are created by the plugin, other exports being typed by OGR."""
+    return output_format == GEOPACKAGE and export_format in (GEOJSON, JSONL)
+
+
+def write_features(features, file_path, output_format, layer_name, is_canceled=lambda: False, field_types=None):
+    """Write an iterable of GeoJSON features to file_path, stopping early when is_canceled() is true."""
+    writer = open_writer(file_path, output_format, layer_name, field_types=field_types)
+    try:
+        for feature in features:
+            if is_canceled():
+                break
+            writer.write(feature)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def upsert_features(features, file_path, layer_name, key_field=None, is_canceled=lambda: False, field_types=None):
+    """
+    Add features to an existing GeoPackage layer. With a key_field, the features already stored with
+    the same key are replaced, otherwise features are appended. Returns the number of features written.
+    """
+    writer = GeoPackageWriter(file_path, layer_name, append=True, field_types=field_types)
+    try:
+        batch = []
+        for feature in features:
+            if is_canceled():
+                break
+            batch.append(feature)
+            if len(batch) == writer.batch_size:
+                _upsert_batch(writer, batch, key_field)
+                batch = []
+        if batch and not is_canceled():
+            _upsert_batch(writer, batch, key_field)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def _upsert_batch(writer, batch, key_field):
+    if key_field:
+        keys = [(feature.get('properties') or {}).get(key_field) for feature in batch]
+        writer.delete_where_in(key_field, [key for key in keys if key is not None])
+    for feature in batch:
+        writer.write(feature)
+
+
+def resolve_export_format(export_format):
+    """
+    Export format to request from the Explore API. Auto picks FlatGeobuf when the local GDAL can read
+    it: it is the most compact format whose geometries OGR always reads back, Parquet geometries
+    depending on the GDAL version and on how the domain encodes them.
+    """
+    if export_format != AUTO:
+        return export_format
+    if ogr.GetDriverByName(BINARY_EXPORT_DRIVERS[FLATGEOBUF]) is not None:
+        return FLATGEOBUF
+    return GEOJSON
+
+
+def convert_file(source_path, file_path, output_format, layer_name):
+    """Convert a file downloaded in a binary export format to the output format, with OGR."""
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    options = gdal.VectorTranslateOptions(format=OGR_DRIVERS[output_format], layerName=layer_name_for(layer_name))
+    if gdal.VectorTranslate(file_path, source_path, options=options) is None:
+        raise OSError('Could not convert {} to {}'.format(source_path, OUTPUT_FORMATS[output_format]))
+
+
+def record_to_feature(record, geom_column):
+    """GeoJSON feature of a record from a JSON export, whose geometry is in the geom_column field."""
+    properties = dict(record)
+    geometry = properties.pop(geom_column, None) if geom_column else None
+    if isinstance(geometry, dict):
+        if 'lon' in geometry and 'lat' in geometry:
+            geometry = {'type': 'Point', 'coordinates': [geometry['lon'], geometry['lat']]}
+        elif geometry.get('type') == 'Feature':
+            geometry = geometry.get('geometry')
+    return {'type': 'Feature', 'geometry': geometry, 'properties': properties}
@@ -0,0 +1,296 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+API_PREFIX = '/api/explore/v2.1/'
+RECORDS_PER_CHUNK = 1000
+DATASET_ID_PREFIX = 'synthetic-dataset-'
+FIELDS = [{'name': 'id', 'label': 'Identifier', 'type': 'int'},
+          {'name': 'name', 'label': 'Name', 'type': 'text'},
+          {'name': 'value', 'label': 'Value', 'type': 'double'},
+          {'name': 'updated_at', 'label': 'Updated at', 'type': 'datetime'},
+          {'name': 'geo_point_2d', 'label': 'Location', 'type': 'geo_point_2d'}]
+# OGR drivers writing the binary export formats, served when the local GDAL has them
+BINARY_EXPORT_DRIVERS = {'fgb': 'FlatGeobuf', 'parquet': 'Parquet'}
+
+
+class FakeExploreServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Explore API v2.1 of a domain, serving a synthetic catalog of catalog_size
+    datasets, each one holding records_count synthetic point records. Every response is delayed
+    by latency seconds and streamed at bandwidth bytes per second at most, if given. The exports in
+    binary_export_formats are written when the server starts, so that their writing is not measured.
+    """
+    daemon_threads = True
+
+    def __init__(self, catalog_size=1000, records_count=10000, latency=0.0, bandwidth=None,
+                 binary_export_formats=()):
+        super(FakeExploreServer, self).__init__(('127.0.0.1', 0), ExploreRequestHandler)
+        self.catalog_size = catalog_size
+        self.records_count = records_count
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.thread = None
+        self.binary_exports = {}
+        self.binary_exports_lock = threading.Lock()
+        self.binary_exports_directory = tempfile.mkdtemp(prefix='ods-benchmarks-')
+        self.binary_export_formats = binary_export_formats
+
+    @property
+    def domain_url(self):
+        """Domain to give to the plugin, scheme included."""
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        for export_format in self.binary_export_formats:
+            self.binary_export(export_format, self.records_count)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        shutil.rmtree(self.binary_exports_directory, ignore_errors=True)
+
+    def binary_export(self, export_format, records_count):
+        """
+        Path of the file of an export of records_count records in a binary export format, written with
+        OGR on the first request then reused, None when the local GDAL cannot write this format.
+        """
+        with self.binary_exports_lock:
+            key = (export_format, records_count)
+            if key not in self.binary_exports:
+                self.binary_exports[key] = write_binary_export(self.binary_exports_directory, export_format,
+                                                               records_count)
+            return self.binary_exports[key]
+
+
+class ExploreRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        path = unquote(url.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not path.startswith(API_PREFIX):
+            return self.send_json({'message': 'Not found'}, 404)
+        parts = path[len(API_PREFIX):].strip('/').split('/')
+        if parts == ['catalog', 'exports', 'json']:
+            return self.send_catalog_export()
+        if parts == ['catalog', 'datasets']:
+            return self.send_catalog_page(params)
+        if len(parts) >= 4 and parts[:2] == ['catalog', 'datasets'] and self.has_dataset(parts[2]):
+            if parts[3] == 'records':
+                return self.send_records(params)
+            if parts[3] == 'exports' and len(parts) == 5:
+                return self.send_export(parts[4], params)
+        return self.send_json({'message': 'Not found'}, 404)
+
+    def has_dataset(self, dataset_id):
+        return is_dataset_id(dataset_id, self.server.catalog_size)
+
+    def send_catalog_export(self):
+        etag = '"catalog-{}"'.format(self.server.catalog_size)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        def chunks():
+            all_ids = dataset_ids(self.server.catalog_size)
+            yield b'['
+            for start in range(0, len(all_ids), RECORDS_PER_CHUNK):
+                yield ''.join('{}{}'.format(',' if index else '', json.dumps({'dataset_id': all_ids[index]}))
+                              for index in range(start, min(start + RECORDS_PER_CHUNK, len(all_ids)))).encode('utf-8')
+            yield b']'
+        self.send_stream(chunks(), {'ETag': etag})
+
+    def send_catalog_page(self, params):
+        where = params.get('where', '')
+        if where.startswith('datasetid:'):
+            dataset_id = where[len('datasetid:'):].strip('"')
+            results = [dataset_metadata(dataset_id, self.server.records_count)] if self.has_dataset(dataset_id) else []
+            return self.send_json({'total_count': len(results), 'results': results})
+        all_ids = dataset_ids(self.server.catalog_size)
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 10))
+        self.send_json({'total_count': len(all_ids),
+                        'results': [{'dataset_id': dataset_id} for dataset_id in all_ids[offset:offset + limit]]})
+
+    def send_records(self, params):
+        records_count = self.server.records_count
+        if 'min(' in params.get('select', ''):
+            return self.send_json({'total_count': 1, 'results': [
+                {'min_value': 0, 'max_value': max(records_count - 1, 0)}]})
+        limit = min(int(params.get('limit', 10)), 100)
+        self.send_json({'total_count': records_count,
+                        'results': [synthetic_record(index) for index in range(min(limit, records_count))]})
+
+    def send_export(self, export_format, params):
+        records_count = self.server.records_count
+        if int(params.get('limit', -1)) != -1:
+            records_count = min(records_count, int(params['limit']))
+        if export_format == 'geojson':
+            return self.send_stream(geojson_export_chunks(records_count))
+        if export_format == 'json':
+            return self.send_stream(json_export_chunks(records_count))
+        if export_format == 'jsonl':
+            return self.send_stream(jsonl_export_chunks(records_count))
+        if export_format in BINARY_EXPORT_DRIVERS:
+            file_path = self.server.binary_export(export_format, records_count)
+            if file_path is None:
+                return self.send_json({'message': 'No {} driver in the GDAL of the benchmarks'.format(
+                    BINARY_EXPORT_DRIVERS[export_format])}, 400)
+            return self.send_stream(file_chunks(file_path), {'Content-Type': 'application/octet-stream'})
+        self.send_json({'message': 'Unknown export format {}'.format(export_format)}, 400)
+
+    def send_json(self, body, status=200):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_stream(self, chunks, headers=None):
+        """Send chunks with chunked transfer encoding, throttled to the bandwidth of the server."""
+        headers = dict({'Content-Type': 'application/json'}, **(headers or {}))
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        start = time.monotonic()
+        sent = 0
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                sent += len(chunk)
+                if self.server.bandwidth:
+                    delay = sent / self.server.bandwidth - (time.monotonic() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client canceled the download
+            self.close_connection = True
+
+
+@functools.lru_cache(maxsize=None)
+def dataset_ids(catalog_size):
+    return tuple('{}{:06d}'.format(DATASET_ID_PREFIX, index) for index in range(catalog_size))
+
+
+def is_dataset_id(dataset_id, catalog_size):
+    suffix = dataset_id[len(DATASET_ID_PREFIX):]
+    return dataset_id.startswith(DATASET_ID_PREFIX) and suffix.isdigit() and int(suffix) < catalog_size
+
+
+def dataset_metadata(dataset_id, records_count):
+    return {'dataset_id': dataset_id, 'fields': FIELDS,
+            'metas': {'default': {'title': dataset_id.replace('-', ' ').title(), 'publisher': 'Benchmarks',
+                                  'records_count': records_count, 'modified': '2021-01-01T00:00:00+00:00',
+                                  'data_processed': '2021-01-01T00:00:00+00:00'}}}
+
+
+def synthetic_record(index):
+    return {'id': index, 'name': 'Record {}'.format(index), 'value': index * 0.5,
+            'updated_at': '2021-01-01T00:00:{:02d}+00:00'.format(index % 60),
+            'geo_point_2d': {'lon': round(-180 + (index * 0.0137) % 360, 6),
+                             'lat': round(-80 + (index * 0.0071) % 160, 6)}}
+
+
+def synthetic_feature(index):
+    properties = synthetic_record(index)
+    point = properties.pop('geo_point_2d')
+    properties['geo_point_2d'] = [point['lat'], point['lon']]
+    return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [point['lon'], point['lat']]},
+            'properties': properties}
+
+
+def geojson_export_chunks(records_count):
+    yield b'{"type": "FeatureCollection", "features": ['
+    for start in range(0, records_count, RECORDS_PER_CHUNK):
+        yield ''.join('{}{}'.format(',\n' if index else '', json.dumps(synthetic_feature(index)))
+                      for index in range(start, min(start + RECORDS_PER_CHUNK, records_count))).encode('utf-8')
+    yield b']}'
+
+
+def json_export_chunks(records_count):
+    yield b'['
+    for start in range(0, records_count, RECORDS_PER_CHUNK):
+        yield ''.join('{}{}'.format(',\n' if index else '', json.dumps(synthetic_record(index)))
+                      for index in range(start, min(start + RECORDS_PER_CHUNK, records_count))).encode('utf-8')
+    yield b']'
+
+
+def jsonl_export_chunks(records_count):
+    for start in range(0, records_count, RECORDS_PER_CHUNK):
+        yield ''.join('{}\n'.format(json.dumps(synthetic_record(index)))
+                      for index in range(start, min(start + RECORDS_PER_CHUNK, records_count))).encode('utf-8')
+
+
+def file_chunks(file_path, chunk_size=1024 * 1024):
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def write_binary_export(directory, export_format, records_count):
+    """Write the synthetic point records of an export with OGR, returning None if GDAL has no driver for it."""
+    try:
+        from osgeo import ogr, osr
+    except ImportError:
+        return None
+    driver = ogr.GetDriverByName(BINARY_EXPORT_DRIVERS[export_format])
+    if driver is None:
+        return None
+    file_path = os.path.join(directory, '{}.{}'.format(records_count, export_format))
+    data_source = driver.CreateDataSource(file_path)
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(4326)
+    spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    layer = data_source.CreateLayer('export', spatial_reference, ogr.wkbPoint)
+    for name, field_type in (('id', ogr.OFTInteger64), ('name', ogr.OFTString), ('value', ogr.OFTReal),
+                             ('updated_at', ogr.OFTDateTime)):
+        layer.CreateField(ogr.FieldDefn(name, field_type))
+    layer_definition = layer.GetLayerDefn()
+    for index in range(records_count):
+        record = synthetic_record(index)
+        point = record.pop('geo_point_2d')
+        feature = ogr.Feature(layer_definition)
+        for name, value in record.items():
+            feature.SetField(name, value)
+        geometry = ogr.Geometry(ogr.wkbPoint)
+        geometry.AddPoint_2D(point['lon'], point['lat'])
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+    # The file is written when the data source is released
+    layer = None
+    data_source = None
+    return file_path
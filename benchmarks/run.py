@@ -0,0 +1,251 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+"""
+Benchmarks of the plugin against a local stand-in of the Explore API, runnable offline from the
+root of the repository with the Python interpreter of QGIS:
+
+    python -m benchmarks.run                      # all scenarios
+    python -m benchmarks.run --check              # fail when a threshold of thresholds.json is exceeded
+    python -m benchmarks.run export_geojson_to_gpkg --records 10000000 --bandwidth 50000000
+
+Each scenario runs in its own process so that its peak RSS is measured alone.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from .fake_server import FakeExploreServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+# name: (measure, server configuration, measure arguments)
+SCENARIOS = {
+    'catalog_listing_1k': ('catalog_listing', {'catalog_size': 1000}, {}),
+    'catalog_listing_50k': ('catalog_listing', {'catalog_size': 50000}, {}),
+    'schema_latency': ('schema_latency', {'latency': 0.05}, {'datasets': 10}),
+    'export_geojson_to_geojson': ('export', {'records_count': 200000},
+                                  {'export_format': 'geojson', 'output_format': 'geojson'}),
+    'export_geojson_to_gpkg': ('export', {'records_count': 200000},
+                               {'export_format': 'geojson', 'output_format': 'gpkg'}),
+    'export_jsonl_to_gpkg': ('export', {'records_count': 200000},
+                             {'export_format': 'jsonl', 'output_format': 'gpkg'}),
+    'export_fgb_to_gpkg': ('export', {'records_count': 200000, 'binary_export_formats': ['fgb']},
+                           {'export_format': 'fgb', 'output_format': 'gpkg'}),
+    'dialog_open_30k': ('dialog_open', {'catalog_size': 30000}, {}),
+    'layer_display_geojson_1m': ('layer_display', {'records_count': 1000000}, {'output_format': 'geojson'}),
+    'layer_display_gpkg_1m': ('layer_display', {'records_count': 1000000}, {'output_format': 'gpkg'}),
+}
+# Measures creating widgets or painting, run by a QGIS application with a GUI on an offscreen display
+GUI_MEASURES = {'dialog_open', 'layer_display'}
+# Map view of the layer display measures, and share of the layer extent covered when zoomed in
+MAP_SIZE = (1200, 800)
+ZOOM_RATIO = 0.01
+
+
+def measure_catalog_listing(api, domain, work_directory):
+    start = time.monotonic()
+    dataset_ids = api.list_datasets(domain, include_non_geo_dataset=True, force_refresh=True)
+    seconds = time.monotonic() - start
+    start = time.monotonic()
+    api.list_datasets(domain, include_non_geo_dataset=True)
+    return {'seconds': seconds, 'cached_seconds': time.monotonic() - start, 'datasets': len(dataset_ids)}
+
+
+def measure_schema_latency(api, domain, work_directory, datasets):
+    dataset_ids = api.list_datasets(domain, include_non_geo_dataset=True, force_refresh=True)[:datasets]
+    latencies = []
+    for dataset_id in dataset_ids:
+        start = time.monotonic()
+        api.get_schema(domain, dataset_id)
+        latencies.append(time.monotonic() - start)
+    start = time.monotonic()
+    api.get_schema(domain, dataset_ids[0])
+    return {'seconds': sum(latencies) / len(latencies), 'slowest_seconds': max(latencies),
+            'cached_seconds': time.monotonic() - start}
+
+
+def measure_export(api, domain, work_directory, export_format, output_format):
+    dataset_id = api.list_datasets(domain, include_non_geo_dataset=True, force_refresh=True)[0]
+    file_path = os.path.join(work_directory, '{}.{}'.format(dataset_id, output_format))
+    start = time.monotonic()
+    records_count = api.export_dataset(domain, dataset_id, file_path, output_format=output_format,
+                                       export_format=export_format)
+    seconds = time.monotonic() - start
+    size = os.path.getsize(file_path)
+    return {'seconds': seconds, 'records': records_count, 'records_per_second': records_count / seconds,
+            'output_mb_per_second': size / 1024 / 1024 / seconds}
+
+
+def measure_dialog_open(api, domain, work_directory):
+    from qgis.core import QgsApplication
+    from Opendatasoft import dataset_model, qgis_ods_plugin, utils
+    dataset_ids = api.list_datasets(domain, include_non_geo_dataset=True, force_refresh=True)
+    # Inputs saved by older versions of the plugin, which held the whole dataset list
+    utils.save_session_state({
+        'domain': domain, 'include_non_geo_dataset': True, 'text_search': None, 'store_apikey_in_cache': False,
+        'dataset_id': {'items': [dataset_model.PLACEHOLDER] + dataset_ids, 'index': 1},
+        'default_geom_column': True, 'are_filters_shown': False, 'params': {}})
+    plugin = qgis_ods_plugin.QgisOdsPlugin(None)
+    latencies = []
+    # The first opening compacts the saved inputs, the next one reads them as saved by this version
+    for _ in range(2):
+        start = time.monotonic()
+        dialog = plugin.openDialog()
+        latencies.append(time.monotonic() - start)
+        dialog.close()
+    task_manager = QgsApplication.taskManager()
+    task_manager.cancelAll()
+    deadline = time.monotonic() + 30
+    while task_manager.countActiveTasks() and time.monotonic() < deadline:
+        QgsApplication.processEvents()
+        time.sleep(0.05)
+    return {'seconds': latencies[0], 'restored_seconds': latencies[1], 'datasets': len(dataset_ids)}
+
+
+def measure_layer_display(api, domain, work_directory, output_format):
+    """Open an exported layer, render it whole then zoomed in, and select the features of the zoomed in view."""
+    from qgis.core import QgsRectangle, QgsVectorLayer
+    dataset_id = api.list_datasets(domain, include_non_geo_dataset=True, force_refresh=True)[0]
+    file_path = os.path.join(work_directory, '{}.{}'.format(dataset_id, output_format))
+    api.export_dataset(domain, dataset_id, file_path, output_format=output_format, export_format='geojson')
+    start = time.monotonic()
+    layer = QgsVectorLayer(file_path, dataset_id, 'ogr')
+    features = layer.featureCount()
+    load_seconds = time.monotonic() - start
+    extent = layer.extent()
+    center = extent.center()
+    half_width, half_height = extent.width() * ZOOM_RATIO / 2, extent.height() * ZOOM_RATIO / 2
+    zoomed_extent = QgsRectangle(center.x() - half_width, center.y() - half_height,
+                                 center.x() + half_width, center.y() + half_height)
+    render_seconds = render(layer, extent)
+    zoomed_render_seconds = render(layer, zoomed_extent)
+    start = time.monotonic()
+    layer.selectByRect(zoomed_extent)
+    select_seconds = time.monotonic() - start
+    return {'load_seconds': load_seconds, 'render_seconds': render_seconds,
+            'zoomed_render_seconds': zoomed_render_seconds, 'select_seconds': select_seconds,
+            'features': features, 'selected': layer.selectedFeatureCount()}
+
+
+def render(layer, extent):
+    """Seconds taken to render layer on a map view of extent."""
+    from PyQt5.QtCore import QSize
+    from qgis.core import QgsMapRendererSequentialJob, QgsMapSettings
+    settings = QgsMapSettings()
+    settings.setLayers([layer])
+    settings.setDestinationCrs(layer.crs())
+    settings.setOutputSize(QSize(*MAP_SIZE))
+    settings.setExtent(extent)
+    job = QgsMapRendererSequentialJob(settings)
+    start = time.monotonic()
+    job.start()
+    job.waitForFinished()
+    return time.monotonic() - start
+
+
+MEASURES = {'catalog_listing': measure_catalog_listing, 'schema_latency': measure_schema_latency,
+            'export': measure_export, 'dialog_open': measure_dialog_open, 'layer_display': measure_layer_display}
+
+
+def run_child(measure, domain, measure_arguments):
+    """Run one measure in the current process, within a throwaway QGIS profile."""
+    sys.path.insert(0, ROOT)
+    with tempfile.TemporaryDirectory() as work_directory:
+        from PyQt5.QtCore import QSettings
+        from qgis.core import QgsApplication
+        gui = measure in GUI_MEASURES
+        if gui:
+            os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        # Settings written by the measure stay in the throwaway profile
+        QSettings.setDefaultFormat(QSettings.IniFormat)
+        QSettings.setPath(QSettings.IniFormat, QSettings.UserScope, os.path.join(work_directory, 'settings'))
+        application = QgsApplication([], gui, os.path.join(work_directory, 'profile'))
+        application.initQgis()
+        from Opendatasoft import api
+        result = MEASURES[measure](api, domain, work_directory, **measure_arguments)
+        application.exitQgis()
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = peak_rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+    return result
+
+
+def run_scenario(name, server_overrides):
+    measure, server_configuration, measure_arguments = SCENARIOS[name]
+    server = FakeExploreServer(**dict(server_configuration, **server_overrides)).start()
+    try:
+        completed = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.run', '--child', measure, server.domain_url,
+             json.dumps(measure_arguments)], cwd=ROOT, stdout=subprocess.PIPE, check=True)
+    finally:
+        server.stop()
+    return json.loads(completed.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def regressions(name, result, thresholds):
+    """Descriptions of the thresholds of a scenario exceeded by its result."""
+    failures = []
+    for threshold, limit in thresholds.get(name, {}).items():
+        kind, metric = threshold.split('_', 1)
+        value = result.get(metric)
+        if value is None:
+            continue
+        if (kind == 'max' and value > limit) or (kind == 'min' and value < limit):
+            failures.append('{} {} = {:.3f}, {} {}'.format(name, metric, value, kind, limit))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='Scenarios to run, all of them by default: {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--check', action='store_true', help='Exit with an error when a threshold is exceeded')
+    parser.add_argument('--records', type=int, help='Records of each synthetic dataset')
+    parser.add_argument('--catalog-size', type=int, help='Datasets of the synthetic catalog')
+    parser.add_argument('--latency', type=float, help='Delay of every response, in seconds')
+    parser.add_argument('--bandwidth', type=float, help='Maximum speed of the responses, in bytes per second')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    unknown_scenarios = set(arguments.scenarios) - set(SCENARIOS)
+    if unknown_scenarios:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown_scenarios))))
+
+    if arguments.child:
+        measure, domain, measure_arguments = arguments.child
+        print(json.dumps(run_child(measure, domain, json.loads(measure_arguments))))
+        return 0
+
+    server_overrides = {name: value for name, value in (
+        ('records_count', arguments.records), ('catalog_size', arguments.catalog_size),
+        ('latency', arguments.latency), ('bandwidth', arguments.bandwidth)) if value is not None}
+    with open(THRESHOLDS_PATH, 'r', encoding='utf-8') as f:
+        thresholds = json.load(f)
+    failures = []
+    for name in arguments.scenarios or list(SCENARIOS):
+        result = run_scenario(name, server_overrides)
+        print('{:<28} {}'.format(name, ', '.join('{}={:.3f}'.format(metric, value)
+                                                 for metric, value in sorted(result.items()))))
+        if not server_overrides:
+            failures += regressions(name, result, thresholds)
+    for failure in failures:
+        print('REGRESSION: {}'.format(failure))
+    return 1 if arguments.check and failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def qgis_application(tmp_path_factory):
+    """QGIS application without GUI, with its settings and profile in a throwaway folder."""
+    from PyQt5.QtCore import QSettings
+    from qgis.core import QgsApplication
+    directory = tmp_path_factory.mktemp('qgis')
+    QSettings.setDefaultFormat(QSettings.IniFormat)
+    QSettings.setPath(QSettings.IniFormat, QSettings.UserScope, str(directory / 'settings'))
+    application = QgsApplication([], False, str(directory / 'profile'))
+    application.initQgis()
+    yield application
+    application.exitQgis()
@@ -0,0 +1,77 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import api, tasks, utils, writers
+from Opendatasoft.exceptions import DatasetError, NumberOfLinesError
+
+DOMAIN = 'data.example.com'
+
+
+def test_export_params_only_hold_the_given_inputs():
+    assert api.export_params() == {}
+    assert api.export_params('secret', 'name,height', 'height > 10', 'height desc', 50) == {
+        'select': 'name,height', 'where': 'height > 10', 'order_by': 'height desc', 'limit': '50',
+        'apikey': 'secret'}
+    assert api.export_params(select='', where=None, limit=-1) == {}
+    assert api.export_params(limit=0) == {'limit': '0'}
+
+
+@pytest.mark.parametrize('limit', [-2, '10', 2.5])
+def test_export_params_reject_invalid_limits(limit):
+    with pytest.raises(NumberOfLinesError):
+        api.export_params(limit=limit)
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Exports whose download writes the dataset identifier to the file, failing for 'broken'."""
+    exports = []
+
+    def import_dataset_to_qgis(domain, dataset_id, params, export_format):
+        exports.append((dataset_id, params, export_format))
+        if dataset_id == 'broken':
+            raise DatasetError()
+        return mock.Mock(dataset_id=dataset_id), 3
+
+    def download_to_file(imported_dataset, file_path, progress_reporter, is_canceled, output_format, *args, **kwargs):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(imported_dataset.dataset_id)
+        progress_reporter.report(100, 3)
+    monkeypatch.setattr(utils, 'import_dataset_to_qgis', import_dataset_to_qgis)
+    monkeypatch.setattr(tasks, 'download_to_file', download_to_file)
+    monkeypatch.setattr(tasks, 'PROGRESS_INTERVAL', 0)
+    return exports
+
+
+def test_export_dataset_downloads_the_query_and_reports_progress(downloads, tmp_path):
+    file_path = tmp_path / 'trees.geojson'
+    reports = []
+
+    records_count = api.export_dataset(DOMAIN, 'trees', str(file_path), where='height > 10', limit=3,
+                                       export_format=writers.GEOJSON,
+                                       report_progress=lambda text, percentage: reports.append(percentage))
+
+    assert records_count == 3
+    assert downloads == [('trees', {'where': 'height > 10', 'limit': '3'}, writers.GEOJSON)]
+    assert file_path.read_text(encoding='utf-8') == 'trees'
+    assert reports == [100]
+
+
+def test_failed_exports_do_not_stop_the_others(downloads, tmp_path):
+    exported, errors = api.export_datasets(DOMAIN, ['trees', 'broken', 'paris-parks'], str(tmp_path),
+                                           output_format=writers.GEOJSON, export_format=writers.GEOJSON)
+
+    assert exported == {'trees': str(tmp_path / 'trees.geojson'), 'paris-parks': str(tmp_path / 'paris_parks.geojson')}
+    assert list(errors) == ['broken'] and isinstance(errors['broken'], DatasetError)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['paris_parks.geojson', 'trees.geojson']
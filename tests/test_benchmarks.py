@@ -0,0 +1,108 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+import os
+
+import pytest
+import requests
+
+from benchmarks import fake_server, run
+
+DATASET_PATH = '/api/explore/v2.1/catalog/datasets/synthetic-dataset-000001/'
+
+
+@pytest.fixture
+def server(monkeypatch):
+    def write_binary_export(directory, export_format, records_count):
+        file_path = os.path.join(directory, '{}.{}'.format(records_count, export_format))
+        with open(file_path, 'wb') as f:
+            f.write(b'FGB' * records_count)
+        return file_path
+    monkeypatch.setattr(fake_server, 'write_binary_export', write_binary_export)
+    server = fake_server.FakeExploreServer(catalog_size=2500, records_count=2500,
+                                           binary_export_formats=['fgb']).start()
+    yield server
+    server.stop()
+
+
+def get(server, path, **kwargs):
+    return requests.get(server.domain_url + path, **kwargs)
+
+
+def test_catalog_export_is_revalidated_with_its_etag(server):
+    response = get(server, '/api/explore/v2.1/catalog/exports/json')
+    datasets = response.json()
+
+    assert len(datasets) == 2500
+    assert datasets[1] == {'dataset_id': 'synthetic-dataset-000001'}
+    revalidated = get(server, '/api/explore/v2.1/catalog/exports/json',
+                      headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+
+
+def test_catalog_pages_and_unknown_datasets(server):
+    page = get(server, '/api/explore/v2.1/catalog/datasets', params={'offset': 2490, 'limit': 100}).json()
+    found = get(server, '/api/explore/v2.1/catalog/datasets', params={'where': 'datasetid:"synthetic-dataset-000001"'})
+
+    assert page['total_count'] == 2500 and len(page['results']) == 10
+    assert found.json()['results'][0]['metas']['default']['records_count'] == 2500
+    assert get(server, '/api/explore/v2.1/catalog/datasets/synthetic-dataset-002500/records').status_code == 404
+
+
+@pytest.mark.parametrize('export_format, parse', [
+    ('geojson', lambda content: json.loads(content)['features']),
+    ('json', json.loads),
+    ('jsonl', lambda content: content.splitlines()),
+])
+def test_exports_stop_at_the_limit(server, export_format, parse):
+    whole = get(server, DATASET_PATH + 'exports/{}'.format(export_format))
+    limited = get(server, DATASET_PATH + 'exports/{}'.format(export_format), params={'limit': 1500})
+
+    assert len(parse(whole.content)) == 2500
+    assert len(parse(limited.content)) == 1500
+
+
+def test_binary_exports_are_written_once_and_streamed(server, monkeypatch):
+    monkeypatch.setattr(fake_server, 'write_binary_export', lambda *args: pytest.fail('written again'))
+
+    response = get(server, DATASET_PATH + 'exports/fgb')
+
+    assert response.headers['Content-Type'] == 'application/octet-stream'
+    assert response.content == b'FGB' * 2500
+
+
+def test_binary_export_without_gdal_driver_is_rejected(server, monkeypatch):
+    monkeypatch.setattr(fake_server, 'write_binary_export', lambda *args: None)
+
+    response = get(server, DATASET_PATH + 'exports/parquet')
+
+    assert response.status_code == 400
+    assert 'Parquet' in response.json()['message']
+
+
+def test_regressions_compare_results_with_the_thresholds():
+    thresholds = {'export_fgb_to_gpkg': {'max_seconds': 30.0, 'min_records_per_second': 10000,
+                                         'max_peak_rss_mb': 450}}
+
+    assert run.regressions('export_fgb_to_gpkg', {'seconds': 12.0, 'records_per_second': 16000}, thresholds) == []
+    assert run.regressions('export_fgb_to_gpkg', {'seconds': 40.0, 'records_per_second': 5000,
+                                                  'peak_rss_mb': 300}, thresholds) == [
+        'export_fgb_to_gpkg seconds = 40.000, max 30.0',
+        'export_fgb_to_gpkg records_per_second = 5000.000, min 10000']
+    assert run.regressions('catalog_listing_1k', {'seconds': 100.0}, thresholds) == []
+
+
+def test_every_scenario_has_thresholds():
+    with open(run.THRESHOLDS_PATH, 'r', encoding='utf-8') as f:
+        thresholds = json.load(f)
+
+    assert set(thresholds) == set(run.SCENARIOS)
+    assert {measure for measure, _, _ in run.SCENARIOS.values()} == set(run.MEASURES)
@@ -0,0 +1,144 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+import os
+import time
+from unittest import mock
+
+import pytest
+import requests
+
+from Opendatasoft import catalog_cache, instrumentation, utils
+
+DATASETS = [{'dataset_id': 'trees'}, {'dataset_id': 'roads'}]
+
+
+def test_entries_are_read_back_with_their_validators(tmp_path):
+    cache = catalog_cache.CatalogCache(str(tmp_path))
+    key = cache.key('data.example.com', None, False, None)
+
+    cache.put(key, DATASETS, etag='"v1"', last_modified='Fri, 01 Jan 2021 00:00:00 GMT')
+    entry = catalog_cache.CatalogCache(str(tmp_path)).get(key)
+
+    assert entry['json_dataset'] == DATASETS
+    assert entry['etag'] == '"v1"'
+    assert entry['last_modified'] == 'Fri, 01 Jan 2021 00:00:00 GMT'
+    assert cache.is_fresh(entry)
+
+
+def test_keys_depend_on_the_query_and_hide_the_apikey(tmp_path):
+    key = catalog_cache.CatalogCache.key('data.example.com', 'trees', False, 'secret-apikey')
+
+    assert key == catalog_cache.CatalogCache.key('data.example.com', 'trees', False, 'secret-apikey')
+    assert key != catalog_cache.CatalogCache.key('data.example.com', 'trees', True, 'secret-apikey')
+    assert key != catalog_cache.CatalogCache.key('data.example.com', 'roads', False, 'secret-apikey')
+    assert key != catalog_cache.CatalogCache.key('data.example.com', 'trees', False, None)
+    cache = catalog_cache.CatalogCache(str(tmp_path))
+    cache.put(key, DATASETS)
+    for file_name in os.listdir(str(tmp_path)):
+        assert 'secret-apikey' not in (tmp_path / file_name).read_text(encoding='utf-8')
+
+
+def test_stale_entries_are_kept_until_touched(tmp_path):
+    cache = catalog_cache.CatalogCache(str(tmp_path), ttl=60)
+    entry = cache.put('stale', DATASETS, etag='"v1"')
+    entry['stored_at'] = time.time() - 120
+
+    assert not cache.is_fresh(entry)
+    cache.touch('stale', entry)
+    assert cache.is_fresh(cache.get('stale'))
+    assert cache.get('stale')['etag'] == '"v1"'
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    # Room for three entries of about 1kB
+    cache = catalog_cache.CatalogCache(str(tmp_path), max_size=3500)
+    datasets = [{'dataset_id': 'dataset-{}'.format(number)} for number in range(30)]
+    for number, key in enumerate(['first', 'second', 'third']):
+        cache.put(key, datasets)
+        # Modification times drive the eviction order
+        os.utime(os.path.join(str(tmp_path), '{}.json'.format(key)), (number, number))
+    cache.get('first')
+
+    cache.put('fourth', datasets)
+
+    assert cache.get('second') is None
+    assert cache.get('third') is not None
+    assert cache.get('first')['json_dataset'] == datasets
+    assert cache.get('fourth')['json_dataset'] == datasets
+
+
+def test_missing_and_corrupt_entries_are_misses(tmp_path):
+    cache = catalog_cache.CatalogCache(str(tmp_path))
+    (tmp_path / 'corrupt.json').write_text('{"stored_at": ', encoding='utf-8')
+
+    assert cache.get('missing') is None
+    assert cache.get('corrupt') is None
+    cache.put('trees', DATASETS)
+    cache.clear()
+    assert cache.get('trees') is None
+
+
+class StubExport:
+    """Streamed catalog export answering status, with its content cut by a dropped connection if drop is set."""
+    def __init__(self, status_code, content=b'', drop=False):
+        self.status_code = status_code
+        self.content = content
+        self.drop = drop
+        self.headers = {'ETag': '"v1"'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size=None):
+        yield self.content
+        if self.drop:
+            raise requests.exceptions.ChunkedEncodingError('Connection broken')
+
+
+def listed_dataset_ids(monkeypatch, tmp_path, export):
+    ods_client = mock.Mock(domain_url='data.example.com')
+    ods_client.send.return_value = export
+    ods_client.get.return_value.json.return_value = {'total_count': 1, 'results': [{'dataset_id': 'paginated'}]}
+    monkeypatch.setattr(utils.client, 'get_client', lambda domain_url, apikey=None: ods_client)
+    monkeypatch.setattr(catalog_cache, 'default_catalog_cache', lambda: catalog_cache.CatalogCache(str(tmp_path)))
+    instrumentation.clear()
+    json_dataset = utils.import_dataset_list('data.example.com', None, True, None)
+    return [dataset['dataset_id'] for dataset in json_dataset['results']]
+
+
+def fallbacks():
+    return [event['reason'] for event in instrumentation.events() if event['kind'] == 'fallback']
+
+
+def test_catalog_export_is_read_when_available(monkeypatch, tmp_path):
+    export = StubExport(200, json.dumps(DATASETS).encode('utf-8'))
+
+    assert listed_dataset_ids(monkeypatch, tmp_path, export) == ['trees', 'roads']
+    assert fallbacks() == []
+
+
+@pytest.mark.parametrize('export, reason', [
+    (StubExport(404), 'status 404'),
+    (StubExport(200, b'[{"dataset_id": "trees"}, {"data', drop=True), 'ChunkedEncodingError')])
+def test_unavailable_or_dropped_catalog_export_falls_back_to_pages(monkeypatch, tmp_path, export, reason):
+    assert listed_dataset_ids(monkeypatch, tmp_path, export) == ['paginated']
+    assert fallbacks() == [reason]
+
+
+def test_malformed_catalog_export_is_not_hidden_by_the_fallback(monkeypatch, tmp_path):
+    with pytest.raises(ValueError):
+        listed_dataset_ids(monkeypatch, tmp_path, StubExport(200, b'[{"dataset_id": "trees"}, {"data'))
+
+    assert fallbacks() == []
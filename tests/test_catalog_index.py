@@ -0,0 +1,110 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import pytest
+
+from Opendatasoft import catalog_index, dataset_model
+
+DOMAIN = 'example.opendatasoft.com'
+
+
+def catalog_dataset(dataset_id, records_count=5000, title=None, geo=True, keyword=None, description=None):
+    fields = [{'name': 'name', 'type': 'text'}]
+    if geo:
+        fields.append({'name': 'geo_point_2d', 'type': 'geo_point_2d'})
+    return {'dataset_id': dataset_id, 'fields': fields,
+            'metas': {'default': {'title': title or dataset_id, 'publisher': 'Publisher',
+                                  'records_count': records_count, 'keyword': keyword, 'description': description}}}
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    index = catalog_index.CatalogIndex(str(tmp_path / 'index.sqlite'))
+    monkeypatch.setattr(catalog_index, 'default_catalog_index', lambda: index)
+    return index
+
+
+def test_local_dataset_search_pages_the_indexed_catalog(index):
+    dataset_ids = ['dataset-{:03d}'.format(number) for number in range(250)]
+    index.replace(index.scope(DOMAIN, None), DOMAIN, [catalog_dataset(dataset_id) for dataset_id in dataset_ids])
+
+    search = dataset_model.local_dataset_search(DOMAIN, None, True, None)
+
+    assert search(0, dataset_model.PAGE_SIZE) == (dataset_ids[:100], 250)
+    assert search(200, dataset_model.PAGE_SIZE) == (dataset_ids[200:], 250)
+
+
+def test_dataset_listed_twice_is_indexed_once(index):
+    scope = index.scope(DOMAIN, None)
+    index.replace(scope, DOMAIN, [catalog_dataset('trees', title='Old trees'),
+                                  catalog_dataset('trees', title='Remarkable trees')])
+
+    assert index.search(scope, 'trees') == (['trees'], 1)
+    assert index.search(scope, 'old') == ([], 0)
+    assert index.summaries(scope, ['trees'])[0]['title'] == 'Remarkable trees'
+
+
+def test_words_are_searched_in_titles_keywords_and_descriptions(index):
+    scope = index.scope(DOMAIN, None)
+    index.replace(scope, DOMAIN, [
+        catalog_dataset('trees', title='Remarkable trees'),
+        catalog_dataset('parks', keyword=['green', 'leisure']),
+        catalog_dataset('roads', description='<p>Road <b>network</b> of the city</p>')])
+
+    assert index.search(scope, 'remarkable') == (['trees'], 1)
+    assert index.search(scope, 'leisure') == (['parks'], 1)
+    assert index.search(scope, 'network city') == (['roads'], 1)
+    # The last word may still be being typed
+    assert index.search(scope, 'remark') == (['trees'], 1)
+    assert index.search(scope, 'b') == ([], 0)
+
+
+def test_search_text_is_never_read_as_a_query(index):
+    scope = index.scope(DOMAIN, None)
+    index.replace(scope, DOMAIN, [catalog_dataset('trees', title='Remarkable trees')])
+
+    assert index.search(scope, 'trees" OR (roads* NEAR') == ([], 0)
+    assert index.search(scope, '"trees"') == (['trees'], 1)
+    assert index.search(scope, '*') == (['trees'], 1)
+
+
+def test_search_filters_on_geometry_and_number_of_records(index):
+    scope = index.scope(DOMAIN, None)
+    index.replace(scope, DOMAIN, [catalog_dataset('budget', records_count=10, geo=False),
+                                  catalog_dataset('roads', records_count=100000),
+                                  catalog_dataset('trees', records_count=5000)])
+
+    assert index.search(scope) == (['budget', 'roads', 'trees'], 3)
+    assert index.search(scope, geo_only=True) == (['roads', 'trees'], 2)
+    assert index.search(scope, min_records=100, max_records=10000) == (['trees'], 1)
+
+
+def test_catalogs_of_each_apikey_are_kept_apart_and_replaced_as_a_whole(index):
+    public_scope, private_scope = index.scope(DOMAIN, None), index.scope(DOMAIN, 'apikey')
+    index.replace(public_scope, DOMAIN, [catalog_dataset('trees'), catalog_dataset('roads')])
+    index.replace(private_scope, DOMAIN, [catalog_dataset('trees'), catalog_dataset('salaries')])
+
+    index.replace(public_scope, DOMAIN, [catalog_dataset('trees')])
+
+    assert index.search(public_scope) == (['trees'], 1)
+    assert index.search(public_scope, 'roads') == ([], 0)
+    assert index.search(private_scope) == (['salaries', 'trees'], 2)
+    assert index.metadata(public_scope, 'salaries') is None
+    assert index.metadata(private_scope, 'salaries') == {'total_count': 1, 'results': [catalog_dataset('salaries')]}
+
+
+def test_indexed_catalogs_expire_after_the_ttl(tmp_path):
+    index = catalog_index.CatalogIndex(str(tmp_path / 'index.sqlite'), ttl=60)
+    scope = index.scope(DOMAIN, None)
+
+    assert not index.is_fresh(scope)
+    index.replace(scope, DOMAIN, [catalog_dataset('trees')])
+    assert index.is_fresh(scope)
+    assert not catalog_index.CatalogIndex(str(tmp_path / 'index.sqlite'), ttl=0).is_fresh(scope)
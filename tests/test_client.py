@@ -0,0 +1,153 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import http.server
+import threading
+import time
+from email.utils import formatdate
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import client
+from Opendatasoft.exceptions import RateLimitError
+
+
+class ScriptedHandler(http.server.BaseHTTPRequestHandler):
+    """Answers with the statuses of server.statuses in turn, then 200."""
+    def do_GET(self):
+        self.server.requests.append(time.monotonic())
+        status, headers = self.server.statuses.pop(0) if self.server.statuses else (200, {})
+        body = b'{"total_count": 0, "results": []}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ScriptedHandler)
+    http_server.requests = []
+    http_server.statuses = []
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def local_client(http_server, scheduler=None):
+    return client.OdsClient('http://127.0.0.1:{}'.format(http_server.server_address[1]),
+                            scheduler=scheduler or client.RequestScheduler())
+
+
+def test_retry_after_is_read_as_seconds_or_as_a_date():
+    assert client.retry_after(mock.Mock(headers={'Retry-After': '3'})) == 3
+    assert client.retry_after(mock.Mock(headers={'Retry-After': '-3'})) == 0
+    assert client.retry_after(mock.Mock(headers={'Retry-After': formatdate(time.time() + 30, usegmt=True)})) \
+        == pytest.approx(30, abs=2)
+    assert client.retry_after(mock.Mock(headers={'Retry-After': 'soon'})) is None
+    assert client.retry_after(mock.Mock(headers={})) is None
+
+
+def test_backoff_delays_are_bounded():
+    for attempt in range(10):
+        delay = client.backoff_delay(attempt)
+        assert 0 <= delay <= min(client.MAX_BACKOFF, client.BACKOFF_BASE * 2 ** attempt)
+
+
+def test_token_bucket_spaces_requests_after_a_burst():
+    bucket = client.TokenBucket(rate=20, capacity=2)
+    start = time.monotonic()
+
+    for _ in range(6):
+        bucket.take()
+
+    # Two requests of the burst, then one every 50ms
+    assert time.monotonic() - start >= 0.18
+
+
+def test_scheduler_limits_concurrent_requests():
+    scheduler = client.RequestScheduler(max_concurrent=2)
+    running = []
+    most_running = []
+    lock = threading.Lock()
+
+    def request():
+        with scheduler.slot():
+            with lock:
+                running.append(1)
+                most_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(most_running) == 2
+
+
+def test_paused_scheduler_delays_every_request():
+    scheduler = client.RequestScheduler()
+    scheduler.pause(0.2)
+    start = time.monotonic()
+
+    with scheduler.slot():
+        pass
+
+    assert time.monotonic() - start >= 0.19
+
+
+def test_unavailable_server_is_retried(monkeypatch, server):
+    monkeypatch.setattr(client, 'BACKOFF_BASE', 0.01)
+    server.statuses = [(503, {}), (502, {})]
+
+    response = local_client(server).get('catalog/datasets')
+
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_throttled_requests_wait_for_retry_after_and_pause_the_domain(server):
+    server.statuses = [(429, {'Retry-After': '0.3'})]
+    scheduler = client.RequestScheduler()
+
+    response = local_client(server, scheduler).get('catalog/datasets')
+
+    assert response.status_code == 200
+    assert server.requests[1] - server.requests[0] >= 0.29
+    assert scheduler.paused_until > 0
+
+
+def test_requests_still_throttled_raise_rate_limit_error(monkeypatch, server):
+    monkeypatch.setattr(client, 'MAX_RETRIES', 2)
+    server.statuses = [(429, {'Retry-After': '0'})] * 3
+
+    with pytest.raises(RateLimitError):
+        local_client(server).get('catalog/datasets')
+    assert len(server.requests) == 3
+
+
+def test_long_retry_after_fails_right_away(server):
+    server.statuses = [(429, {'Retry-After': str(client.MAX_RETRY_AFTER + 1)})]
+
+    with pytest.raises(RateLimitError):
+        local_client(server).get('catalog/datasets')
+    assert len(server.requests) == 1
@@ -0,0 +1,66 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+
+import pytest
+
+from Opendatasoft import clusters
+
+
+def test_cluster_query_keeps_the_where_clause_and_the_extent():
+    params = clusters.cluster_params({'where': 'height > 10', 'order_by': 'height'}, 'geo_point_2d', 7,
+                                     'avg(height) as height', extent=(2.2, 48.8, 2.5, 48.9))
+
+    assert params == {
+        'select': 'count(*) as count, avg(height) as height',
+        'group_by': 'geo_cluster(geo_point_2d, 7) as cluster',
+        'where': '(height > 10) and (in_bbox(geo_point_2d, 48.8, 2.2, 48.9, 2.5))'}
+
+
+def test_cluster_query_without_filter_has_no_where_clause():
+    params = clusters.cluster_params({}, 'geo_point_2d', clusters.DEFAULT_PRECISION)
+
+    assert params == {'select': 'count(*) as count', 'group_by': 'geo_cluster(geo_point_2d, 5) as cluster'}
+
+
+@pytest.mark.parametrize('value', [
+    {'lon': 2.35, 'lat': 48.85},
+    {'type': 'Point', 'coordinates': [2.35, 48.85]},
+    {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [2.35, 48.85, 35.0]}, 'properties': {}},
+    json.dumps({'lon': 2.35, 'lat': 48.85}),
+])
+def test_cluster_centers_are_read_from_every_shape(value):
+    assert clusters.cluster_center(value) == (2.35, 48.85)
+
+
+def test_geohash_clusters_are_located_at_the_center_of_their_cell():
+    lon, lat = clusters.cluster_center('u09tvw')
+
+    assert lon == pytest.approx(2.3511, abs=0.006)
+    assert lat == pytest.approx(48.8566, abs=0.003)
+
+
+@pytest.mark.parametrize('value', [None, '', 'not a geohash!', {'type': 'Polygon', 'coordinates': []}, 12])
+def test_unknown_cluster_values_have_no_center(value):
+    assert clusters.cluster_center(value) is None
+
+
+def test_rows_become_point_features_with_their_aggregates():
+    feature = clusters.cluster_to_feature({'cluster': {'lon': 2.35, 'lat': 48.85}, 'count': 12, 'height': 8.5})
+
+    assert feature == {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [2.35, 48.85]},
+                       'properties': {'count': 12, 'height': 8.5}}
+    assert clusters.cluster_to_feature({'count': 3})['geometry'] is None
+
+
+def test_refined_precision_stops_at_the_maximum():
+    assert clusters.refined_precision(clusters.DEFAULT_PRECISION) == clusters.DEFAULT_PRECISION + clusters.REFINE_STEP
+    assert clusters.refined_precision(clusters.MAX_PRECISION - 1) == clusters.MAX_PRECISION
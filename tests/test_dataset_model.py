@@ -0,0 +1,167 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import threading
+from unittest import mock
+
+from Opendatasoft import dataset_model, ui_methods, utils
+from Opendatasoft.exceptions import RequestTimeoutError
+
+DOMAIN = 'example.opendatasoft.com'
+
+
+def served_catalog(monkeypatch, dataset_ids, local_search=None):
+    """Replace the catalog endpoint and the local search, returning the offsets of the pages requested."""
+    offsets = []
+
+    def import_dataset_page(domain_url, apikey, include_non_geo_dataset, text_search_param, offset, limit=100,
+                            timeout=None):
+        offsets.append(offset)
+        return dataset_ids[offset:offset + limit], len(dataset_ids)
+
+    monkeypatch.setattr(utils, 'import_dataset_page', import_dataset_page)
+    monkeypatch.setattr(dataset_model, 'local_dataset_search', lambda *args: local_search)
+    return offsets
+
+
+def query(text_search=None, force_refresh=False):
+    return {'domains': [DOMAIN], 'apikey': None, 'include_non_geo_dataset': True, 'text_search': text_search,
+            'force_refresh': force_refresh}
+
+
+def run_page_task(page_query, offset=0):
+    task = dataset_model.DatasetPageTask(page_query, 1, offset)
+    assert task.run()
+    return task
+
+
+def test_first_page_only_is_requested_from_the_server(monkeypatch):
+    dataset_ids = ['dataset-{:05d}'.format(number) for number in range(25000)]
+    offsets = served_catalog(monkeypatch, dataset_ids)
+
+    task = run_page_task(query('trees'))
+
+    assert task.dataset_ids == dataset_ids[:dataset_model.PAGE_SIZE]
+    assert task.local_search is None
+    assert offsets == [0]
+    # Pages past the query size limit of the catalog endpoint cannot be requested
+    assert task.total_count == utils.catalog_query_size_limit(DOMAIN)
+
+
+def test_next_pages_are_requested_by_offset(monkeypatch):
+    dataset_ids = ['dataset-{:03d}'.format(number) for number in range(250)]
+    offsets = served_catalog(monkeypatch, dataset_ids)
+
+    task = run_page_task(query(), offset=200)
+
+    assert task.dataset_ids == dataset_ids[200:]
+    assert task.total_count == 250
+    assert offsets == [200]
+
+
+def test_local_search_is_preferred_unless_refreshing(monkeypatch):
+    offsets = served_catalog(monkeypatch, ['listed'], local_search=lambda offset, limit: (['indexed'], 1))
+
+    task = run_page_task(query('trees'))
+    assert task.dataset_ids == ['indexed']
+    assert task.local_search is not None
+    assert offsets == []
+
+    task = run_page_task(query('trees', force_refresh=True))
+    assert task.dataset_ids == ['listed']
+    assert offsets == [0]
+
+
+def federated_query(*domains):
+    return dict(query('trees'), domains=list(domains))
+
+
+def test_federated_search_reports_each_domain_as_it_answers(monkeypatch):
+    slow_domain_answered = threading.Event()
+    timeouts = []
+
+    def import_dataset_page(domain_url, apikey, include_non_geo_dataset, text_search_param, offset, limit=100,
+                            timeout=None):
+        timeouts.append(timeout)
+        if domain_url == 'slow.example.com':
+            # Only answers once the other domains were reported
+            assert slow_domain_answered.wait(5)
+            return ['slow-trees'], 1
+        if domain_url == 'down.example.com':
+            raise RequestTimeoutError
+        return ['{}-trees'.format(domain_url.split('.')[0])], 1
+    monkeypatch.setattr(utils, 'import_dataset_page', import_dataset_page)
+    monkeypatch.setattr(utils, 'indexed_dataset_search', lambda *args: (
+        lambda offset, limit: (['indexed-trees'], 1)) if args[0] == 'indexed.example.com' else None)
+    task = dataset_model.FederatedSearchTask(federated_query(
+        'slow.example.com', 'fast.example.com', 'down.example.com', 'indexed.example.com'), 1, 2.5)
+    searched = []
+
+    def domain_searched(domain, dataset_ids, error):
+        searched.append((domain, dataset_ids, type(error).__name__ if error else None))
+        if len(searched) == 3:
+            slow_domain_answered.set()
+    task.domainSearched.connect(domain_searched)
+
+    assert task.run()
+
+    assert searched[-1] == ('slow.example.com', ['slow-trees'], None)
+    assert sorted(searched[:3]) == [('down.example.com', None, 'RequestTimeoutError'),
+                                    ('fast.example.com', ['fast-trees'], None),
+                                    ('indexed.example.com', ['indexed-trees'], None)]
+    assert timeouts == [2.5] * 3
+
+
+def test_federated_rows_keep_their_domain(monkeypatch):
+    model = dataset_model.DatasetListModel()
+    monkeypatch.setattr(model, 'searchDomains', mock.Mock())
+    failed = []
+    model.domainFailed.connect(lambda domain, error: failed.append(domain))
+    model.setQuery(['a.example.com', 'b.example.com'], None, True, 'trees')
+    task = mock.Mock(generation=model.generation)
+
+    model.domainSearched(task, 'b.example.com', ['parks'], None)
+    model.domainSearched(task, 'a.example.com', None, RequestTimeoutError())
+    model.domainSearched(task, 'a.example.com', ['trees', 'benches'], None)
+    # Answers to a previous query are dropped
+    model.domainSearched(mock.Mock(generation=model.generation - 1), 'c.example.com', ['old'], None)
+
+    model.searchDomains.assert_called_once_with()
+    assert model.isFederated()
+    assert model.datasets == [('b.example.com', 'parks'), ('a.example.com', 'trees'), ('a.example.com', 'benches')]
+    assert model.rowCount() == 4 and model.total_count == 3
+    assert failed == ['a.example.com']
+    # Only the first page of each domain is listed
+    assert not model.canFetchMore()
+
+
+def dialog_with_domains(text, current_text='', current_index=0):
+    dialog = mock.Mock()
+    dialog.domainInput.text.return_value = text
+    dialog.datasetListComboBox.currentText.return_value = current_text
+    dialog.datasetListComboBox.currentIndex.return_value = current_index
+    dialog.domains = lambda: ui_methods.ODSDialog.domains(dialog)
+    return dialog
+
+
+def test_domain_field_holds_several_domains():
+    dialog = dialog_with_domains('https://a.example.com/explore/, b.example.com;a.example.com  c.example.com/')
+
+    assert ui_methods.ODSDialog.domains(dialog) == ['a.example.com', 'b.example.com', 'c.example.com']
+
+
+def test_typed_dataset_is_looked_up_on_the_domain_of_its_label():
+    federated_dialog = dialog_with_domains('a.example.com, b.example.com', 'trees (b.example.com)')
+    single_dialog = dialog_with_domains('a.example.com', 'trees (b.example.com)')
+    unknown_domain_dialog = dialog_with_domains('a.example.com, b.example.com', 'trees (c.example.com)')
+
+    assert ui_methods.ODSDialog.selected_dataset(federated_dialog) == ('b.example.com', 'trees')
+    assert ui_methods.ODSDialog.selected_dataset(single_dialog) == ('a.example.com', 'trees (b.example.com)')
+    assert ui_methods.ODSDialog.selected_dataset(unknown_domain_dialog) == ('', 'trees (c.example.com)')
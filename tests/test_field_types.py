@@ -0,0 +1,66 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import api, tasks, utils, writers
+
+FIELDS = [{'name': 'name', 'type': 'text'}, {'name': 'height', 'type': 'double'},
+          {'name': 'planted', 'type': 'date'}, {'name': 'geo_point_2d', 'type': 'geo_point_2d'}]
+
+
+def test_pruned_select_keeps_the_geometry_field():
+    assert utils.pruned_select(['name', 'planted on'], 'geo_point_2d') == '`name`,`planted on`,`geo_point_2d`'
+    assert utils.pruned_select(['geo_point_2d', 'name'], 'geo_point_2d') == '`geo_point_2d`,`name`'
+    assert utils.pruned_select(['name']) == '`name`'
+
+
+@pytest.mark.parametrize('select', [None, '', 'name,height', '`name`,`geo_point_2d`'])
+def test_exported_fields_keep_their_schema_type(select):
+    assert utils.export_field_types(FIELDS, {'select': select}) == {
+        'name': 'text', 'height': 'double', 'planted': 'date', 'geo_point_2d': 'geo_point_2d'}
+
+
+@pytest.mark.parametrize('select', ['count(*) as trees', 'height AS size', 'year(planted)'])
+def test_computed_or_renamed_fields_have_no_known_type(select):
+    assert utils.export_field_types(FIELDS, {'select': select}) == {}
+
+
+def test_export_of_some_fields_prunes_the_select_and_types_the_layer(monkeypatch, tmp_path):
+    monkeypatch.setattr(api, 'get_schema', lambda *args: mock.Mock(fields=FIELDS, geom_column='geo_point_2d'))
+    import_dataset_to_qgis = mock.Mock(return_value=(mock.Mock(), 10))
+    download_to_file = mock.Mock()
+    monkeypatch.setattr(utils, 'import_dataset_to_qgis', import_dataset_to_qgis)
+    monkeypatch.setattr(tasks, 'download_to_file', download_to_file)
+
+    api.export_dataset('data.example.com', 'trees', str(tmp_path / 'trees.gpkg'), select='name,height',
+                       export_format=writers.GEOJSON, fields=['name', 'height'])
+
+    assert import_dataset_to_qgis.call_args[0][2] == {'select': '`name`,`height`,`geo_point_2d`'}
+    assert download_to_file.call_args[1]['field_types']['height'] == 'double'
+
+
+def test_layer_fields_are_created_with_their_schema_type(monkeypatch, tmp_path):
+    ogr = mock.Mock(name='ogr')
+    monkeypatch.setattr(writers, 'ogr', ogr)
+    monkeypatch.setattr(writers, 'osr', mock.Mock(name='osr'))
+    monkeypatch.setattr(writers, 'ODS_FIELD_TYPES', {'double': ('real', 'none'), 'date': ('date', 'none')})
+    writer = writers.GeoPackageWriter(str(tmp_path / 'trees.gpkg'), 'trees',
+                                      field_types={'height': 'double', 'planted': 'date', 'name': 'text'})
+
+    # A height typed as an integer in the first record still makes a real field
+    writer.write({'type': 'Feature', 'geometry': None,
+                  'properties': {'height': 12, 'planted': '2001-03-04', 'name': 'oak', 'age': 4}})
+    writer.close()
+
+    created = {call[0][0]: call[0][1] for call in ogr.FieldDefn.call_args_list}
+    assert created == {'height': 'real', 'planted': 'date', 'name': ogr.OFTString, 'age': ogr.OFTInteger64}
@@ -0,0 +1,131 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import http.server
+import json
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from Opendatasoft import instrumentation
+
+BODY = b'{"total_count": 0, "results": []}' * 100
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def clear_events():
+    instrumentation.clear()
+    yield
+    instrumentation.clear()
+
+
+def timed_session():
+    session = requests.Session()
+    session.mount('http://', instrumentation.TimedHTTPAdapter())
+    return session
+
+
+def tracked_get(session, url, stream=False):
+    instrumentation.start_request()
+    start = time.monotonic()
+    return instrumentation.track_response(session.get(url, stream=stream), url, start)
+
+
+def test_phase_records_its_duration_and_failure():
+    with instrumentation.phase('convert', dataset_id='trees') as metrics:
+        metrics['records'] = 3
+    with pytest.raises(ValueError):
+        with instrumentation.phase('convert', dataset_id='trees'):
+            raise ValueError
+
+    succeeded, failed = instrumentation.events()
+    assert succeeded['kind'] == 'phase' and succeeded['name'] == 'convert'
+    assert succeeded['records'] == 3 and succeeded['duration'] >= 0 and 'failed' not in succeeded
+    assert failed['failed'] is True and failed['dataset_id'] == 'trees'
+
+
+def test_streamed_response_is_recorded_when_closed_with_its_connection_timings(server):
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    session = timed_session()
+
+    response = tracked_get(session, url, stream=True)
+    assert not instrumentation.events()
+    content = b''.join(response.iter_content(chunk_size=100))
+    response.close()
+    response.close()
+    tracked_get(session, url)
+    session.close()
+
+    first, second = instrumentation.events()
+    assert content == BODY
+    assert first['kind'] == 'http' and first['name'] == url and first['status'] == 200
+    assert first['bytes'] == len(BODY) and not first['reused_connection']
+    assert first['dns'] >= 0 and first['connect'] >= 0
+    assert second['bytes'] == len(BODY) and second['reused_connection'] and 'dns' not in second
+
+
+def test_every_resolved_address_is_tried_in_turn(server, monkeypatch):
+    getaddrinfo = socket.getaddrinfo
+    closed_socket = socket.socket()
+    closed_socket.bind(('127.0.0.1', 0))
+    closed_port = closed_socket.getsockname()[1]
+    closed_socket.close()
+
+    def resolve(host, port, *args, **kwargs):
+        if host != 'trees.example':
+            return getaddrinfo(host, port, *args, **kwargs)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', closed_port)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', server.server_address[1]))]
+    monkeypatch.setattr(socket, 'getaddrinfo', resolve)
+    session = timed_session()
+
+    response = tracked_get(session, 'http://trees.example:{}/'.format(server.server_address[1]))
+    session.close()
+
+    assert response.content == BODY
+    assert instrumentation.events()[0]['dns'] >= 0
+
+
+def test_events_are_exported_as_json(tmp_path):
+    instrumentation.record('retry', 'catalog/datasets', attempt=1, delay=0.5)
+    file_path = str(tmp_path / 'events.json')
+
+    instrumentation.export_json(file_path)
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        events = json.load(f)
+    assert events == instrumentation.events()
+    assert events[0]['kind'] == 'retry' and events[0]['attempt'] == 1 and 'time' in events[0]
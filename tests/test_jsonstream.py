@@ -0,0 +1,85 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+
+import pytest
+
+from Opendatasoft import jsonstream
+
+FEATURES = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [2.35, 48.85]},
+             'properties': {'name': 'Châtaignier n°{}'.format(number), 'height': 12345 + number, 'tags': ['a', ']']}}
+            for number in range(20)]
+
+
+def chunked(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 100000])
+def test_features_are_read_whatever_the_chunk_size(chunk_size):
+    document = json.dumps({'type': 'FeatureCollection', 'features': FEATURES}, ensure_ascii=False).encode('utf-8')
+
+    assert list(jsonstream.iter_json_array(chunked(document, chunk_size), 'features')) == FEATURES
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 1000])
+def test_top_level_arrays_of_scalars_are_read(chunk_size):
+    values = [12345, 'dataset-1', 3.25, True, None, 678]
+
+    assert list(jsonstream.iter_json_array(chunked(json.dumps(values).encode('utf-8'), chunk_size))) == values
+
+
+def test_truncated_stream_raises_value_error():
+    document = json.dumps({'features': FEATURES}).encode('utf-8')
+    items = []
+
+    with pytest.raises(ValueError):
+        for item in jsonstream.iter_json_array(chunked(document[:len(document) // 2], 50), 'features'):
+            items.append(item)
+    assert items == FEATURES[:len(items)]
+    assert items
+
+
+def test_key_which_is_not_an_array_raises_value_error():
+    with pytest.raises(ValueError):
+        list(jsonstream.iter_json_array([b'{"features": {"type": "Feature"}}'], 'features'))
+
+
+def test_features_split_across_chunks_are_counted_once():
+    document = json.dumps({'type': 'FeatureCollection', 'features': FEATURES}).encode('utf-8')
+    counter = jsonstream.FeatureCounter()
+
+    for chunk in chunked(document, 5):
+        counter.update(chunk)
+
+    assert counter.count == len(FEATURES)
+    counter.reset()
+    assert counter.count == 0
+
+
+@pytest.mark.parametrize('chunk_size', [1, 9, 1000])
+def test_json_lines_are_read_without_a_final_newline(chunk_size):
+    records = [{'name': 'Châtaignier', 'height': number} for number in range(5)]
+    lines = '\n'.join(json.dumps(record, ensure_ascii=False) for record in records).encode('utf-8')
+
+    assert list(jsonstream.iter_json_lines(chunked(lines + b'\n\n', chunk_size))) == records
+    assert list(jsonstream.iter_json_lines(chunked(lines, chunk_size))) == records
+
+
+def test_array_prefix_of_a_truncated_stream_ends_after_its_last_complete_item():
+    document = json.dumps({'type': 'FeatureCollection', 'features': FEATURES}, ensure_ascii=False).encode('utf-8')
+    truncated = document[:document.index(b'n\xc2\xb010')]
+
+    count, end = jsonstream.array_prefix(chunked(truncated, 7), 'features')
+
+    assert count == 10
+    assert json.loads(document[:end] + b']}')['features'] == FEATURES[:10]
+    assert jsonstream.array_prefix(chunked(document[:20], 7), 'features') == (0, None)
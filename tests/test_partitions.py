@@ -0,0 +1,151 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+import re
+import types
+from unittest import mock
+
+from Opendatasoft import partitions, writers
+
+DATASET_ID = 'trees'
+PARTITION_WHERE = re.compile(r'^height >= (\S+) and height (<=|<) (\S+)$')
+NESTED_WHERE = re.compile(r'^\((.*)\) and \((.*)\)$')
+ID_WHERE = re.compile(r'^id > (\d+)$')
+
+
+class StubResponse:
+    def __init__(self, content, url='', chunk_size=37):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.request = types.SimpleNamespace(url=url)
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def close(self):
+        pass
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=None):
+        # Small chunks, so that features are split across chunks
+        for start in range(0, len(self.content), self.chunk_size):
+            yield self.content[start:start + self.chunk_size]
+
+
+class StubClient:
+    """Serves the records of one dataset, understanding the where clauses written by partition_params only."""
+    def __init__(self, records):
+        self.records = records
+        self.requests = []
+
+    def get(self, path, params=None, headers=None, stream=False, not_found_error=None, timeout=None):
+        self.requests.append((path, dict(params or {})))
+        records = [record for record in self.records if matches(record, (params or {}).get('where'))]
+        if path.endswith('/records'):
+            heights = [record['height'] for record in records if record['height'] is not None]
+            return StubResponse(json.dumps({'results': [{'min_value': min(heights, default=None),
+                                                         'max_value': max(heights, default=None)}]}).encode())
+        features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [record['id'], 45.0]},
+                     'properties': record} for record in records]
+        return StubResponse(json.dumps({'type': 'FeatureCollection', 'features': features}).encode('utf-8'),
+                            '{}?{}'.format(path, params))
+
+
+def matches(record, where):
+    if where is None:
+        return True
+    if NESTED_WHERE.match(where):
+        return all(matches(record, clause) for clause in NESTED_WHERE.match(where).groups())
+    if ID_WHERE.match(where):
+        return record['id'] > int(ID_WHERE.match(where).group(1))
+    if where == 'height is null':
+        return record['height'] is None
+    lower, operator, upper = PARTITION_WHERE.match(where).groups()
+    if record['height'] is None or record['height'] < float(lower):
+        return False
+    return record['height'] <= float(upper) if operator == '<=' else record['height'] < float(upper)
+
+
+def read_features(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return sorted(json.load(f)['features'], key=lambda feature: feature['properties']['id'])
+
+
+def test_merged_partitions_equal_the_single_stream_export(tmp_path):
+    records = [{'id': number, 'name': 'tree {}'.format(number),
+                'height': None if number % 7 == 0 else (number * 37) % 101 / 4} for number in range(500)]
+    ods_client = StubClient(records)
+    single_path = str(tmp_path / 'single.geojson')
+    with ods_client.get('catalog/datasets/{}/exports/geojson'.format(DATASET_ID), {}, stream=True) as response:
+        writers.write_features(
+            partitions.jsonstream.iter_json_array(response.iter_content(), 'features'), single_path, writers.GEOJSON,
+            DATASET_ID)
+    merged_path = str(tmp_path / 'merged.geojson')
+    reports = []
+    merges = []
+
+    partition_params = partitions.partition_params(ods_client, DATASET_ID, {}, 'height', 4)
+    partitions.download_partitions(ods_client, DATASET_ID, partition_params, merged_path,
+                                   lambda downloaded, records_count: reports.append(records_count), lambda: False,
+                                   report_merge=lambda merged, records_count: merges.append((merged, records_count)))
+
+    assert partition_params[0] == {'where': 'height is null'}
+    assert len(partition_params) == 5
+    merged_features = read_features(merged_path)
+    assert merged_features == read_features(single_path)
+    assert len([feature for feature in merged_features if feature['properties']['height'] is None]) == 72
+    assert not list(tmp_path.glob('merged.geojson.part*'))
+    assert len(merges) == 500 and merges[-1] == (500, 500)
+
+
+def test_partitions_keep_the_where_clause_of_the_query(tmp_path):
+    records = [{'id': number, 'height': float(number)} for number in range(10)]
+
+    partition_params = partitions.partition_params(StubClient(records), DATASET_ID, {'where': 'id > 2'}, 'height', 2)
+
+    assert [params['where'] for params in partition_params] == [
+        '(id > 2) and (height is null)', '(id > 2) and (height >= 3.0 and height < 6.0)',
+        '(id > 2) and (height >= 6.0 and height <= 9.0)']
+
+
+def test_dates_in_utc_written_with_z_are_partitioned():
+    partition_params = partitions.partition_params(
+        mock.Mock(**{'get.return_value.json.return_value': {'results': [
+            {'min_value': '2024-01-01T00:00:00Z', 'max_value': '2024-01-03T00:00:00Z'}]}}),
+        DATASET_ID, {}, 'planted', 2)
+
+    assert len(partition_params) == 3
+    assert partition_params[1]['where'].startswith(
+        "planted >= date'2024-01-01T00:00:00Z' and planted < date'2024-01-02")
+    assert partition_params[2]['where'].endswith("planted <= date'2024-01-03T00:00:00Z'")
+    assert partitions.parse_date('2024-01-01T00:00:00Z') == partitions.parse_date('2024-01-01T00:00:00+00:00')
+
+
+def test_merge_reports_the_features_merged(tmp_path):
+    paths = []
+    for index, numbers in enumerate([range(3), range(3, 5)]):
+        path = tmp_path / 'part{}'.format(index)
+        path.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'geometry': None, 'properties': {'id': number}} for number in numbers]}))
+        paths.append(str(path))
+    merged = []
+
+    partitions.merge_geojson_files(paths, str(tmp_path / 'merged.geojson'), report_progress=merged.append)
+
+    assert merged == [1, 2, 3, 4, 5]
+    assert [feature['properties']['id'] for feature in read_features(str(tmp_path / 'merged.geojson'))] == \
+        list(range(5))
@@ -0,0 +1,90 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import tasks, utils, writers
+from Opendatasoft.exceptions import DatasetError, NumberOfLinesError, OdsqlError
+
+DOMAIN = 'data.example.com'
+DATASET_ID = 'trees'
+QUERY = {'select': 'name,height', 'where': 'height > 10', 'order_by': 'height', 'limit': '50', 'apikey': 'secret'}
+
+
+@pytest.fixture
+def ods_client(monkeypatch):
+    """Client of a domain whose count query matches 120 records, recording the API keys it is built with."""
+    ods_client = mock.Mock(apikeys=[], export=mock.Mock())
+
+    def get(path, params, **kwargs):
+        if path.endswith('/records'):
+            return mock.Mock(json=lambda: {'total_count': 120, 'results': []})
+        return ods_client.export
+    ods_client.get.side_effect = get
+
+    def get_client(domain, apikey=None):
+        ods_client.apikeys.append(apikey)
+        return ods_client
+    monkeypatch.setattr(utils.client, 'get_client', get_client)
+    return ods_client
+
+
+def test_query_is_validated_by_a_zero_row_count_before_the_export(ods_client):
+    imported_dataset, records_count = utils.import_dataset_to_qgis(DOMAIN, DATASET_ID, QUERY, writers.JSONL)
+
+    (count_path, count_params), _ = ods_client.get.call_args_list[0]
+    (export_path, export_params), export_options = ods_client.get.call_args_list[1]
+    assert count_path == 'catalog/datasets/trees/records'
+    assert count_params == {'select': 'name,height', 'where': 'height > 10', 'order_by': 'height', 'limit': 0}
+    assert export_path == 'catalog/datasets/trees/exports/jsonl'
+    assert export_params == {'select': 'name,height', 'where': 'height > 10', 'order_by': 'height', 'limit': '50'}
+    assert export_options['stream']
+    assert ods_client.apikeys == ['secret']
+    # The export stops at the limit of the query
+    assert records_count == 50
+    assert imported_dataset is ods_client.export
+
+
+def test_count_without_limit_is_the_number_of_matching_records(ods_client):
+    query = dict(QUERY)
+    query.pop('limit')
+
+    assert utils.import_dataset_to_qgis(DOMAIN, DATASET_ID, query)[1] == 120
+
+
+@pytest.mark.parametrize('error', [OdsqlError('Unknown field: heigth'), DatasetError()])
+def test_rejected_query_opens_no_export(ods_client, error):
+    ods_client.get.side_effect = error
+
+    with pytest.raises(type(error)):
+        utils.import_dataset_to_qgis(DOMAIN, DATASET_ID, QUERY)
+
+    ods_client.get.assert_called_once()
+    assert ods_client.get.call_args[0][0].endswith('/records')
+
+
+@pytest.mark.parametrize('limit', ['ten', '-2'])
+def test_invalid_limit_is_rejected_before_any_request(ods_client, limit):
+    with pytest.raises(NumberOfLinesError):
+        utils.import_dataset_to_qgis(DOMAIN, DATASET_ID, dict(QUERY, limit=limit))
+
+    ods_client.get.assert_not_called()
+
+
+def test_progress_shows_the_percentage_and_time_left_of_counted_exports():
+    text = tasks.progress_text(3 * 1024 * 1024, 25, 100, 30)
+
+    assert 'Downloaded: 3MB' in text
+    assert 'Records: 25/100 (25%)' in text
+    assert 'Time left: 1m30s' in text
+    assert 'Records' not in tasks.progress_text(1024, 25, None, 30)
+    assert tasks.format_duration(2 * 3600 + 5 * 60) == '2h05m'
@@ -0,0 +1,150 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import dataset_store, tasks, utils, writers
+
+DOMAIN = 'data.example.com'
+DATASET_ID = 'trees'
+LAST_TIMESTAMP = '2024-03-01T10:00:00+00:00'
+
+
+def metadata(modified):
+    return {'total_count': 1, 'results': [{'metas': {'default': {'modified': modified, 'data_processed': None}}}]}
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """Dataset store in tmp_path, holding the GeoPackage import of DATASET_ID made when it was modified on March 1st."""
+    store = dataset_store.DatasetStore(str(tmp_path / 'store.json'))
+    monkeypatch.setattr(dataset_store, 'default_dataset_store', lambda: store)
+    file_path = tmp_path / 'trees.gpkg'
+    file_path.write_bytes(b'')
+    store.put(store.key(DOMAIN, DATASET_ID, {}), {
+        'file_path': str(file_path), 'output_format': writers.GEOPACKAGE,
+        'signature': dataset_store.modification_signature(metadata('2024-03-01')),
+        'timestamp_field': 'updated at', 'last_timestamp': LAST_TIMESTAMP})
+    store.file = file_path
+    return store
+
+
+@pytest.fixture
+def started_tasks(monkeypatch):
+    started = []
+    monkeypatch.setattr(tasks, 'start_task', started.append)
+    monkeypatch.setattr(tasks, 'add_layer_to_project', lambda *args: started.append(args))
+    monkeypatch.setattr(utils.ui_methods, 'CancelImportDialog', mock.Mock())
+    monkeypatch.setattr(tasks, 'RefreshDatasetTask', mock.Mock(side_effect=lambda *args: mock.Mock(args=args)))
+    return started
+
+
+def stub_client(monkeypatch):
+    ods_client = mock.Mock()
+
+    def get(path, params=None, **kwargs):
+        if path.endswith('/records') and 'select' in params:
+            return mock.Mock(json=lambda: {'results': [{'max_value': '2024-03-02T08:00:00+00:00'}]})
+        if path.endswith('/records'):
+            return mock.Mock(json=lambda: {'total_count': 12})
+        return mock.Mock(name='export')
+    ods_client.get.side_effect = get
+    monkeypatch.setattr(utils.client, 'get_client', lambda domain, apikey=None: ods_client)
+    return ods_client
+
+
+def test_store_forgets_entries_whose_file_was_removed(store):
+    key = store.key(DOMAIN, DATASET_ID, {})
+
+    assert store.get(key)['last_timestamp'] == LAST_TIMESTAMP
+    assert store.get(store.key(DOMAIN, DATASET_ID, {'where': 'height > 10'})) is None
+    store.file.unlink()
+    assert store.get(key) is None
+    store.remove(key)
+    assert store._load() == {}
+
+
+def test_unchanged_dataset_reuses_the_stored_layer(store, started_tasks, monkeypatch):
+    monkeypatch.setattr(utils, 'import_dataset_metadata', lambda *args: metadata('2024-03-01'))
+    ods_client = stub_client(monkeypatch)
+
+    assert utils.refresh_dataset_to_qgis(DOMAIN, DATASET_ID, {}, writers.GEOPACKAGE, 'updated at', 'id')
+
+    assert started_tasks == [(str(store.file), writers.GEOPACKAGE, DATASET_ID)]
+    ods_client.get.assert_not_called()
+
+
+def test_modified_dataset_downloads_the_records_since_the_last_timestamp(store, started_tasks, monkeypatch):
+    monkeypatch.setattr(utils, 'import_dataset_metadata', lambda *args: metadata('2024-03-02'))
+    ods_client = stub_client(monkeypatch)
+
+    assert utils.refresh_dataset_to_qgis(DOMAIN, DATASET_ID, {}, writers.GEOPACKAGE, 'updated at', 'id')
+
+    (task,) = started_tasks
+    export_path, export_params = ods_client.get.call_args_list[-1][0]
+    assert export_path == 'catalog/datasets/{}/exports/geojson'.format(DATASET_ID)
+    # Records of the last timestamp are downloaded again, the upsert on the key field replacing them
+    assert export_params['where'] == "`updated at` >= date'{}'".format(LAST_TIMESTAMP)
+    assert ods_client.get.call_args_list[0][0][1]['select'] == 'max(`updated at`) as max_value'
+    assert task.args[3:] == (12, 'id')
+    # Called once the task completes
+    task.taskCompleted.connect.call_args[0][0]()
+    assert store.get(store.key(DOMAIN, DATASET_ID, {}))['last_timestamp'] == '2024-03-02T08:00:00+00:00'
+
+
+def test_refresh_without_key_field_only_downloads_newer_records(store, started_tasks, monkeypatch):
+    monkeypatch.setattr(utils, 'import_dataset_metadata', lambda *args: metadata('2024-03-02'))
+    ods_client = stub_client(monkeypatch)
+    store.put(store.key(DOMAIN, DATASET_ID, {'where': 'height > 10'}), store.get(store.key(DOMAIN, DATASET_ID, {})))
+
+    assert utils.refresh_dataset_to_qgis(DOMAIN, DATASET_ID, {'where': 'height > 10'}, writers.GEOPACKAGE,
+                                         'updated at')
+
+    assert ods_client.get.call_args_list[-1][0][1]['where'] == \
+        "(height > 10) and (`updated at` > date'{}')".format(LAST_TIMESTAMP)
+
+
+class FakeGeoPackageWriter:
+    """Features of a GeoPackage layer, kept in memory."""
+    layers = {}
+
+    def __init__(self, file_path, layer_name, append=False, field_types=None, batch_size=2):
+        self.features = self.layers.setdefault(file_path, [])
+        self.batch_size = batch_size
+        self.count = 0
+
+    def write(self, feature):
+        self.features.append(feature)
+        self.count += 1
+
+    def delete_where_in(self, field_name, values):
+        self.features[:] = [feature for feature in self.features if feature['properties'][field_name] not in values]
+
+    def close(self):
+        pass
+
+
+def test_upsert_replaces_the_features_stored_with_the_same_key(monkeypatch):
+    monkeypatch.setattr(writers, 'GeoPackageWriter', FakeGeoPackageWriter)
+    monkeypatch.setattr(FakeGeoPackageWriter, 'layers', {})
+
+    def feature(key, version):
+        return {'type': 'Feature', 'geometry': None, 'properties': {'id': key, 'version': version}}
+    writers.upsert_features([feature(key, 1) for key in range(5)], 'trees.gpkg', DATASET_ID, 'id')
+
+    written = writers.upsert_features([feature(3, 2), feature(4, 2), feature(5, 2)], 'trees.gpkg', DATASET_ID, 'id')
+    writers.upsert_features([feature(6, 1)], 'trees.gpkg', DATASET_ID)
+
+    assert written == 3
+    assert sorted((f['properties']['id'], f['properties']['version'])
+                  for f in FakeGeoPackageWriter.layers['trees.gpkg']) == [
+        (0, 1), (1, 1), (2, 1), (3, 2), (4, 2), (5, 2), (6, 1)]
@@ -0,0 +1,193 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import http.server
+import json
+import threading
+import urllib.parse
+
+import pytest
+
+from Opendatasoft import client, jsonstream, resumable
+
+EXPORT_PATH = 'catalog/datasets/trees/exports/geojson'
+PAYLOAD = bytes(range(256)) * 4096
+ETAG = '"trees-v1"'
+FEATURES = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [number, 45.0]},
+             'properties': {'id': number, 'name': 'tree {}'.format(number)}} for number in range(3000)]
+
+
+class DroppingHandler(http.server.BaseHTTPRequestHandler):
+    """Serves PAYLOAD, closing the connection after sending drop_after bytes of the first drops responses."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        start = 0
+        if self.server.honor_range and self.headers.get('If-Range') == ETAG and self.headers.get('Range'):
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(PAYLOAD) - start))
+        self.send_header('ETag', ETAG)
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(PAYLOAD) - 1, len(PAYLOAD)))
+        self.end_headers()
+        end = len(PAYLOAD)
+        if self.server.drops:
+            self.server.drops -= 1
+            end = start + self.server.drop_after
+        self.wfile.write(PAYLOAD[start:end])
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the GeoJSON export of FEATURES from its offset query parameter, without any validator
+    nor Range support, closing the connection after sending drop_after bytes of the first drops responses.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        self.server.requests.append(params)
+        offset = int(params.get('offset', 0))
+        body = json.dumps({'type': 'FeatureCollection', 'features': FEATURES[offset:]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        end = len(body)
+        if self.server.drops:
+            self.server.drops -= 1
+            end = self.server.drop_after
+        self.wfile.write(body[:end])
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(monkeypatch, handler):
+    monkeypatch.setattr(resumable, 'RETRY_DELAY', 0)
+    http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    http_server.requests = []
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    return http_server
+
+
+@pytest.fixture
+def records_server(monkeypatch):
+    http_server = start_server(monkeypatch, RecordsHandler)
+    http_server.drops = 2
+    # Cuts a feature, and the chunk being read when the connection drops is lost
+    http_server.drop_after = 2 * resumable.DOWNLOAD_CHUNK_SIZE + 1000
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    http_server = start_server(monkeypatch, DroppingHandler)
+    http_server.honor_range = True
+    http_server.drops = len(PAYLOAD)
+    # Bytes of the chunk being read when the connection drops are lost
+    http_server.drop_after = 2 * resumable.DOWNLOAD_CHUNK_SIZE + 1000
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def open_export(http_server, params=None):
+    ods_client = client.OdsClient('http://127.0.0.1:{}'.format(http_server.server_address[1]),
+                                  scheduler=client.RequestScheduler())
+    return ods_client, ods_client.get(EXPORT_PATH, params, stream=True)
+
+
+def download(http_server, file_path, feature_counter=None, records_key=None):
+    ods_client, response = open_export(http_server)
+    chunks = list(resumable.ResumableDownload(response, str(file_path), feature_counter, records_key).chunks(
+        lambda: False))
+    ods_client.close()
+    return chunks
+
+
+def test_dropped_download_resumes_from_the_last_byte_written(server, tmp_path):
+    file_path = tmp_path / 'trees.geojson'
+
+    download(server, file_path)
+
+    assert file_path.read_bytes() == PAYLOAD
+    # More drops than MAX_RETRIES: the count of failures starts over whenever bytes arrive
+    assert len(server.requests) > resumable.MAX_RETRIES + 1
+    assert server.requests[1]['Range'] == 'bytes={}-'.format(2 * resumable.DOWNLOAD_CHUNK_SIZE)
+    assert server.requests[1]['If-Range'] == ETAG
+    assert not resumable.has_checkpoint(str(file_path))
+
+
+def test_download_starts_over_when_the_server_ignores_the_range(server, tmp_path):
+    server.honor_range = False
+    server.drops = 1
+    server.drop_after = len(PAYLOAD) // 2
+    file_path = tmp_path / 'trees.geojson'
+
+    download(server, file_path)
+
+    assert file_path.read_bytes() == PAYLOAD
+    assert len(server.requests) == 2
+
+
+def test_download_fails_after_max_retries_without_progress(server, tmp_path):
+    server.drop_after = 0
+    file_path = tmp_path / 'trees.geojson'
+
+    with pytest.raises(resumable.RETRYABLE_ERRORS):
+        download(server, file_path)
+
+    assert len(server.requests) == resumable.MAX_RETRIES + 1
+    assert resumable.has_checkpoint(str(file_path))
+
+
+def test_download_without_validator_resumes_from_the_last_feature_written(records_server, tmp_path):
+    file_path = tmp_path / 'trees.geojson'
+    feature_counter = jsonstream.FeatureCounter()
+
+    download(records_server, file_path, feature_counter, 'features')
+
+    with open(str(file_path), 'r', encoding='utf-8') as f:
+        assert json.load(f)['features'] == FEATURES
+    assert feature_counter.count == len(FEATURES)
+    assert len(records_server.requests) == 3
+    offsets = [int(params.get('offset', 0)) for params in records_server.requests]
+    assert offsets == sorted(offsets) and 0 < offsets[1] < len(FEATURES)
+    assert not resumable.has_checkpoint(str(file_path))
+
+
+def test_records_without_validator_are_read_again_from_the_last_record(records_server):
+    ods_client, response = open_export(records_server, {'limit': len(FEATURES)})
+
+    features = list(resumable.iter_records(response, lambda chunks: jsonstream.iter_json_array(chunks, 'features')))
+    ods_client.close()
+
+    assert features == FEATURES
+    assert len(records_server.requests) == 3
+    resumed = records_server.requests[1]
+    assert int(resumed['offset']) + int(resumed['limit']) == len(FEATURES)
+
+
+def test_resumed_params_skip_the_records_read():
+    assert resumable.resumed_params({'where': 'id > 2'}, 10) == {'where': 'id > 2', 'offset': 10}
+    assert resumable.resumed_params({'offset': 5, 'limit': 100}, 10) == {'offset': 15, 'limit': 90}
+    assert resumable.resumed_params({'limit': -1}, 10) == {'limit': -1, 'offset': 10}
@@ -0,0 +1,133 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import schema, tasks, ui_methods
+from Opendatasoft.exceptions import DomainError, InternalError, RateLimitError
+
+DOMAIN = 'data.example.com'
+DATASET_ID = 'trees'
+
+
+def fetched_dialog(task, import_dataset=False, shown_columns=0):
+    dialog = mock.Mock()
+    dialog.schemaTask = task
+    dialog.selected_dataset.return_value = (DOMAIN, DATASET_ID)
+    dialog.schemaTableWidget.columnCount.return_value = shown_columns
+    ui_methods.ODSDialog.schemaFetched(dialog, task, True, import_dataset)
+    return dialog
+
+
+@pytest.mark.parametrize('error', [DomainError(), InternalError(), RateLimitError('Too many requests')])
+def test_failed_schema_task_shows_its_error_without_fetching_again(monkeypatch, error):
+    fetches = []
+
+    def get_dataset_schema(domain_url, dataset_id, apikey):
+        fetches.append(dataset_id)
+        raise error
+
+    monkeypatch.setattr(schema, 'get_dataset_schema', get_dataset_schema)
+    task = schema.SchemaTask(DOMAIN, DATASET_ID, None)
+
+    assert not task.run()
+    dialog = fetched_dialog(task)
+
+    assert task.error is error
+    dialog.showSchemaError.assert_called_once_with(error)
+    dialog.showSchema.assert_not_called()
+    assert fetches == [DATASET_ID]
+    assert dialog.schemaTask is None
+
+
+def test_fetched_schema_is_shown_from_the_task(monkeypatch):
+    dataset_schema = object()
+    monkeypatch.setattr(schema, 'get_dataset_schema', lambda domain_url, dataset_id, apikey: dataset_schema)
+    task = schema.SchemaTask(DOMAIN, DATASET_ID, None)
+
+    assert task.run()
+    dialog = fetched_dialog(task)
+
+    dialog.showSchema.assert_called_once_with(dataset_schema, True)
+    dialog.showSchemaError.assert_not_called()
+
+
+def test_schema_of_a_dataset_no_longer_selected_is_not_shown(monkeypatch):
+    monkeypatch.setattr(schema, 'get_dataset_schema', lambda domain_url, dataset_id, apikey: object())
+    task = schema.SchemaTask(DOMAIN, 'other-dataset', None)
+    task.run()
+
+    dialog = fetched_dialog(task)
+
+    dialog.showSchema.assert_not_called()
+    dialog.showSchemaError.assert_not_called()
+
+
+@pytest.mark.parametrize('shown_columns', [0, 3])
+def test_import_waiting_for_the_schema_goes_on_once_it_is_fetched(monkeypatch, shown_columns):
+    dataset_schema = object()
+    monkeypatch.setattr(schema, 'get_dataset_schema', lambda domain_url, dataset_id, apikey: dataset_schema)
+    task = schema.SchemaTask(DOMAIN, DATASET_ID, 'secret')
+    task.run()
+
+    dialog = fetched_dialog(task, import_dataset=True, shown_columns=shown_columns)
+
+    assert dialog.datasetSchema is dataset_schema
+    assert dialog.datasetSchemaKey == (DOMAIN, DATASET_ID, 'secret')
+    # A schema table already filled is kept, with the columns selected in it
+    assert dialog.showSchema.called == (shown_columns == 0)
+    dialog.importDataset.assert_called_once_with()
+
+
+def test_import_without_a_fetched_schema_fetches_it_in_the_background(monkeypatch):
+    def get_dataset_schema(domain_url, dataset_id, apikey):
+        raise AssertionError('The schema must not be fetched from the main thread')
+    monkeypatch.setattr(schema, 'get_dataset_schema', get_dataset_schema)
+    dialog = mock.Mock()
+    dialog.domain.return_value = DOMAIN
+    dialog.dataset_id.return_value = DATASET_ID
+    dialog.batch_dataset_ids.return_value = []
+    dialog.loadedSchema.return_value = None
+
+    ui_methods.ODSDialog.importDataset(dialog)
+
+    dialog.fetchSchema.assert_called_once_with(import_dataset=True)
+    dialog.close.assert_not_called()
+
+
+def test_loaded_schema_belongs_to_the_selected_dataset_and_api_key():
+    dialog = mock.Mock()
+    dialog.datasetSchema = dataset_schema = object()
+    dialog.datasetSchemaKey = (DOMAIN, DATASET_ID, None)
+    dialog.domain.return_value = DOMAIN
+    dialog.dataset_id.return_value = DATASET_ID
+    dialog.apikey.return_value = None
+
+    assert ui_methods.ODSDialog.loadedSchema(dialog) is dataset_schema
+    dialog.apikey.return_value = 'secret'
+    assert ui_methods.ODSDialog.loadedSchema(dialog) is None
+
+
+def test_schema_task_is_kept_alive_until_it_finishes(monkeypatch):
+    started = []
+    monkeypatch.setattr(tasks, 'start_task', started.append)
+    dialog = mock.Mock()
+    dialog.domain.return_value = DOMAIN
+    dialog.dataset_id.return_value = DATASET_ID
+    dialog.apikey.return_value = None
+    dialog.dialogButtonBox.buttons.return_value = []
+
+    ui_methods.ODSDialog.fetchSchema(dialog, clear_filters=True)
+
+    (task,) = started
+    assert isinstance(task, schema.SchemaTask) and dialog.schemaTask is task
+    dialog.schemaTableWidget.setColumnCount.assert_called_once_with(0)
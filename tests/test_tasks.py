@@ -0,0 +1,253 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import threading
+import types
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import tasks, writers
+from Opendatasoft.exceptions import DatasetError
+
+
+class StubResponse:
+    def __init__(self, headers=None, content=b'', error=None):
+        self.headers = headers or {}
+        self.content = content
+        self.error = error
+        self.request = types.SimpleNamespace(url='catalog/datasets/trees/exports/geojson')
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for start in range(0, len(self.content), 10):
+            yield self.content[start:start + 10]
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def batch_task(tmp_path, dataset_ids, open_export):
+    file_paths = {dataset_id: str(tmp_path / '{}.gpkg'.format(dataset_id)) for dataset_id in dataset_ids}
+    return tasks.BatchImportTask(dataset_ids, open_export, file_paths, writers.GEOPACKAGE, max_workers=2)
+
+
+def test_failures_are_reported_while_the_batch_runs(monkeypatch, tmp_path):
+    failure_reported = threading.Event()
+    texts = []
+
+    def open_export(dataset_id):
+        if dataset_id == 'private':
+            raise DatasetError
+        if dataset_id == 'broken':
+            raise RuntimeError('Unexpected end of export')
+        return StubResponse(), 10, writers.GEOJSON, None, None
+
+    def download_to_file(imported_dataset, file_path, progress_reporter, is_canceled, *args, **kwargs):
+        # The last dataset downloads until the failure of the others was reported
+        assert failure_reported.wait(10)
+
+    def progress_text_changed(text):
+        texts.append(text)
+        if 'Failed: 2' in text:
+            failure_reported.set()
+
+    monkeypatch.setattr(tasks, 'download_to_file', download_to_file)
+    task = batch_task(tmp_path, ['private', 'broken', 'trees'], open_export)
+    task.progressTextChanged.connect(progress_text_changed)
+
+    assert task.run()
+
+    assert any('Failed: 2' in text and 'Datasets: 0/3 imported' in text for text in texts)
+    assert set(task.errors) == {'private', 'broken'}
+    assert isinstance(task.errors['broken'], RuntimeError)
+    assert task.imported == ['trees']
+
+
+def test_binary_exports_report_the_share_of_bytes_downloaded(monkeypatch, tmp_path):
+    progress = []
+
+    def open_export(dataset_id):
+        return StubResponse({'Content-Length': '4000'}), 10, writers.FLATGEOBUF, None, None
+
+    def download_to_file(imported_dataset, file_path, progress_reporter, is_canceled, *args, **kwargs):
+        progress_reporter.report(1000, None)
+        task.reportProgress(1)
+        progress.append(task.progress())
+
+    monkeypatch.setattr(tasks, 'download_to_file', download_to_file)
+    task = batch_task(tmp_path, ['trees'], open_export)
+
+    assert task.run()
+
+    assert progress == [25]
+
+
+def test_compressed_responses_have_no_known_size():
+    assert tasks.response_size(StubResponse({'Content-Length': '4000', 'Content-Encoding': 'gzip'})) is None
+    assert tasks.response_size(StubResponse({'Content-Length': '4000'})) == 4000
+    assert tasks.response_size(StubResponse()) is None
+
+
+GEOJSON_EXPORT = b'{"type": "FeatureCollection", "features": [' + b', '.join(
+    b'{"type": "Feature", "geometry": null, "properties": {"id": %d}}' % number for number in range(20)) + b']}'
+
+
+def test_import_task_downloads_in_the_background_and_reports_progress(monkeypatch, tmp_path):
+    monkeypatch.setattr(tasks, 'PROGRESS_INTERVAL', 0)
+    file_path = tmp_path / 'trees.geojson'
+    task = tasks.ImportDatasetTask('trees', StubResponse(content=GEOJSON_EXPORT), str(file_path), records_count=20)
+    texts = []
+    task.progressTextChanged.connect(texts.append)
+
+    assert task.run()
+
+    assert file_path.read_bytes() == GEOJSON_EXPORT
+    assert 'Records: 20/20 (100%)' in texts[-1]
+    assert task.progress() == 100
+
+
+def test_canceled_import_stops_and_removes_its_partial_file(tmp_path):
+    file_path = tmp_path / 'trees.geojson'
+    response = StubResponse(content=GEOJSON_EXPORT)
+    task = tasks.ImportDatasetTask('trees', response, str(file_path), records_count=20)
+    task.cancel()
+
+    assert not task.run()
+    assert len(file_path.read_bytes()) < len(GEOJSON_EXPORT)
+    task.finished(False)
+
+    assert not file_path.exists()
+    assert response.closed
+    assert task not in tasks._active_tasks
+
+
+def test_failed_import_reports_its_error_once_finished(tmp_path):
+    file_path = tmp_path / 'trees.geojson'
+    task = tasks.ImportDatasetTask('trees', StubResponse(content=GEOJSON_EXPORT[:50], error=DatasetError()),
+                                   str(file_path))
+    messages = []
+    task.errorOccurred.connect(messages.append)
+
+    assert not task.run()
+    task.finished(False)
+
+    assert isinstance(task.error, DatasetError)
+    assert messages == ['The import of trees was interrupted: DatasetError']
+    assert not file_path.exists()
+
+
+def test_progress_is_reported_at_most_every_interval():
+    reports = []
+    progress_reporter = tasks.ProgressReporter(100, lambda text, percentage: reports.append(percentage))
+
+    for downloaded_records in range(1, 51):
+        progress_reporter.report(downloaded_records * 1000, downloaded_records)
+
+    assert reports == [1]
+    assert progress_reporter.metrics() == {'bytes': 50000, 'write': 0, 'records': 50}
+
+
+class FakeProject:
+    """Layers of the current QGIS project, by identifier."""
+    def __init__(self):
+        self.layers = {}
+
+    def addMapLayer(self, layer):
+        self.layers[layer.id()] = layer
+
+    def mapLayer(self, layer_id):
+        return self.layers.get(layer_id)
+
+    def removeMapLayer(self, layer_id):
+        del self.layers[layer_id]
+
+
+@pytest.fixture
+def project(monkeypatch):
+    project = FakeProject()
+    monkeypatch.setattr(tasks, 'QgsProject', mock.Mock(instance=lambda: project))
+    monkeypatch.setattr(tasks, 'QgsVectorLayer', lambda uri, name, provider: mock.Mock(
+        uri=uri, id=mock.Mock(return_value='{}-layer'.format(name))))
+    return project
+
+
+def progressive_task(tmp_path):
+    return tasks.ProgressiveImportDatasetTask('trees', StubResponse(), str(tmp_path / 'trees.gpkg'), 10000)
+
+
+def test_committed_batches_are_shown_at_most_every_refresh_interval(project, tmp_path, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(tasks.time, 'monotonic', lambda: clock[0])
+    task = progressive_task(tmp_path)
+    shown = []
+    task.batchCommitted.connect(shown.append)
+
+    for count in (2000, 4000):
+        task.batchWritten(count)
+    clock[0] += tasks.REFRESH_INTERVAL
+    task.batchWritten(6000)
+
+    assert shown == [2000, 6000]
+    # The layer is added with the first batch, then reloaded
+    (layer,) = project.layers.values()
+    assert layer.uri == '{}|layername=trees'.format(task.file_path)
+    layer.reload.assert_called_once_with()
+    layer.triggerRepaint.assert_called_once_with()
+
+
+def test_layer_removed_by_the_user_is_only_added_again_once_complete(project, tmp_path):
+    task = progressive_task(tmp_path)
+    task.showBatch(2000)
+    project.removeMapLayer(task.layer_id)
+
+    task.showBatch(4000)
+    assert project.layers == {}
+    task.finished(True)
+
+    assert list(project.layers) == ['trees-layer']
+
+
+def test_canceled_progressive_import_shows_nothing(project, tmp_path):
+    task = progressive_task(tmp_path)
+    task.cancel()
+
+    task.showBatch(2000)
+
+    assert project.layers == {}
+
+
+def test_failed_progressive_import_removes_its_layer_and_file(project, tmp_path):
+    task = progressive_task(tmp_path)
+    task.showBatch(2000)
+    file_path = tmp_path / 'trees.gpkg'
+    file_path.write_bytes(b'first batch')
+    task.error = DatasetError()
+
+    task.finished(False)
+
+    assert project.layers == {}
+    assert not file_path.exists()
+
+
+def test_completed_progressive_import_reloads_its_layer(project, tmp_path):
+    task = progressive_task(tmp_path)
+    task.layer_properties = {'ods_dataset_id': 'trees'}
+    task.showBatch(2000)
+    layer = task.layer()
+
+    task.finished(True)
+
+    assert list(project.layers.values()) == [layer]
+    layer.updateExtents.assert_called_once_with()
+    layer.setCustomProperty.assert_called_once_with('ods_dataset_id', 'trees')
+    assert task.imported_dataset.closed
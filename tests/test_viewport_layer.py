@@ -0,0 +1,138 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+import json
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import viewport_layer
+
+DOMAIN = 'data.example.com'
+TILE = (3, 2, 1)
+
+
+def point(number, lon, lat):
+    return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': {'number': number}}
+
+
+@pytest.fixture
+def controllers(monkeypatch, tmp_path):
+    """Build controllers whose tiles are cached in tmp_path, recording the tiles they fetch."""
+    monkeypatch.setattr(viewport_layer, 'DISK_CACHE_DIRECTORY_NAME', str(tmp_path / 'tiles'))
+    # The map canvas is not read: tests show tiles themselves
+    monkeypatch.setattr(viewport_layer.ViewportLayerController, 'updateTiles', lambda self: None)
+    monkeypatch.setattr(viewport_layer.ViewportLayerController, 'refreshLayer', lambda self: None)
+    fetched = []
+    monkeypatch.setattr(viewport_layer.ViewportLayerController, 'fetchTile', lambda self, tile: fetched.append(tile))
+
+    def controller(params=None, dataset_id='trees'):
+        return viewport_layer.ViewportLayerController(mock.Mock(), mock.Mock(domain_url=DOMAIN, apikey=None),
+                                                      dataset_id, params or {}, 'geo_point_2d')
+    controller.fetched = fetched
+    return controller
+
+
+def test_tile_keys_depend_on_the_query_the_api_key_and_the_tile():
+    query = ('trees', {'where': 'height > 10'}, 'geo_point_2d')
+    key = viewport_layer.tile_key(DOMAIN, None, *query, TILE)
+
+    assert key == viewport_layer.tile_key(DOMAIN, None, *query, TILE)
+    assert key != viewport_layer.tile_key(DOMAIN, None, *query, (3, 2, 2))
+    assert key != viewport_layer.tile_key(DOMAIN, None, 'trees', {}, 'geo_point_2d', TILE)
+    assert key != viewport_layer.tile_key(DOMAIN, None, 'roads', {'where': 'height > 10'}, 'geo_point_2d', TILE)
+    assert key != viewport_layer.tile_key('other.example.com', None, *query, TILE)
+    assert key != viewport_layer.tile_key(DOMAIN, 'secret', *query, TILE)
+    assert viewport_layer.tile_key(DOMAIN, 'secret', *query, TILE) \
+        != viewport_layer.tile_key(DOMAIN, 'other secret', *query, TILE)
+
+
+def test_visible_tiles_cover_the_extent():
+    tiles = viewport_layer.visible_tiles(2.2, 48.8, 2.5, 48.9)
+
+    lon_min = min(viewport_layer.tile_bounds(tile)[0] for tile in tiles)
+    lat_min = min(viewport_layer.tile_bounds(tile)[1] for tile in tiles)
+    lon_max = max(viewport_layer.tile_bounds(tile)[2] for tile in tiles)
+    lat_max = max(viewport_layer.tile_bounds(tile)[3] for tile in tiles)
+    assert lon_min <= 2.2 and lat_min <= 48.8 and lon_max >= 2.5 and lat_max >= 48.9
+    assert len({tile[0] for tile in tiles}) == 1
+    assert len(tiles) <= 2 * (viewport_layer.TILES_PER_VIEW + 1)
+
+
+def test_cached_tiles_are_reused_by_the_next_controller(controllers):
+    features = [point(1, 2.3, 48.85), point(2, 2.4, 48.86)]
+    controllers().storeFeatures(TILE, features)
+
+    controller = controllers()
+    controller.showTiles([TILE, (3, 2, 2)])
+
+    assert controller.cachedFeatures(TILE) == features
+    assert controllers.fetched == [(3, 2, 2)]
+
+
+def test_tiles_of_another_query_are_fetched(controllers):
+    controllers({'where': 'height > 10'}).storeFeatures(TILE, [point(1, 2.3, 48.85)])
+
+    controllers({'where': 'height > 20'}).showTiles([TILE])
+    controllers({'where': 'height > 10'}, dataset_id='roads').showTiles([TILE])
+
+    assert controllers.fetched == [TILE, TILE]
+
+
+def test_tiles_are_not_stored_with_the_catalog(controllers, tmp_path):
+    controllers().storeFeatures(TILE, [point(1, 2.3, 48.85)])
+
+    entry = viewport_layer.TileCache(str(tmp_path / 'tiles')).get(controllers().tileKey(TILE))
+
+    assert entry['features'] == [point(1, 2.3, 48.85)]
+    assert 'json_dataset' not in entry
+
+
+def test_memory_cache_is_bounded_by_features_but_keeps_the_tiles_in_view(controllers, monkeypatch):
+    monkeypatch.setattr(viewport_layer, 'MEMORY_CACHE_MAX_FEATURES', 4)
+    controller = controllers()
+    tiles = [(3, x, 1) for x in range(4)]
+    controller.current_tiles = tiles[:2]
+
+    for x, tile in enumerate(tiles):
+        controller.storeFeatures(tile, [point(x * 10 + number, 2.3, 48.85) for number in range(3)], on_disk=False)
+
+    assert list(controller.memory_cache) == [tiles[0], tiles[1], tiles[3]]
+    assert controller.memory_cache_features == 9
+
+
+class StubResponse:
+    def __init__(self, features):
+        self.content = json.dumps({'type': 'FeatureCollection', 'features': features}).encode('utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size=None):
+        yield self.content
+
+
+@pytest.mark.parametrize('records_count, truncated', [(3, False), (4, True)])
+def test_tiles_over_the_record_limit_are_truncated(monkeypatch, records_count, truncated):
+    monkeypatch.setattr(viewport_layer, 'TILE_RECORD_LIMIT', 3)
+    ods_client = mock.Mock()
+    ods_client.get.side_effect = lambda path, params, **kwargs: StubResponse(
+        [point(number, 2.3, 48.85) for number in range(min(records_count, params['limit']))])
+    task = viewport_layer.TileFetchTask(ods_client, 'trees', {}, 'geo_point_2d', TILE)
+
+    assert task.run()
+
+    assert task.truncated == truncated
+    assert len(task.features) == 3
+    assert ods_client.get.call_args[0][1]['limit'] == 4
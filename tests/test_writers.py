@@ -0,0 +1,99 @@
+# -----------------------------------------------------------
+# Copyright (C) 2021 Venceslas Roullier/Opendatasoft
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+# ---------------------------------------------------------------------
+
+from unittest import mock
+
+import pytest
+
+from Opendatasoft import writers
+
+
+@pytest.fixture
+def ogr(monkeypatch):
+    """OGR module whose GPKG driver creates a layer recording the calls made to it."""
+    ogr = mock.Mock(name='ogr')
+    layer = ogr.GetDriverByName.return_value.CreateDataSource.return_value.CreateLayer.return_value
+    ogr.layer = layer
+    monkeypatch.setattr(writers, 'ogr', ogr)
+    monkeypatch.setattr(writers, 'osr', mock.Mock(name='osr'))
+    return ogr
+
+
+def feature(number):
+    return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [2.35, 48.85]},
+            'properties': {'id': number, 'name': 'tree {}'.format(number)}}
+
+
+def transactions(layer):
+    """Names of the transaction calls made to layer, in order."""
+    return [name for name, args, kwargs in layer.method_calls
+            if name in ('StartTransaction', 'CommitTransaction')]
+
+
+def test_geopackage_layer_is_created_with_a_spatial_index(ogr, tmp_path):
+    writers.GeoPackageWriter(str(tmp_path / 'trees.gpkg'), 'paris-trees').close()
+
+    ogr.GetDriverByName.assert_called_once_with('GPKG')
+    name, spatial_reference, geometry_type, options = \
+        ogr.GetDriverByName.return_value.CreateDataSource.return_value.CreateLayer.call_args[0]
+    assert name == 'paris_trees'
+    assert 'SPATIAL_INDEX=YES' in options
+
+
+def test_features_are_committed_in_batches(ogr, tmp_path):
+    commits = []
+    writer = writers.GeoPackageWriter(str(tmp_path / 'trees.gpkg'), 'trees', batch_size=2, on_commit=commits.append)
+
+    for number in range(5):
+        writer.write(feature(number))
+    writer.close()
+
+    assert writer.count == 5
+    assert ogr.layer.CreateFeature.call_count == 5
+    # Each field is created once, when it first shows up
+    assert ogr.layer.CreateField.call_count == 2
+    assert commits == [2, 4]
+    assert transactions(ogr.layer) == ['StartTransaction', 'CommitTransaction', 'StartTransaction',
+                                       'CommitTransaction', 'StartTransaction', 'CommitTransaction']
+
+
+def test_existing_file_is_replaced(ogr, tmp_path):
+    file_path = tmp_path / 'trees.gpkg'
+    file_path.write_bytes(b'previous import')
+
+    writers.GeoPackageWriter(str(file_path), 'trees').close()
+
+    assert not file_path.exists()
+    ogr.GetDriverByName.return_value.CreateDataSource.assert_called_once_with(str(file_path))
+
+
+def test_appending_to_a_missing_layer_fails(ogr, tmp_path):
+    ogr.Open.return_value.GetLayerByName.return_value = None
+
+    with pytest.raises(OSError):
+        writers.GeoPackageWriter(str(tmp_path / 'trees.gpkg'), 'trees', append=True)
+
+
+def test_auto_export_format_is_flatgeobuf_when_gdal_reads_it(ogr):
+    assert writers.resolve_export_format(writers.AUTO) == writers.FLATGEOBUF
+    ogr.GetDriverByName.assert_called_once_with('FlatGeobuf')
+
+
+def test_auto_export_format_falls_back_to_geojson_without_flatgeobuf_driver(ogr):
+    ogr.GetDriverByName.return_value = None
+
+    assert writers.resolve_export_format(writers.AUTO) == writers.GEOJSON
+
+
+@pytest.mark.parametrize('export_format', [writers.GEOJSON, writers.PARQUET, writers.JSONL, writers.FLATGEOBUF])
+def test_chosen_export_format_is_kept(ogr, export_format):
+    ogr.GetDriverByName.return_value = None
+
+    assert writers.resolve_export_format(export_format) == export_format